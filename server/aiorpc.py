@@ -0,0 +1,181 @@
+from server import (framing, rpc)
+from collections import deque
+import asyncio
+import logging
+import socket
+import time
+
+
+"""
+Channel that runs on an asyncio event loop instead of a dedicated thread.
+
+Reading, parsing and writing all happen on the loop, so an idle connection
+costs no thread at all. Handler methods are still ordinary blocking functions,
+so each request is run on the shared worker pool. Writes are scheduled onto the
+loop, which makes send() safe to call from those worker threads, and lets
+handler code use the same Proxy class as the threaded server.
+
+Frames are handed to the transport until its buffer passes the high water mark
+and it pauses writing, and stay in the channel's bounded outbound queue after
+that, until the peer catches up.
+"""
+class AsyncListener(rpc.Channel, asyncio.BufferedProtocol):
+    # The event loop must never wait for room in the worker pool.
+    blocking = False
+    # Seconds between attempts to submit held back requests.
+    retry_interval = 0.01
+
+    """
+    Creates a listener for a new connection. The handler class is instantiated
+    once the connection is made, and on_disconnect is called with the proxy
+    when the connection is lost.
+    """
+    def __init__(self, loop, handler, on_disconnect=None):
+        rpc.Channel.__init__(self)
+        self.loop = loop
+        self.handler_class = handler
+        self.on_disconnect = on_disconnect
+        self.transport = None
+        self.proxy = None
+        # Requests held back while the worker pool is full.
+        self.backlog = deque()
+        # Whether a call to _flush() is scheduled on the loop.
+        self.flush_scheduled = False
+        # Whether the transport has asked for writing to pause.
+        self.paused = False
+        self.closing = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.address = transport.get_extra_info("peername")
+        self.open = True
+
+        sock = transport.get_extra_info("socket")
+        if sock is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+
+        logging.info("Received connection from %s", self.address)
+        self.proxy = rpc.Proxy(self, self.handler_class)
+
+    def get_buffer(self, sizehint):
+        return self.decoder.get_buffer(sizehint)
+
+    def buffer_updated(self, nbytes):
+        self.decoder.buffer_updated(nbytes)
+        self.bytes_in += nbytes
+        try:
+            self._process_frames()
+        except (framing.FrameException, ValueError) as e:
+            logging.warning("Closing connection to %s: %s", self.address, e)
+            self.transport.abort()
+
+    def connection_lost(self, exc):
+        self.open = False
+        self._closed()
+        if self.on_disconnect is not None:
+            self.on_disconnect(self.proxy)
+
+    """
+    The event loop does the reading, so there is no thread to start.
+    """
+    def start(self):
+        pass
+
+    """
+    Queues raw bytes to be written by the event loop.
+    """
+    def _write(self, data, droppable=False):
+        with self.write_lock:
+            if not self._enqueue(data, droppable):
+                self.loop.call_soon_threadsafe(self.transport.abort)
+                return
+
+            if self.flush_scheduled:
+                return
+            self.flush_scheduled = True
+
+        self.loop.call_soon_threadsafe(self._flush)
+
+    """
+    Hands queued frames to the transport until it pauses writing.
+    """
+    def _flush(self):
+        with self.write_lock:
+            self.flush_scheduled = False
+            if self.transport.is_closing():
+                return
+
+            while self.outbound and not self.paused:
+                data = self.outbound.popleft()[0]
+                self.outbound_bytes -= len(data)
+                # May call pause_writing() before returning.
+                self.transport.write(data)
+
+            if self.outbound:
+                if self.stalled_since is None:
+                    self.stalled_since = time.time()
+                return
+            self.stalled_since = None
+
+        if self.closing:
+            self.transport.close()
+
+    def pause_writing(self):
+        self.paused = True
+
+    def resume_writing(self):
+        self.paused = False
+        self._flush()
+
+    """
+    Submits a task to the worker pool, behind any tasks that are already held
+    back. Under the "wait" overload policy, tasks the pool has no room for are
+    held back instead of blocking the loop, for single requests and batch
+    entries alike, and reading from the peer is paused until they have all been
+    submitted.
+    """
+    def _submit(self, task, strand, block):
+        if not self.backlog and rpc.pool.submit(task, strand):
+            return True
+        if rpc.pool.overload != "wait":
+            return False
+
+        self.backlog.append((task, strand))
+        if len(self.backlog) == 1:
+            self.transport.pause_reading()
+            self.loop.call_later(self.retry_interval, self._retry)
+        return True
+
+    def _retry(self):
+        while self.backlog:
+            (task, strand) = self.backlog[0]
+            if not rpc.pool.submit(task, strand):
+                self.loop.call_later(self.retry_interval, self._retry)
+                return
+            self.backlog.popleft()
+
+        if not self.transport.is_closing():
+            self.transport.resume_reading()
+
+    """
+    Closes the connection once any pending writes have been flushed.
+    """
+    def close_later(self):
+        self.close()
+
+    """
+    Closes the connection once everything queued before this call has been
+    written.
+    """
+    def close(self):
+        self.open = False
+        if self.transport is not None:
+            self.loop.call_soon_threadsafe(self._close_when_flushed)
+
+    def _close_when_flushed(self):
+        with self.write_lock:
+            self.closing = True
+            if self.outbound:
+                # _flush() closes the transport once the queue is empty.
+                return
+        self.transport.close()
@@ -0,0 +1,348 @@
+from server import rpc
+import argparse
+import json
+import logging
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+
+"""
+Measures the throughput and latency of a chat server under load.
+
+Starts a server on localhost with an empty temporary data directory (or uses
+one that is already running), creates accounts and groups, and then runs a
+number of simulated clients at once for a fixed time. Each client logs in and
+loops over a weighted mix of operations. Every client also receives messages,
+and measures how long they took to arrive from the moment they were sent.
+
+Results are printed as JSON, so runs against different builds can be compared.
+"""
+
+
+# Relative weights of the operations each client performs.
+DEFAULT_MIX = {
+    "send_user": 40,
+    "send_group": 20,
+    "history": 20,
+    "friends": 10,
+    "groups": 10
+}
+
+PASSWORD = "benchmark"
+
+
+"""
+Timings for one kind of operation.
+"""
+class Samples:
+    def __init__(self):
+        self.latencies = []
+        self.errors = 0
+        self.lock = threading.Lock()
+
+    def add(self, seconds):
+        with self.lock:
+            self.latencies.append(seconds)
+
+    def fail(self):
+        with self.lock:
+            self.errors += 1
+
+    def summary(self, duration):
+        latencies = sorted(self.latencies)
+        return {
+            "count": len(latencies),
+            "errors": self.errors,
+            "throughput": len(latencies) / duration if duration else 0.0,
+            "mean": sum(latencies) / len(latencies) if latencies else 0.0,
+            "p50": percentile(latencies, 0.5),
+            "p95": percentile(latencies, 0.95),
+            "p99": percentile(latencies, 0.99),
+            "max": latencies[-1] if latencies else 0.0
+        }
+
+
+"""
+Handles messages pushed to a simulated client, recording how long they took to
+arrive. Benchmark messages carry their send time in their text.
+"""
+class BenchmarkHandler(rpc.Handler):
+    def __init__(self, proxy, samples):
+        rpc.Handler.__init__(self, proxy)
+        self.samples = samples
+
+    def receive_message(self, **message):
+        try:
+            sent = float(message["text"].split()[1])
+        except (IndexError, ValueError):
+            return True
+
+        self.samples.add(time.time() - sent)
+        return True
+
+    def receive_presence(self, users):
+        return True
+
+
+"""
+One simulated user, with its own connection, running operations in a loop.
+"""
+class Client(threading.Thread):
+    def __init__(self, benchmark, username):
+        threading.Thread.__init__(self, daemon=True)
+        self.benchmark = benchmark
+        self.username = username
+        self.random = random.Random(username)
+        self.proxy = None
+        self.token = None
+
+    def connect(self):
+        self.proxy = rpc.connect(
+            self.benchmark.address,
+            self.benchmark.port,
+            lambda proxy: BenchmarkHandler(proxy, self.benchmark.delivery)
+        )
+        self.token = self.proxy.login(username=self.username, password=PASSWORD)
+
+    def run(self):
+        operations = list(self.benchmark.mix)
+        weights = [self.benchmark.mix[name] for name in operations]
+
+        while not self.benchmark.stopping.is_set():
+            name = self.random.choices(operations, weights)[0]
+            samples = self.benchmark.operations[name]
+
+            start = time.perf_counter()
+            try:
+                getattr(self, name)()
+            except Exception as e:
+                samples.fail()
+                logging.debug("%s failed for %s: %s", name, self.username, e)
+                continue
+            samples.add(time.perf_counter() - start)
+
+    def send_user(self):
+        self.proxy.send_message(
+            token=self.token,
+            receiver={"type": "user", "username": self.random.choice(self.benchmark.usernames)},
+            text="benchmark %r" % time.time()
+        )
+
+    def send_group(self):
+        self.proxy.send_message(
+            token=self.token,
+            receiver={"type": "group", "id": self.random.choice(self.benchmark.groups)},
+            text="benchmark %r" % time.time()
+        )
+
+    def history(self):
+        self.proxy.get_message_page_with_user(
+            token=self.token,
+            username=self.random.choice(self.benchmark.usernames),
+            limit=50
+        )
+
+    def friends(self):
+        friend = self.random.choice(self.benchmark.usernames)
+        self.proxy.add_friend(token=self.token, username=friend)
+        self.proxy.get_friends(token=self.token)
+        self.proxy.remove_friend(token=self.token, username=friend)
+
+    def groups(self):
+        group = self.random.choice(self.benchmark.groups)
+        self.proxy.add_group_user(token=self.token, group=group, username=self.random.choice(self.benchmark.usernames))
+        self.proxy.get_group(token=self.token, id=group)
+
+    def close(self):
+        try:
+            self.proxy.close()
+        except Exception:
+            pass
+
+
+"""
+Runs a benchmark against a server at the given address and port.
+"""
+class Benchmark:
+    def __init__(self, address, port, clients=20, groups=10, group_size=5, duration=10.0, mix=DEFAULT_MIX):
+        self.address = address
+        self.port = port
+        self.client_count = clients
+        self.group_count = groups
+        self.group_size = group_size
+        self.duration = duration
+        self.mix = mix
+        self.usernames = []
+        self.groups = []
+        self.operations = {name: Samples() for name in mix}
+        self.delivery = Samples()
+        self.stopping = threading.Event()
+
+    """
+    Creates the accounts and groups used by the clients. Usernames include the
+    time, so a benchmark can be run more than once against the same server.
+    """
+    def setup(self):
+        proxy = rpc.connect(self.address, self.port, rpc.Handler)
+        prefix = "bench%x" % int(time.time() * 1000)
+
+        # One at a time, since the server limits how many passwords it hashes at once.
+        for i in range(self.client_count):
+            username = "%s_%d" % (prefix, i)
+            proxy.create_user(username=username, password=PASSWORD, first_name="Bench", last_name=str(i),
+                email=username + "@example.com", address="localhost")
+            self.usernames.append(username)
+
+        token = proxy.login(username=self.usernames[0], password=PASSWORD)
+        for _ in range(self.group_count):
+            group = proxy.create_group(token=token)
+            for username in random.sample(self.usernames, min(self.group_size, len(self.usernames))):
+                proxy.add_group_user(token=token, group=group, username=username)
+            self.groups.append(group)
+
+        proxy.close()
+
+    """
+    Runs every client for the configured time and returns the results.
+    """
+    def run(self):
+        clients = [Client(self, username) for username in self.usernames]
+
+        start = time.perf_counter()
+        for client in clients:
+            client.connect()
+        connect_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for client in clients:
+            client.start()
+        self.stopping.wait(self.duration)
+        self.stopping.set()
+        for client in clients:
+            client.join()
+        elapsed = time.perf_counter() - start
+
+        # Give messages still in flight a moment to arrive.
+        time.sleep(0.5)
+        for client in clients:
+            client.close()
+
+        operations = {name: samples.summary(elapsed) for name, samples in self.operations.items()}
+        total = Samples()
+        for samples in self.operations.values():
+            total.latencies.extend(samples.latencies)
+            total.errors += samples.errors
+
+        return {
+            "config": {
+                "clients": self.client_count,
+                "groups": self.group_count,
+                "group_size": self.group_size,
+                "duration": self.duration,
+                "mix": self.mix
+            },
+            "elapsed": elapsed,
+            "login_time": connect_time,
+            "operations": operations,
+            "total": total.summary(elapsed),
+            "delivery": self.delivery.summary(elapsed)
+        }
+
+
+"""
+Gets the value below which a fraction q of sorted values fall.
+"""
+def percentile(values, q):
+    if not values:
+        return 0.0
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+"""
+Starts a server on a free local port with a data directory, returning the
+process and port once it accepts connections.
+"""
+def start_server(data_dir, server_args):
+    probe = socket.socket()
+    probe.bind(("127.0.0.1", 0))
+    port = probe.getsockname()[1]
+    probe.close()
+
+    script = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "server.py")
+    with open(os.path.join(data_dir, "server.log"), "wb") as log:
+        process = subprocess.Popen(
+            [sys.executable, script, "--port", str(port), "--data-dir", data_dir] + server_args,
+            stdout=subprocess.DEVNULL,
+            stderr=log
+        )
+
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise Exception("Server exited with status " + str(process.returncode))
+        try:
+            socket.create_connection(("127.0.0.1", port), 0.1).close()
+            return (process, port)
+        except OSError:
+            time.sleep(0.05)
+
+    process.kill()
+    raise Exception("Server did not start listening")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the chat server",
+        epilog="Arguments after -- are passed to the server, for example: -- --storage sqlite")
+    parser.add_argument("--clients", type=int, default=20, help="number of simulated clients")
+    parser.add_argument("--groups", type=int, default=10, help="number of groups to create")
+    parser.add_argument("--group-size", type=int, default=5, help="number of users added to each group")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds to run the clients for")
+    parser.add_argument("--mix", type=json.loads, default=DEFAULT_MIX,
+        help="JSON object of operation weights, out of " + ", ".join(DEFAULT_MIX))
+    parser.add_argument("--connect", metavar="HOST:PORT",
+        help="use a running server instead of starting one")
+    parser.add_argument("--output", help="file to write the JSON results to instead of standard output")
+    parser.add_argument("server_args", nargs="*", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    unknown = set(args.mix) - set(DEFAULT_MIX)
+    if unknown:
+        parser.error("unknown operations in --mix: " + ", ".join(sorted(unknown)))
+
+    logging.basicConfig(level=logging.WARNING, format="%(asctime)s %(levelname)s: %(message)s")
+
+    with tempfile.TemporaryDirectory(prefix="chat-benchmark-") as data_dir:
+        process = None
+        if args.connect is not None:
+            (address, port) = args.connect.rsplit(":", 1)
+            port = int(port)
+        else:
+            (process, port) = start_server(data_dir, args.server_args)
+            address = "127.0.0.1"
+
+        try:
+            benchmark = Benchmark(address, port, args.clients, args.groups, args.group_size, args.duration, args.mix)
+            benchmark.setup()
+            results = benchmark.run()
+        finally:
+            if process is not None:
+                process.terminate()
+                process.wait()
+
+    results["server_args"] = args.server_args
+    output = json.dumps(results, indent=2)
+    if args.output is None:
+        print(output)
+    else:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,245 @@
+from server import rpc
+from server.modules import (delivery, groups, presence)
+import logging
+import os
+import socket
+import threading
+
+
+"""
+Routes real-time deliveries between worker processes.
+
+When the server runs as several processes, each user is connected to only one
+of them. Workers tell the broker which users are connected to them, and send
+messages for users they do not hold to the broker, which passes them on to the
+right worker. Messages to a group are passed on to every other worker, which
+delivers them to the group's members it holds, and so are changes to groups, so
+that workers can drop their cached copy. Workers also tell the broker which
+users are online on them, and the broker tells every worker when a user comes
+online or goes offline across all of them. The broker runs in the supervisor
+process and talks to workers over a Unix domain socket using the same RPC
+protocol as clients. Everything is sent as notifications, so nobody waits for a
+reply.
+"""
+class Broker:
+    """
+    Creates a broker around a listening socket from listen().
+    """
+    def __init__(self, server_socket):
+        self.socket = server_socket
+        # Proxy for the worker holding each connected user.
+        self.locations = {}
+        # Proxies for every connected worker.
+        self.workers = set()
+        # Users online on each worker, by proxy.
+        self.presence = {}
+        # Number of workers each online user is online on.
+        self.online = {}
+        self.lock = threading.Lock()
+
+    """
+    Starts accepting worker connections in the background.
+    """
+    def start(self):
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            try:
+                connection, _ = self.socket.accept()
+            except OSError:
+                return
+
+            listener = BrokerListener(connection, self)
+            proxy = rpc.Proxy(listener, lambda proxy: BrokerHandler(proxy, self))
+            with self.lock:
+                self.workers.add(proxy)
+
+    def register(self, proxy, username):
+        with self.lock:
+            self.locations[username] = proxy
+
+    def unregister(self, proxy, username):
+        with self.lock:
+            if self.locations.get(username) is proxy:
+                del self.locations[username]
+
+    def route(self, username, message, method):
+        with self.lock:
+            proxy = self.locations.get(username)
+
+        if proxy is not None:
+            proxy.notify("deliver", {"username": username, "message": message, "method": method})
+
+    """
+    Sends a notification to every worker but the one it came from.
+    """
+    def broadcast(self, sender, method, params):
+        with self.lock:
+            workers = [proxy for proxy in self.workers if proxy is not sender]
+
+        for proxy in workers:
+            proxy.notify(method, params)
+
+    """
+    Records whether a user is online on a worker, and tells every worker if
+    that changes whether they are online at all.
+    """
+    def set_presence(self, proxy, username, online):
+        with self.lock:
+            if not proxy in self.workers:
+                return
+            users = self.presence.setdefault(proxy, set())
+            if online == (username in users):
+                return
+
+            if online:
+                users.add(username)
+            else:
+                users.discard(username)
+            if self._count(username, 1 if online else -1):
+                self._presence_changed(username, online)
+
+    """
+    Forgets every user held by a worker that has disconnected, and tells the
+    other workers about users who were only online on it.
+    """
+    def disconnected(self, proxy):
+        with self.lock:
+            self.workers.discard(proxy)
+            for username in [username for username, location in self.locations.items() if location is proxy]:
+                del self.locations[username]
+
+            for username in self.presence.pop(proxy, ()):
+                if self._count(username, -1):
+                    self._presence_changed(username, False)
+
+    """
+    Changes the number of workers a user is online on, and returns whether
+    they came online or went offline.
+    """
+    def _count(self, username, change):
+        count = self.online.get(username, 0) + change
+        if count > 0:
+            self.online[username] = count
+        else:
+            self.online.pop(username, None)
+        return count == (1 if change > 0 else 0)
+
+    """
+    Tells every worker about a change in a user's presence. Called with the
+    lock held, so that workers get the changes in the order they happened.
+    """
+    def _presence_changed(self, username, online):
+        for proxy in self.workers:
+            proxy.notify("presence_changed", {"username": username, "online": online})
+
+
+"""
+Listener for a worker connection that tells the broker when it closes.
+"""
+class BrokerListener(rpc.Listener):
+    def __init__(self, connection, broker):
+        rpc.Listener.__init__(self, connection)
+        self.broker = broker
+        # Deliveries to a whole worker must not be limited like a client's.
+        self.max_outbound_bytes = None
+        self.max_outbound_messages = None
+
+    def run(self):
+        rpc.Listener.run(self)
+        self.broker.disconnected(self.handler.proxy)
+
+
+"""
+Handles notifications from a worker.
+"""
+class BrokerHandler(rpc.Handler):
+    def __init__(self, proxy, broker):
+        rpc.Handler.__init__(self, proxy)
+        self.broker = broker
+
+    def register(self, username):
+        self.broker.register(self.proxy, username)
+
+    def unregister(self, username):
+        self.broker.unregister(self.proxy, username)
+
+    def route(self, username, message, method):
+        self.broker.route(username, message, method)
+
+    def route_group(self, group, message, method):
+        self.broker.broadcast(self.proxy, "deliver_group", {"group": group, "message": message, "method": method})
+
+    def group_changed(self, id):
+        self.broker.broadcast(self.proxy, "group_changed", {"id": id})
+
+    def set_presence(self, username, online):
+        self.broker.set_presence(self.proxy, username, online)
+
+
+"""
+Connection from a worker process to the broker, used by the delivery manager
+to route messages for users connected to other workers.
+"""
+class BrokerClient:
+    def __init__(self, path):
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.connect(path)
+        listener = rpc.Listener(connection)
+        listener.max_outbound_bytes = None
+        listener.max_outbound_messages = None
+        self.proxy = rpc.Proxy(listener, WorkerHandler)
+
+    def register(self, username):
+        self.proxy.notify("register", {"username": username})
+
+    def unregister(self, username):
+        self.proxy.notify("unregister", {"username": username})
+
+    def route(self, username, message, method):
+        self.proxy.notify("route", {"username": username, "message": message, "method": method})
+
+    def route_group(self, group, message, method):
+        self.proxy.notify("route_group", {"group": group, "message": message, "method": method})
+
+    def group_changed(self, id):
+        self.proxy.notify("group_changed", {"id": id})
+
+    def set_presence(self, username, online):
+        self.proxy.notify("set_presence", {"username": username, "online": online})
+
+
+"""
+Handles deliveries, group changes and presence changes passed on by the
+broker.
+"""
+class WorkerHandler(rpc.Handler):
+    def deliver(self, username, message, method):
+        delivery.manager.deliver(username, message, method, route=False)
+
+    def deliver_group(self, group, message, method):
+        delivery.manager.deliver_group(group, groups.manager.get_online_members(group), message, method, route=False)
+
+    def group_changed(self, id):
+        groups.manager.invalidate(id)
+
+    def presence_changed(self, username, online):
+        presence.manager.set_online(username, online)
+
+
+"""
+Creates the broker's listening socket at the given path, replacing any socket
+left behind by an earlier run.
+"""
+def listen(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+    server_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server_socket.bind(path)
+    server_socket.listen(64)
+    logging.info("Broker listening on %s", path)
+    return server_socket
@@ -0,0 +1,132 @@
+import json
+import zlib
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+"""
+Codecs and compressors for message payloads.
+
+Every peer understands JSON, which is also what a connection starts with.
+Peers can negotiate MessagePack and per-frame compression instead when both
+sides have the libraries installed. Those produce binary payloads, so they are
+only used together with length-prefixed framing.
+"""
+
+
+"""
+Encodes messages as JSON, using orjson if it is installed since it is much
+faster than the standard library and produces the same format.
+"""
+class JsonCodec:
+    name = "json"
+    binary = False
+
+    def encode(self, message):
+        if orjson is not None:
+            return orjson.dumps(message)
+        return json.dumps(message).encode()
+
+    def decode(self, payload):
+        if orjson is not None:
+            return orjson.loads(payload)
+        return json.loads(str(payload, "utf-8"))
+
+
+"""
+Encodes messages as MessagePack.
+"""
+class MsgpackCodec:
+    name = "msgpack"
+    binary = True
+
+    def encode(self, message):
+        return msgpack.packb(message, use_bin_type=True)
+
+    def decode(self, payload):
+        return msgpack.unpackb(payload, raw=False)
+
+
+"""
+Compresses payloads with zlib.
+"""
+class ZlibCompressor:
+    name = "zlib"
+
+    def compress(self, payload):
+        return zlib.compress(payload, 1)
+
+    def decompress(self, payload, max_size):
+        decompressor = zlib.decompressobj()
+        try:
+            data = decompressor.decompress(payload, max_size)
+        except zlib.error as e:
+            raise ValueError("Invalid compressed frame: " + str(e))
+        if decompressor.unconsumed_tail:
+            raise ValueError("Decompressed frame is larger than " + str(max_size) + " bytes")
+        return data
+
+
+"""
+Compresses payloads with Zstandard.
+"""
+class ZstdCompressor:
+    name = "zstd"
+
+    def compress(self, payload):
+        return zstandard.ZstdCompressor(level=3).compress(payload)
+
+    def decompress(self, payload, max_size):
+        try:
+            return zstandard.ZstdDecompressor().decompress(payload, max_output_size=max_size)
+        except zstandard.ZstdError as e:
+            raise ValueError("Invalid compressed frame: " + str(e))
+
+
+JSON = JsonCodec()
+
+"""
+Available codecs by name, and their names from most to least preferred.
+"""
+CODECS = {JSON.name: JSON}
+if msgpack is not None:
+    CODECS[MsgpackCodec.name] = MsgpackCodec()
+PREFERRED_CODECS = [name for name in ("msgpack", "json") if name in CODECS]
+
+"""
+Available compressors by name, and their names from most to least preferred.
+"""
+COMPRESSORS = {ZlibCompressor.name: ZlibCompressor()}
+if zstandard is not None:
+    COMPRESSORS[ZstdCompressor.name] = ZstdCompressor()
+PREFERRED_COMPRESSORS = [name for name in ("zstd", "zlib") if name in COMPRESSORS]
+
+# Compressed payloads start with a flag byte saying whether they are compressed.
+UNCOMPRESSED = b"\x00"
+COMPRESSED = b"\x01"
+
+# Default size in bytes above which payloads are compressed.
+COMPRESSION_THRESHOLD = 1024
+
+
+"""
+Picks the first name in a peer's list of preferences that is available here.
+"""
+def choose(preferences, available, default=None):
+    for name in preferences:
+        if name in available:
+            return name
+    return default
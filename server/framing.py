@@ -0,0 +1,175 @@
+"""
+Splits the byte stream between peers into frames, each holding one message.
+
+Two framings are supported. "delimited" frames end with four NUL bytes, which
+every client understands. "length" frames start with their length as a 4-byte
+big-endian integer, which can be parsed without scanning the payload. Peers
+start out delimited and can switch to length prefixes by negotiating it.
+"""
+
+DELIMITED = "delimited"
+LENGTH = "length"
+FRAMINGS = (DELIMITED, LENGTH)
+
+DELIMITER = b"\0\0\0\0"
+LENGTH_SIZE = 4
+
+# Default limit on the size of a single frame.
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+# Size of the buffer allocated when data arrives. It grows for larger bursts and
+# frames; a small one is cheap to allocate again after every read.
+BUFFER_SIZE = 8192
+
+# Smallest amount of free space offered to each read.
+MIN_READ_SIZE = 4096
+
+
+"""
+Exception thrown if the peer sends a frame that cannot be parsed.
+"""
+class FrameException(Exception):
+    pass
+
+
+"""
+Wraps a payload in a frame.
+"""
+def frame(payload, framing=DELIMITED):
+    if framing == LENGTH:
+        return len(payload).to_bytes(LENGTH_SIZE, "big") + payload
+    return payload + DELIMITER
+
+
+"""
+Incremental frame parser that reads straight into a preallocated buffer.
+
+The reader asks for a writable view with get_buffer(), receives into it (for
+example with socket.recv_into()), reports how much was written with
+buffer_updated(), and then iterates over frames(). This is the same interface
+as asyncio.BufferedProtocol, so it can back one directly.
+
+Frames are returned as memoryview slices of the buffer, without copying, and
+are only valid until the next call to get_buffer(). Data is only moved when
+the unparsed tail has to be shifted to the front of the buffer to make room.
+In delimited mode, searching resumes where the last search stopped instead of
+rescanning the whole partial frame.
+
+The buffer is allocated when data first arrives, and released once every frame
+in it has been parsed, so idle connections hold no buffer at all, and one grown
+for a large frame does not keep that size.
+"""
+class FrameDecoder:
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE, bufsize=BUFFER_SIZE, framing=DELIMITED):
+        self.max_frame_size = max_frame_size
+        self.framing = framing
+        # Size of the buffer allocated when data arrives.
+        self.bufsize = bufsize
+        self._release()
+
+    """
+    Gets a writable view of the free space at the end of the buffer, making
+    room first if there is little left.
+    """
+    def get_buffer(self, sizehint=-1):
+        needed = max(sizehint, MIN_READ_SIZE, self._remaining_frame_size())
+        if len(self.buffer) - self.end < needed:
+            self._make_room(needed)
+
+        return self.view[self.end:]
+
+    """
+    Records that nbytes were written into the view from get_buffer().
+    """
+    def buffer_updated(self, nbytes):
+        self.end += nbytes
+
+    """
+    Yields every complete frame in the buffer.
+
+    The framing may be changed between frames, and takes effect for the next
+    frame yielded.
+    """
+    def frames(self):
+        while True:
+            if self.framing == LENGTH:
+                frame = self._next_length_frame()
+            else:
+                frame = self._next_delimited_frame()
+
+            if frame is None:
+                if self.start == self.end:
+                    self._release()
+                return
+            yield frame
+
+    def _next_delimited_frame(self):
+        pos = self.buffer.find(DELIMITER, max(self.scan, self.start), self.end)
+        if pos < 0:
+            if self.end - self.start > self.max_frame_size:
+                raise FrameException("Frame is larger than " + str(self.max_frame_size) + " bytes")
+
+            # The delimiter might be split across reads.
+            self.scan = max(self.start, self.end - len(DELIMITER) + 1)
+            return None
+
+        frame = self.view[self.start:pos]
+        self.start = pos + len(DELIMITER)
+        self.scan = self.start
+        return frame
+
+    def _next_length_frame(self):
+        if self.end - self.start < LENGTH_SIZE:
+            return None
+
+        length = int.from_bytes(self.buffer[self.start:self.start + LENGTH_SIZE], "big")
+        if length > self.max_frame_size:
+            raise FrameException("Frame is larger than " + str(self.max_frame_size) + " bytes")
+
+        frame_start = self.start + LENGTH_SIZE
+        if self.end - frame_start < length:
+            return None
+
+        self.start = frame_start + length
+        self.scan = self.start
+        return self.view[frame_start:self.start]
+
+    """
+    Gets the number of bytes still missing from a partial length-prefixed
+    frame, so that the rest can be read in one go.
+    """
+    def _remaining_frame_size(self):
+        if self.framing != LENGTH or self.end - self.start < LENGTH_SIZE:
+            return 0
+
+        length = int.from_bytes(self.buffer[self.start:self.start + LENGTH_SIZE], "big")
+        return min(length, self.max_frame_size) + LENGTH_SIZE - (self.end - self.start)
+
+    def _make_room(self, needed):
+        pending = self.end - self.start
+
+        if pending + needed > len(self.buffer):
+            # Grow into a new buffer, copying only the unparsed data.
+            buffer = bytearray(max(len(self.buffer) * 2, pending + needed, self.bufsize))
+            buffer[:pending] = self.view[self.start:self.end]
+            self.buffer = buffer
+            self.view = memoryview(buffer)
+        elif pending > 0:
+            self.buffer[:pending] = self.buffer[self.start:self.end]
+
+        self.scan -= self.start
+        self.start = 0
+        self.end = pending
+
+    """
+    Drops the buffer once it holds no unparsed data. Frames already returned
+    keep the old buffer alive for as long as they are used.
+    """
+    def _release(self):
+        self.buffer = bytearray()
+        self.view = memoryview(self.buffer)
+        # Unparsed data lies between start and end.
+        self.start = 0
+        self.end = 0
+        # Offset where the next search for a delimiter starts.
+        self.scan = 0
@@ -0,0 +1,404 @@
+from server import metrics
+import array
+import bisect
+import logging
+import mmap
+import os
+import pickle
+import struct
+import threading
+import time
+import zlib
+
+
+"""
+How often appended records are forced to disk.
+
+"always" fsyncs after every append, "batch" fsyncs from a background thread
+every fsync_interval seconds, and "os" leaves it to the operating system.
+Records are handed to the OS after every append under all policies, so only a
+machine crash can lose acknowledged records.
+"""
+FSYNC_POLICIES = ("always", "batch", "os")
+
+# Each record is a payload length and a CRC32 of the payload, then the payload.
+HEADER = struct.Struct("<II")
+
+# Every this many records, the offset of a record is kept in the sparse index of
+# its segment, so reading any record scans the headers of at most this many.
+INDEX_INTERVAL = 64
+
+
+"""
+Append-only log of records stored as a series of segment files in a directory.
+
+Appending costs the size of the record no matter how long the log is. Segment
+files are named after the index of their first record, and a new segment is
+started once the current one grows past segment_size bytes. When the log is
+opened, a record that was only partly written before a crash is cut off the
+end of the last segment.
+
+Records can also be read back by index. Each segment has a sparse index of the
+offset of every INDEX_INTERVAL-th record, which is written next to a segment
+once it is full and never changes after that, so opening a log with recover()
+only has to read its last segment. Segments are read through memory maps, which
+leaves it to the operating system to page in the parts being read.
+
+A log opened with read_only never changes its files: an incomplete record at
+the end is skipped instead of cut off, missing sparse indexes are only kept in
+memory, and appending is an error.
+"""
+class Log:
+    def __init__(self, directory, fsync="batch", fsync_interval=0.05, segment_size=64 * 1024 * 1024, read_only=False):
+        if not fsync in FSYNC_POLICIES:
+            raise ValueError("Unknown fsync policy " + fsync)
+
+        self.directory = directory
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.segment_size = segment_size
+        self.read_only = read_only
+        self.lock = threading.Lock()
+        self.count = 0
+        self.file = None
+        self.dirty = False
+        self.closed = False
+        # Sparse index of each segment, keyed by the index of its first record.
+        self.indexes = {}
+        # Memory maps of segments being read, keyed the same way.
+        self.maps = {}
+
+        if read_only:
+            names = os.listdir(directory) if os.path.isdir(directory) else []
+        else:
+            os.makedirs(directory, exist_ok=True)
+            names = os.listdir(directory)
+        self.segments = sorted(int(name[:-4]) for name in names if name.endswith(".log"))
+
+        if self.fsync == "batch" and not read_only:
+            self.flusher = threading.Thread(target=self._flush_periodically, daemon=True)
+            self.flusher.start()
+
+    """
+    Reads every record in the log, in order.
+
+    Must be called once after opening and before appending, since it also
+    recovers the tail of the last segment and finds where to append next.
+    """
+    def replay(self):
+        for start in self.segments:
+            path = self._segment_path(start)
+            with open(path, "rb") as f:
+                data = f.read()
+
+            offsets = self.indexes[start] = array.array("q")
+            offset = 0
+            while offset < len(data):
+                record = self._read_record(data, offset)
+                if record is None:
+                    break
+                if (self.count - start) % INDEX_INTERVAL == 0:
+                    offsets.append(offset)
+                payload, offset = record
+                self.count += 1
+                yield pickle.loads(payload)
+
+            if offset < len(data):
+                if start != self.segments[-1]:
+                    raise Exception("Log segment " + path + " is corrupt")
+                self._truncate(path, offset, len(data))
+
+    """
+    Opens the log for appending and reading by index without reading every
+    record. Use instead of replay().
+
+    Only the last segment is read, to recover its tail. Full segments are
+    found through their sparse index files, which are written for segments
+    left by older versions the first time they are opened.
+    """
+    def recover(self):
+        for start in self.segments[:-1]:
+            self.indexes[start] = self._load_index(start)
+
+        if self.segments:
+            start = self.segments[-1]
+            (offsets, count) = self._index_segment(start, True)
+            self.indexes[start] = offsets
+            self.count = start + count
+
+    """
+    Reads the record at an index.
+    """
+    def read(self, index):
+        if not 0 <= index < self.count:
+            raise IndexError("No record " + str(index) + " in log " + self.directory)
+
+        (start, offset, _) = self._locate(index)
+        (data, length) = self._map_record(start, offset)
+        offset += HEADER.size
+        return pickle.loads(data[offset:offset + length])
+
+    """
+    Iterates over the records from an index up to the end of the log as it
+    was when iteration started.
+    """
+    def scan(self, start=0):
+        index = start
+        end = self.count
+        while index < end:
+            (segment, offset, segment_end) = self._locate(index)
+            data = self._map(segment, 0)
+            while index < min(end, segment_end):
+                if offset + HEADER.size > len(data):
+                    data = self._map(segment, offset + HEADER.size)
+                (length, _) = HEADER.unpack_from(data, offset)
+                offset += HEADER.size
+                if offset + length > len(data):
+                    data = self._map(segment, offset + length)
+                yield pickle.loads(data[offset:offset + length])
+                offset += length
+                index += 1
+
+    """
+    Appends a record to the log and returns its index.
+    """
+    def append(self, record):
+        payload = pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+        header = HEADER.pack(len(payload), zlib.crc32(payload))
+
+        with self.lock:
+            if self.read_only:
+                raise Exception("Log " + self.directory + " is read-only")
+            if self.file is None or self.file.tell() >= self.segment_size:
+                self._rotate()
+
+            start = self.segments[-1]
+            if (self.count - start) % INDEX_INTERVAL == 0:
+                self.indexes[start].append(self.file.tell())
+
+            self.file.write(header)
+            self.file.write(payload)
+            self.file.flush()
+
+            if self.fsync == "always":
+                self._fsync()
+            else:
+                self.dirty = True
+
+            index = self.count
+            self.count += 1
+
+        return index
+
+    """
+    Forces every appended record to disk.
+    """
+    def sync(self):
+        with self.lock:
+            if self.file is not None and self.dirty:
+                self._fsync()
+                self.dirty = False
+
+    """
+    Deletes every record, so that the log starts again from empty. Used once
+    the records have been saved somewhere else.
+    """
+    def reset(self):
+        with self.lock:
+            if self.read_only:
+                raise Exception("Log " + self.directory + " is read-only")
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+            self._close_maps()
+            for start in self.segments:
+                os.remove(self._segment_path(start))
+                if os.path.exists(self._index_path(start)):
+                    os.remove(self._index_path(start))
+
+            self.segments = []
+            self.indexes = {}
+            self.count = 0
+            self.dirty = False
+
+    """
+    Syncs and closes the log.
+    """
+    def close(self):
+        self.sync()
+        with self.lock:
+            self.closed = True
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+            self._close_maps()
+
+    # Must be called with the lock held.
+    def _fsync(self):
+        start = time.perf_counter()
+        os.fsync(self.file.fileno())
+        metrics.registry.record_flush("log", time.perf_counter() - start)
+
+    def _segment_path(self, start):
+        return os.path.join(self.directory, "%020d.log" % start)
+
+    def _index_path(self, start):
+        return os.path.join(self.directory, "%020d.idx" % start)
+
+    # Must be called with the lock held.
+    def _rotate(self):
+        if self.file is not None:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+            self.dirty = False
+            self._write_index(self.segments[-1])
+            self.segments.append(self.count)
+        elif not self.segments:
+            self.segments.append(self.count)
+
+        # After opening, keep appending to the last existing segment.
+        self.indexes.setdefault(self.segments[-1], array.array("q"))
+        self.file = open(self._segment_path(self.segments[-1]), "ab")
+
+    """
+    Finds the record at an index, returning the index of the first record of
+    its segment, the offset of the record in the segment, and the index after
+    the segment's last record.
+    """
+    def _locate(self, index):
+        position = bisect.bisect_right(self.segments, index) - 1
+        start = self.segments[position]
+        segment_end = self.segments[position + 1] if position + 1 < len(self.segments) else self.count
+
+        offset = self.indexes[start][(index - start) // INDEX_INTERVAL]
+        for _ in range((index - start) % INDEX_INTERVAL):
+            (_, length) = self._map_record(start, offset)
+            offset += HEADER.size + length
+
+        return (start, offset, segment_end)
+
+    """
+    Maps the segment holding a record far enough to read all of it, and
+    returns the map and the length of the record's payload.
+    """
+    def _map_record(self, start, offset):
+        data = self._map(start, offset + HEADER.size)
+        (length, _) = HEADER.unpack_from(data, offset)
+        return (self._map(start, offset + HEADER.size + length), length)
+
+    """
+    Gets a memory map of a segment that is at least end bytes long. The last
+    segment grows as records are appended, so it is mapped again whenever a
+    record past the end of the current map is read.
+    """
+    def _map(self, start, end):
+        data = self.maps.get(start)
+        if data is None or len(data) < end:
+            with open(self._segment_path(start), "rb") as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            if len(data) < end:
+                raise Exception("Log segment " + self._segment_path(start) + " is shorter than its index")
+            # Readers still holding an older map keep it open until they are done.
+            self.maps[start] = data
+        return data
+
+    def _close_maps(self):
+        for data in self.maps.values():
+            data.close()
+        self.maps = {}
+
+    """
+    Reads the sparse index of a full segment from its file, or builds and
+    writes it if there is none.
+    """
+    def _load_index(self, start):
+        try:
+            with open(self._index_path(start), "rb") as f:
+                offsets = array.array("q")
+                offsets.frombytes(f.read())
+                return offsets
+        except FileNotFoundError:
+            pass
+
+        (offsets, _) = self._index_segment(start, False)
+        self.indexes[start] = offsets
+        if not self.read_only:
+            self._write_index(start)
+        return offsets
+
+    """
+    Reads the headers of every record in a segment, checking them, and
+    returns its sparse index and number of records. A record
+    that was only partly written is cut off the end if truncate is true, and
+    is an error otherwise.
+    """
+    def _index_segment(self, start, truncate):
+        path = self._segment_path(start)
+        offsets = array.array("q")
+        count = 0
+        offset = 0
+
+        with open(path, "rb") as f:
+            data = f.read()
+        while offset < len(data):
+            record = self._read_record(data, offset)
+            if record is None:
+                break
+            if count % INDEX_INTERVAL == 0:
+                offsets.append(offset)
+            (_, offset) = record
+            count += 1
+
+        if offset < len(data):
+            if not truncate:
+                raise Exception("Log segment " + path + " is corrupt")
+            self._truncate(path, offset, len(data))
+
+        return (offsets, count)
+
+    """
+    Cuts an incomplete record off the end of a segment, or only leaves it
+    unread if the log is read-only.
+    """
+    def _truncate(self, path, offset, size):
+        if self.read_only:
+            logging.warning("Skipping %d bytes of incomplete records in %s", size - offset, path)
+            return
+
+        logging.warning("Truncating %d bytes of incomplete records from %s", size - offset, path)
+        with open(path, "r+b") as f:
+            f.truncate(offset)
+
+    def _write_index(self, start):
+        path = self._index_path(start)
+        temp_path = path + ".tmp"
+        with open(temp_path, "wb") as f:
+            f.write(self.indexes[start].tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+
+    def _read_record(self, data, offset):
+        if offset + HEADER.size > len(data):
+            return None
+
+        length, checksum = HEADER.unpack_from(data, offset)
+        start = offset + HEADER.size
+        end = start + length
+        if end > len(data):
+            return None
+
+        payload = data[start:end]
+        if zlib.crc32(payload) != checksum:
+            return None
+
+        return payload, end
+
+    def _flush_periodically(self):
+        while not self.closed:
+            time.sleep(self.fsync_interval)
+            try:
+                self.sync()
+            except (OSError, ValueError):
+                logging.exception("Failed to sync log %s", self.directory)
@@ -1,19 +1,36 @@
-from server import rpc
-from server.modules import (accounts, friends, groups, messages, session)
+from server import (aiorpc, broker, encoding, framing, log, metrics, passwords, profiling, rpc, storage, workers)
+from server.modules import (accounts, delivery, friends, groups, messages, presence, session)
+import argparse
+import asyncio
 import logging
+import os
+import resource
+import signal
 import socket
 import threading
 
 
+# Seconds to wait for running requests to finish when shutting down.
+SHUTDOWN_TIMEOUT = 10
+
+
 """
 An RPC server that waits for connections from peers and handles them on
 separate threads.
 """
 class Server:
-    def listen(self, port):
+    def __init__(self):
+        # Threads handling connections that are still open.
+        self.threads = set()
+        self.lock = threading.Lock()
+
+    def listen(self, port, reuse_port=False):
         # Set up a connection server.
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            # Let the kernel spread connections over every process on the port.
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.socket.bind(("0.0.0.0", port))
         self.socket.listen(1)
 
@@ -23,6 +40,9 @@ class Server:
             try:
                 connection, address = self.socket.accept()
                 connection.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+                # Responses and notifications are small writes of their own,
+                # which Nagle's algorithm would hold back.
+                connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
             except KeyboardInterrupt:
                 logging.info("Shutting down")
                 break
@@ -30,43 +50,157 @@ class Server:
             # Spawn a separate thread to handle the connection.
             logging.info("Received connection from %s", address)
             listener = rpc.Listener(connection)
-            thread = ServerThread(listener)
+            thread = ServerThread(listener, self)
+            with self.lock:
+                self.threads.add(thread)
             thread.start()
 
+        self.close()
+
+    """
+    Stops accepting connections, closes every open one, and waits for their
+    threads to finish, so that no more requests come in once the backend is
+    closed.
+    """
+    def close(self):
+        self.socket.close()
+
+        with self.lock:
+            threads = list(self.threads)
+        for thread in threads:
+            thread.listener.close()
+        for thread in threads:
+            thread.join()
+
+    """
+    Forgets a connection thread that has finished.
+    """
+    def finished(self, thread):
+        with self.lock:
+            self.threads.discard(thread)
+
 
 """
 Thread that handles a connection to a client.
 """
 class ServerThread(threading.Thread):
-    def __init__(self, listener):
+    def __init__(self, listener, server):
         threading.Thread.__init__(self)
         self.listener = listener
+        self.server = server
 
     def run(self):
         proxy = rpc.Proxy(self.listener, Handler)
         self.listener.join()
         self.listener.close()
-        logging.info("Client %s disconnected", proxy.get_peer_name())
+        disconnected(proxy)
+        self.server.finished(self)
+
+
+"""
+An RPC server that serves every connection from a single asyncio event loop.
+
+Idle connections cost no threads, so this scales to many more clients than the
+threaded server. Requests are still handled by the blocking Handler methods,
+which run on the shared worker pool.
+"""
+class AsyncServer:
+    def listen(self, port, reuse_port=False, backlog=1024):
+        raise_file_limit()
+
+        try:
+            asyncio.run(self._serve(port, reuse_port, backlog))
+        except KeyboardInterrupt:
+            logging.info("Shutting down")
+
+    async def _serve(self, port, reuse_port, backlog):
+        loop = asyncio.get_running_loop()
+        server = await loop.create_server(
+            lambda: aiorpc.AsyncListener(loop, Handler, disconnected),
+            "0.0.0.0",
+            port,
+            reuse_address=True,
+            reuse_port=reuse_port,
+            backlog=backlog
+        )
+
+        async with server:
+            await server.serve_forever()
+
+
+"""
+Cleans up after a client connection has closed, logging out its user.
+"""
+def disconnected(proxy):
+    logging.info("Client %s disconnected", proxy.get_peer_name())
+    proxy.listener.handler._sign_out()
+
+
+"""
+Raises the soft limit on open files to the hard limit, since every connection
+needs a file descriptor.
+"""
+def raise_file_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError):
+            logging.warning("Could not raise open file limit above %d", soft)
 
 
 """
 Primary handler for client connections.
 """
 class Handler(rpc.Handler):
+    def __init__(self, proxy):
+        rpc.Handler.__init__(self, proxy)
+        # User logged in on this connection, and the callback sending them messages.
+        self.username = None
+        self.callback = None
+
     def login(self, username, password):
         token = session.manager.login(username, password, self.proxy.get_peer_name())
 
+        # Logging in again on the same connection replaces the earlier login.
+        self._sign_out()
+
         # Set up callback handler.
-        messages.manager.set_callback(username, lambda message: self.proxy.receive_message(**message))
+        self.username = username
+        self.callback = self._push
+        messages.manager.set_callback(username, self.callback)
+        presence.manager.connected(username)
 
         return token
 
     def logout(self, token):
         session.manager.validate_token(token)
-        username = session.manager.get_token_user(token)
-        messages.manager.remove_callback(username)
+        self._sign_out()
         return session.manager.logout(token)
 
+    """
+    Passes something the delivery manager has queued for this user to their
+    client. It is sent as a notification, so a client that stops answering
+    cannot hold up a delivery thread waiting for its reply; its messages just
+    queue up on its connection. Presence updates are droppable, so they are the
+    first thing discarded for a slow client.
+    """
+    def _push(self, method, params):
+        self.proxy.notify(method, params, droppable=method == "receive_presence")
+
+    """
+    Stops sending messages to the user logged in on this connection, and marks
+    them offline unless they are logged in elsewhere.
+    """
+    def _sign_out(self):
+        if self.username is None:
+            return
+
+        messages.manager.remove_callback(self.username, self.callback)
+        presence.manager.disconnected(self.username)
+        self.username = None
+        self.callback = None
+
     def get_users(self):
         return accounts.manager.get_users()
 
@@ -74,7 +208,8 @@ class Handler(rpc.Handler):
         user = accounts.manager.get_user(username)
         return {
             "username": user.username,
-            "email": user.email
+            "email": user.email,
+            "online": presence.manager.is_online(user.username)
         }
 
     def create_user(self, username, password, first_name, last_name, email, address):
@@ -100,12 +235,40 @@ class Handler(rpc.Handler):
         session.manager.validate_token(token)
         return messages.manager.get_all_in_group(group)
 
+    def get_message_page_with_user(self, token, username, before_id=None, since_id=None, limit=50):
+        session.manager.validate_token(token)
+        me = session.manager.get_token_user(token)
+        return messages.manager.get_page_with_users(me, username, before_id, since_id, limit)
+
+    def get_message_page_in_group(self, token, group, before_id=None, since_id=None, limit=50):
+        session.manager.validate_token(token)
+        me = session.manager.get_token_user(token)
+        if not groups.manager.is_member(group, me):
+            raise Exception("You are not in the group")
+        return messages.manager.get_page_in_group(group, before_id, since_id, limit)
+
     def send_message(self, token, receiver, text):
         session.manager.validate_token(token)
         me = session.manager.get_token_user(token)
         messages.manager.send(me, receiver["type"], text, username=receiver.get("username", None), group=receiver.get("id", None))
         return True
 
+    def search_messages(self, token, query, conversation=None, limit=50, cursor=None):
+        session.manager.validate_token(token)
+        me = session.manager.get_token_user(token)
+        return messages.manager.search(me, query, conversation, limit, cursor)
+
+    def get_inbox(self, token):
+        session.manager.validate_token(token)
+        me = session.manager.get_token_user(token)
+        return messages.manager.get_inbox(me)
+
+    def mark_read(self, token, conversation, up_to_id):
+        session.manager.validate_token(token)
+        me = session.manager.get_token_user(token)
+        messages.manager.mark_read(me, conversation, up_to_id)
+        return True
+
     def get_groups(self, token):
         session.manager.validate_token(token)
         username = session.manager.get_token_user(token)
@@ -131,10 +294,21 @@ class Handler(rpc.Handler):
 
     def remove_group_user(self, token, group, username):
         session.manager.validate_token(token)
+        me = session.manager.get_token_user(token)
+        if not groups.manager.is_member(group, me):
+            raise Exception("You are not in the group")
+        # Members may leave, but only administrators can remove others.
+        if username != me and not session.manager.is_admin(me):
+            raise Exception("Only administrators can remove other users")
+        groups.manager.remove_user_from_group(username, group)
         return True
 
     def delete_group(self, token, group):
         session.manager.validate_token(token)
+        me = session.manager.get_token_user(token)
+        if not groups.manager.is_member(group, me):
+            raise Exception("You are not in the group")
+        groups.manager.delete_group(group)
         return True
 
     def get_friends(self, token):
@@ -142,6 +316,33 @@ class Handler(rpc.Handler):
         username = session.manager.get_token_user(token)
         return friends.manager.get_friends(username)
 
+    def get_followers(self, token):
+        session.manager.validate_token(token)
+        username = session.manager.get_token_user(token)
+        return friends.manager.get_followers(username)
+
+    def get_mutual_friends(self, token, username):
+        session.manager.validate_token(token)
+        owner_username = session.manager.get_token_user(token)
+        return friends.manager.get_mutual_friends(owner_username, username)
+
+    def get_friends_of_friends(self, token, limit=50):
+        session.manager.validate_token(token)
+        username = session.manager.get_token_user(token)
+        return friends.manager.get_friends_of_friends(username, limit)
+
+    def add_friends(self, token, usernames):
+        session.manager.validate_token(token)
+        owner_username = session.manager.get_token_user(token)
+        friends.manager.add_friends(owner_username, usernames)
+        return True
+
+    def remove_friends(self, token, usernames):
+        session.manager.validate_token(token)
+        owner_username = session.manager.get_token_user(token)
+        friends.manager.remove_friends(owner_username, usernames)
+        return True
+
     def add_friend(self, token, username):
         session.manager.validate_token(token)
         owner_username = session.manager.get_token_user(token)
@@ -154,8 +355,124 @@ class Handler(rpc.Handler):
         friends.manager.remove_friend(owner_username, username)
         return True
 
+    def get_stats(self, token):
+        session.manager.validate_admin(token)
+        stats = metrics.registry.get_stats()
+        stats["sessions"] = session.manager.get_stats()
+        stats["delivery"] = {
+            "summary": delivery.manager.get_summary(),
+            "recipients": delivery.manager.get_stats()
+        }
+        return stats
+
+    def start_profiling(self, token, seconds=30, mode="cprofile", methods=None):
+        session.manager.validate_admin(token)
+        try:
+            return profiling.profiler.start(seconds, mode, methods)
+        except ValueError as e:
+            raise rpc.RpcException(rpc.INVALID_PARAMS, str(e))
+
+    def stop_profiling(self, token):
+        session.manager.validate_admin(token)
+        return profiling.profiler.stop()
+
+
+"""
+Registers gauges for the sizes of the server's queues and tables.
+"""
+def add_gauges():
+    metrics.registry.add_gauge("threads", "Threads running in the server process.", threading.active_count)
+    metrics.registry.add_gauge("worker_threads", "Threads in the request worker pool.", lambda: rpc.pool.size())
+    metrics.registry.add_gauge("worker_queue_depth", "Requests waiting for a worker.", lambda: rpc.pool.depth())
+    metrics.registry.add_gauge("delivery_backlog", "Messages waiting to be delivered to connected users.", lambda: delivery.manager.get_backlog())
+    metrics.registry.add_gauge("delivery_oldest_age_seconds", "Time the oldest message waiting to be delivered has waited.", lambda: delivery.manager.get_summary()["oldest_age"])
+    metrics.registry.add_gauge("delivery_max_lag_seconds", "Longest time from queueing to delivery of a message to a connected user.", lambda: delivery.manager.get_summary()["max_lag"])
+    metrics.registry.add_gauge("delivery_dropped", "Messages dropped from full queues of connected users.", lambda: delivery.manager.get_summary()["dropped"])
+    metrics.registry.add_gauge("delivery_failed", "Messages that could not be passed to connected users.", lambda: delivery.manager.get_summary()["failed"])
+    metrics.registry.add_gauge("sessions", "Live login sessions.", lambda: len(session.manager.tokens))
+    metrics.registry.add_gauge("online_users", "Users with at least one logged in connection.", lambda: len(presence.manager.connections))
+
+
+def terminate(signum, frame):
+    raise KeyboardInterrupt()
+
+
+"""
+Samples the whole process for 30 seconds when sent SIGUSR1.
+"""
+def start_profiling(signum, frame):
+    try:
+        profiling.profiler.start(30, "sample")
+    except Exception as e:
+        logging.warning("Could not start profiling: %s", e)
+
 
 def main():
+    parser = argparse.ArgumentParser(description="Chat server")
+    parser.add_argument("--port", type=int, default=6543, help="port to listen on")
+    parser.add_argument("--mode", choices=["asyncio", "threaded"], default="asyncio",
+        help="serve all connections from one event loop, or use a thread per connection")
+    parser.add_argument("--threads", type=int, default=32,
+        help="number of worker threads that handle requests")
+    parser.add_argument("--queue-size", type=int, default=1024,
+        help="maximum number of requests waiting for a worker")
+    parser.add_argument("--overload", choices=workers.OVERLOAD_POLICIES, default="wait",
+        help="what to do with requests when the queue is full")
+    parser.add_argument("--max-frame-size", type=int, default=framing.MAX_FRAME_SIZE,
+        help="largest message in bytes accepted from a client")
+    parser.add_argument("--compression-threshold", type=int, default=encoding.COMPRESSION_THRESHOLD,
+        help="size in bytes above which messages are compressed, for clients that support it")
+    parser.add_argument("--max-outbound-bytes", type=int, default=rpc.max_outbound_bytes,
+        help="bytes that can be queued for a client that is not reading before --slow-consumer applies")
+    parser.add_argument("--max-outbound-messages", type=int, default=rpc.max_outbound_messages,
+        help="messages that can be queued for a client that is not reading before --slow-consumer applies")
+    parser.add_argument("--slow-consumer", choices=rpc.SLOW_CONSUMER_POLICIES, default=rpc.slow_consumer,
+        help="drop presence updates for a client that is not reading before disconnecting it, or disconnect it straight away")
+    parser.add_argument("--delivery-threads", type=int, default=16,
+        help="number of threads that deliver messages to connected users")
+    parser.add_argument("--delivery-queue-size", type=int, default=256,
+        help="maximum number of undelivered messages queued for one user")
+    parser.add_argument("--data-dir", default=".",
+        help="directory to store data in")
+    parser.add_argument("--storage", choices=storage.BACKENDS, default="files",
+        help="how to store data")
+    parser.add_argument("--fsync", choices=log.FSYNC_POLICIES, default="batch",
+        help="when to force written data to disk")
+    parser.add_argument("--fsync-interval", type=int, default=50,
+        help="milliseconds between syncs with --fsync batch")
+    parser.add_argument("--flush-interval", type=int, default=1000,
+        help="milliseconds between saves of changed accounts, groups and inboxes")
+    parser.add_argument("--flush-threshold", type=int, default=100,
+        help="number of unsaved changes to a file that triggers an early save")
+    parser.add_argument("--hot-messages", type=int, default=100000,
+        help="number of the newest messages kept in memory with --storage files")
+    parser.add_argument("--hot-age", type=int,
+        help="seconds after which messages are only kept on disk with --storage files")
+    parser.add_argument("--hash-processes", type=int, default=2,
+        help="number of processes that hash passwords")
+    parser.add_argument("--hash-queue-size", type=int, default=16,
+        help="maximum number of passwords being hashed at once before logins are refused")
+    parser.add_argument("--session-lifetime", type=int, default=session.Token.lifetime,
+        help="seconds of inactivity after which a login session expires")
+    parser.add_argument("--max-sessions-per-user", type=int, default=16,
+        help="number of login sessions a user can have before the oldest is ended")
+    parser.add_argument("--admin", action="append", default=[],
+        help="username allowed to call administrative methods like get_stats (may be repeated)")
+    parser.add_argument("--metrics-port", type=int,
+        help="local port to serve Prometheus metrics on; with --processes, each process uses the next port up")
+    parser.add_argument("--profile-dir",
+        help="directory to write profiles to (default: profiles in the data directory)")
+    parser.add_argument("--slow-request-ms", type=int,
+        help="log calls that take longer than this many milliseconds, with a stack snapshot")
+    parser.add_argument("--presence-interval", type=int, default=500,
+        help="milliseconds over which presence changes are collected before telling friends")
+    parser.add_argument("--processes", type=int, default=1,
+        help="number of server processes sharing the port (needs --storage sqlite)")
+    args = parser.parse_args()
+
+    if args.processes > 1 and args.storage != "sqlite":
+        parser.error("--processes needs --storage sqlite, since other backends cannot be shared")
+
     # Set the logging level.
     logging.getLogger().setLevel(logging.DEBUG)
 
@@ -165,5 +482,119 @@ def main():
     handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s: %(message)s'))
     logging.getLogger().addHandler(handler)
 
-    server = Server()
-    server.listen(6543)
+    if args.processes > 1:
+        supervise(args)
+    else:
+        serve(args)
+
+
+"""
+Runs a server process. With reuse_port, other processes may listen on the same
+port, and deliveries for users they hold are routed through the broker socket
+at broker_path. worker numbers the process among its siblings.
+"""
+def serve(args, reuse_port=False, broker_path=None, worker=0):
+    backend = storage.open_backend(
+        args.storage,
+        args.data_dir,
+        args.fsync,
+        args.fsync_interval / 1000,
+        args.flush_interval / 1000,
+        args.flush_threshold,
+        args.hot_messages,
+        args.hot_age
+    )
+    for module in (accounts, friends, groups, messages):
+        module.manager.open(backend)
+
+    rpc.pool = workers.WorkerPool(args.threads, args.queue_size, args.overload)
+    rpc.max_frame_size = args.max_frame_size
+    rpc.compression_threshold = args.compression_threshold
+    rpc.max_outbound_bytes = args.max_outbound_bytes
+    rpc.max_outbound_messages = args.max_outbound_messages
+    rpc.slow_consumer = args.slow_consumer
+    delivery.manager = delivery.DeliveryManager(args.delivery_threads, args.delivery_queue_size)
+    passwords.hasher = passwords.PasswordHasher(args.hash_processes, args.hash_queue_size)
+    session.manager = session.SessionManager(args.session_lifetime, args.max_sessions_per_user, admins=args.admin)
+    presence.manager = presence.PresenceManager(args.presence_interval / 1000)
+    friends.manager.add_listener(presence.manager.friends_changed)
+    if broker_path is not None:
+        delivery.manager.router = broker.BrokerClient(broker_path)
+        groups.manager.router = delivery.manager.router
+        presence.manager.router = delivery.manager.router
+
+    profiling.profiler = profiling.Profiler(args.profile_dir or os.path.join(args.data_dir, "profiles"))
+    if args.slow_request_ms is not None:
+        profiling.profiler.set_slow_threshold(args.slow_request_ms / 1000)
+
+    add_gauges()
+    if args.metrics_port is not None:
+        metrics.serve(args.metrics_port + worker)
+
+    if args.mode == "threaded":
+        server = Server()
+    else:
+        server = AsyncServer()
+
+    # Shut down the same way on SIGTERM as on Ctrl+C, so data is saved.
+    signal.signal(signal.SIGTERM, terminate)
+    signal.signal(signal.SIGUSR1, start_profiling)
+
+    try:
+        server.listen(args.port, reuse_port)
+    finally:
+        # Let requests that are still running finish storing what they were
+        # given before the backend goes away.
+        if not rpc.pool.wait(SHUTDOWN_TIMEOUT):
+            logging.warning("Closing storage with requests still running")
+        backend.close()
+        passwords.hasher.close()
+
+
+"""
+Starts several server processes that share the port, and runs the broker that
+routes deliveries between them until the server is stopped.
+
+The broker socket is created before forking so that it is ready when the
+workers connect to it. Stopping the supervisor stops every worker.
+"""
+def supervise(args):
+    os.makedirs(args.data_dir, exist_ok=True)
+    broker_path = os.path.join(args.data_dir, "broker.sock")
+    broker_socket = broker.listen(broker_path)
+
+    children = []
+    for worker in range(args.processes):
+        pid = os.fork()
+        if pid == 0:
+            broker_socket.close()
+            try:
+                serve(args, True, broker_path, worker)
+            finally:
+                os._exit(0)
+        children.append(pid)
+
+    logging.info("Started %d server processes", len(children))
+    broker.Broker(broker_socket).start()
+    signal.signal(signal.SIGTERM, terminate)
+    # Pass requests for profiling on to every worker.
+    signal.signal(signal.SIGUSR1, lambda signum, frame: [os.kill(pid, signum) for pid in children])
+
+    try:
+        for pid in children:
+            os.waitpid(pid, 0)
+    except KeyboardInterrupt:
+        logging.info("Stopping server processes")
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in children:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+    finally:
+        broker_socket.close()
+        os.unlink(broker_path)
@@ -0,0 +1,131 @@
+from server.modules import messages
+import argparse
+import json
+import pickle
+import random
+import time
+import tracemalloc
+
+
+"""
+Measures how much memory and log space messages take.
+
+Builds the same set of messages twice: as the nested dictionaries the server
+used to keep, and as Message records. Usernames and group IDs are decoded from
+bytes for every message, like the parameters of an RPC call are, so the
+dictionaries hold a copy of each while the records share interned ones. The
+text of the messages is created beforehand and is not counted, since both hold
+the same strings.
+
+Results are printed as JSON, in bytes per message.
+"""
+
+
+"""
+Builds a message the way the server did before Message records, with the
+receiver in a dictionary of its own.
+"""
+def make_dict(id, sender, receiver_type, receiver, timestamp, text):
+    message = {
+        "id": id,
+        "sender": sender.decode(),
+        "receiver": {
+            "type": receiver_type
+        },
+        "timestamp": timestamp,
+        "text": text
+    }
+    if receiver_type == "user":
+        message["receiver"]["username"] = receiver.decode()
+    else:
+        message["receiver"]["id"] = receiver.decode()
+    return message
+
+
+def make_record(id, sender, receiver_type, receiver, timestamp, text):
+    return messages.Message(
+        id,
+        sender.decode(),
+        messages.USER if receiver_type == "user" else messages.GROUP,
+        receiver.decode(),
+        timestamp,
+        text
+    )
+
+
+"""
+Gets the bytes allocated per message while building every message with make.
+"""
+def measure(make, specs):
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    built = [make(*spec) for spec in specs]
+    used = tracemalloc.get_traced_memory()[0] - start
+    tracemalloc.stop()
+
+    # The list holding the messages is not part of them.
+    used -= len(built) * 8
+    return (built, used / len(built))
+
+
+"""
+Gets the average size of messages as pickled log records.
+"""
+def pickled_size(records):
+    return sum(len(pickle.dumps(record, pickle.HIGHEST_PROTOCOL)) for record in records) / len(records)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the memory used by stored messages")
+    parser.add_argument("--messages", type=int, default=200000, help="number of messages to build")
+    parser.add_argument("--users", type=int, default=1000, help="number of users sending them")
+    parser.add_argument("--groups", type=int, default=100, help="number of groups, which get a third of the messages")
+    parser.add_argument("--output", help="file to write the JSON results to instead of standard output")
+    args = parser.parse_args()
+
+    generator = random.Random(1)
+    usernames = [("user%d" % i).encode() for i in range(args.users)]
+    groups = [("group-%08x" % generator.getrandbits(32)).encode() for _ in range(args.groups)]
+    now = time.time()
+
+    specs = []
+    for id in range(args.messages):
+        text = "message %d %s" % (id, "x" * generator.randrange(10, 80))
+        if generator.random() < 1 / 3:
+            specs.append((id, generator.choice(usernames), "group", generator.choice(groups), now + id, text))
+        else:
+            specs.append((id, generator.choice(usernames), "user", generator.choice(usernames), now + id, text))
+
+    (dicts, dict_bytes) = measure(make_dict, specs)
+    (records, record_bytes) = measure(make_record, specs)
+
+    results = {
+        "config": {
+            "messages": args.messages,
+            "users": args.users,
+            "groups": args.groups
+        },
+        "text_bytes_per_message": sum(len(spec[5]) for spec in specs) / len(specs),
+        "memory_bytes_per_message": {
+            "dict": dict_bytes,
+            "record": record_bytes
+        },
+        "log_bytes_per_message": {
+            "dict": pickled_size(dicts),
+            "record": pickled_size([
+                (message.id, message.sender, message.receiver_type, message.receiver, message.timestamp, message.text)
+                for message in records
+            ])
+        }
+    }
+
+    output = json.dumps(results, indent=2)
+    if args.output is None:
+        print(output)
+    else:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,328 @@
+from http.server import (BaseHTTPRequestHandler, ThreadingHTTPServer)
+import bisect
+import logging
+import threading
+import time
+
+
+# Upper bounds in seconds of histogram buckets, from 100µs doubling to about 26s.
+BUCKETS = [0.0001 * 2 ** i for i in range(19)]
+
+
+"""
+Counts of observed durations in exponentially sized buckets.
+
+Recording is a bucket lookup and a few additions, so it is cheap enough to do
+for every request. Quantiles are estimated by interpolating within the bucket
+they fall in, which is accurate to within a factor of two of the real value
+and usually much closer.
+"""
+class Histogram:
+    def __init__(self):
+        # One count per bucket, plus one for anything beyond the last bound.
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    """
+    Estimates the value below which a fraction q of observations fall.
+    """
+    def quantile(self, q):
+        if self.count == 0:
+            return 0.0
+
+        rank = q * self.count
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = BUCKETS[bucket - 1] if bucket > 0 else 0.0
+                upper = BUCKETS[bucket] if bucket < len(BUCKETS) else BUCKETS[-1]
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+
+        return BUCKETS[-1]
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "mean": self.sum / self.count if self.count else 0.0,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99)
+        }
+
+
+"""
+Call counts, error counts and latencies of one RPC method.
+"""
+class MethodStats:
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.latency = Histogram()
+
+
+"""
+Collects the server's metrics.
+
+RPC calls and persistence flushes are recorded as they happen. Traffic is
+counted by each connection, and added to the totals here when it closes.
+Values owned by other parts of the server, like queue depths, are registered
+as gauges: functions that are called when the metrics are read.
+"""
+class Registry:
+    def __init__(self):
+        self.methods = {}
+        self.flushes = {}
+        self.channels = set()
+        self.opened_count = 0
+        # Traffic of connections that have closed.
+        self.closed_bytes_in = 0
+        self.closed_bytes_out = 0
+        # Frames dropped for, and connections closed because of, slow peers.
+        self.dropped_frames = 0
+        self.slow_disconnects = 0
+        self.gauges = {}
+        self.lock = threading.Lock()
+
+    """
+    Records a finished RPC call.
+    """
+    def record_call(self, method, seconds, error):
+        with self.lock:
+            stats = self.methods.get(method)
+            if stats is None:
+                stats = self.methods[method] = MethodStats()
+
+            stats.calls += 1
+            if error:
+                stats.errors += 1
+            stats.latency.observe(seconds)
+
+    """
+    Records how long it took to write some store's data to disk.
+    """
+    def record_flush(self, store, seconds):
+        with self.lock:
+            histogram = self.flushes.get(store)
+            if histogram is None:
+                histogram = self.flushes[store] = Histogram()
+            histogram.observe(seconds)
+
+    """
+    Starts tracking a connection, which counts its traffic in its bytes_in and
+    bytes_out attributes.
+    """
+    def opened(self, channel):
+        with self.lock:
+            self.channels.add(channel)
+            self.opened_count += 1
+
+    """
+    Stops tracking a connection. Safe to call more than once.
+    """
+    def closed(self, channel):
+        with self.lock:
+            if channel in self.channels:
+                self.channels.remove(channel)
+                self.closed_bytes_in += channel.bytes_in
+                self.closed_bytes_out += channel.bytes_out
+
+    """
+    Records that a frame was dropped ("dropped"), or the connection closed
+    ("disconnected"), because a peer was not reading fast enough.
+    """
+    def record_slow_consumer(self, channel, action):
+        with self.lock:
+            if action == "dropped":
+                self.dropped_frames += 1
+            else:
+                self.slow_disconnects += 1
+
+    """
+    Registers a function that returns the current value of a gauge.
+    """
+    def add_gauge(self, name, description, function):
+        self.gauges[name] = (description, function)
+
+    """
+    Gets every metric as a dictionary.
+    """
+    def get_stats(self):
+        with self.lock:
+            methods = {name: dict(stats.latency.summary(), calls=stats.calls, errors=stats.errors) for name, stats in self.methods.items()}
+            flushes = {store: histogram.summary() for store, histogram in self.flushes.items()}
+            channels = list(self.channels)
+            (bytes_in, bytes_out) = self._totals(channels)
+            opened_count = self.opened_count
+            (dropped_frames, slow_disconnects) = (self.dropped_frames, self.slow_disconnects)
+
+        now = time.time()
+        return {
+            "methods": methods,
+            "flushes": flushes,
+            "connections": {
+                "live": len(channels),
+                "opened": opened_count,
+                "bytes_in": bytes_in,
+                "bytes_out": bytes_out,
+                "queued_bytes": sum(channel.outbound_bytes for channel in channels),
+                "stalled": sum(1 for channel in channels if channel.stalled_since is not None),
+                "dropped_frames": dropped_frames,
+                "slow_disconnects": slow_disconnects,
+                "peers": [
+                    {
+                        "address": str(channel.address),
+                        "bytes_in": channel.bytes_in,
+                        "bytes_out": channel.bytes_out,
+                        "queued_bytes": channel.outbound_bytes,
+                        "queued_messages": len(channel.outbound),
+                        "stalled_for": now - channel.stalled_since if channel.stalled_since is not None else 0.0
+                    }
+                    for channel in channels
+                ]
+            },
+            "gauges": self._read_gauges()
+        }
+
+    """
+    Renders every metric in the Prometheus text exposition format.
+    """
+    def render(self):
+        lines = []
+
+        with self.lock:
+            methods = [(name, stats.calls, stats.errors, _copy(stats.latency)) for name, stats in sorted(self.methods.items())]
+            flushes = [(store, _copy(histogram)) for store, histogram in sorted(self.flushes.items())]
+            channels = list(self.channels)
+            (bytes_in, bytes_out) = self._totals(channels)
+            opened_count = self.opened_count
+            (dropped_frames, slow_disconnects) = (self.dropped_frames, self.slow_disconnects)
+
+        lines.append("# HELP chat_rpc_calls_total RPC calls handled.")
+        lines.append("# TYPE chat_rpc_calls_total counter")
+        for name, calls, _, _ in methods:
+            lines.append('chat_rpc_calls_total{method="%s"} %d' % (_label(name), calls))
+
+        lines.append("# HELP chat_rpc_errors_total RPC calls that failed.")
+        lines.append("# TYPE chat_rpc_errors_total counter")
+        for name, _, errors, _ in methods:
+            lines.append('chat_rpc_errors_total{method="%s"} %d' % (_label(name), errors))
+
+        lines.append("# HELP chat_rpc_duration_seconds Time taken to handle RPC calls.")
+        lines.append("# TYPE chat_rpc_duration_seconds histogram")
+        for name, _, _, histogram in methods:
+            _render_histogram(lines, "chat_rpc_duration_seconds", 'method="%s"' % _label(name), histogram)
+
+        lines.append("# HELP chat_flush_duration_seconds Time taken to write stored data to disk.")
+        lines.append("# TYPE chat_flush_duration_seconds histogram")
+        for store, histogram in flushes:
+            _render_histogram(lines, "chat_flush_duration_seconds", 'store="%s"' % _label(store), histogram)
+
+        lines.append("# HELP chat_connections Open client connections.")
+        lines.append("# TYPE chat_connections gauge")
+        lines.append("chat_connections %d" % len(channels))
+        lines.append("# HELP chat_connections_opened_total Client connections accepted.")
+        lines.append("# TYPE chat_connections_opened_total counter")
+        lines.append("chat_connections_opened_total %d" % opened_count)
+        lines.append("# HELP chat_received_bytes_total Bytes received from peers.")
+        lines.append("# TYPE chat_received_bytes_total counter")
+        lines.append("chat_received_bytes_total %d" % bytes_in)
+        lines.append("# HELP chat_sent_bytes_total Bytes sent to peers.")
+        lines.append("# TYPE chat_sent_bytes_total counter")
+        lines.append("chat_sent_bytes_total %d" % bytes_out)
+        lines.append("# HELP chat_queued_bytes Bytes waiting to be sent to peers.")
+        lines.append("# TYPE chat_queued_bytes gauge")
+        lines.append("chat_queued_bytes %d" % sum(channel.outbound_bytes for channel in channels))
+        lines.append("# HELP chat_stalled_connections Connections whose peer is not keeping up with writes.")
+        lines.append("# TYPE chat_stalled_connections gauge")
+        lines.append("chat_stalled_connections %d" % sum(1 for channel in channels if channel.stalled_since is not None))
+        lines.append("# HELP chat_dropped_frames_total Droppable messages discarded for slow peers.")
+        lines.append("# TYPE chat_dropped_frames_total counter")
+        lines.append("chat_dropped_frames_total %d" % dropped_frames)
+        lines.append("# HELP chat_slow_consumer_disconnects_total Connections closed for not reading their messages.")
+        lines.append("# TYPE chat_slow_consumer_disconnects_total counter")
+        lines.append("chat_slow_consumer_disconnects_total %d" % slow_disconnects)
+
+        for name, value in sorted(self._read_gauges().items()):
+            lines.append("# HELP chat_%s %s" % (name, self.gauges[name][0]))
+            lines.append("# TYPE chat_%s gauge" % name)
+            lines.append("chat_%s %s" % (name, value))
+
+        return "\n".join(lines) + "\n"
+
+    # Must be called with the lock held.
+    def _totals(self, channels):
+        bytes_in = self.closed_bytes_in + sum(channel.bytes_in for channel in channels)
+        bytes_out = self.closed_bytes_out + sum(channel.bytes_out for channel in channels)
+        return (bytes_in, bytes_out)
+
+    def _read_gauges(self):
+        values = {}
+        for name, (_, function) in list(self.gauges.items()):
+            try:
+                values[name] = function()
+            except Exception as e:
+                logging.warning("Could not read gauge %s: %s", name, e)
+        return values
+
+
+"""
+Serves the metrics in the Prometheus text format over HTTP at /metrics.
+"""
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+
+        body = registry.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+"""
+Starts serving the metrics endpoint in the background on a local port.
+"""
+def serve(port, address="127.0.0.1"):
+    server = ThreadingHTTPServer((address, port), MetricsRequestHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logging.info("Serving metrics on http://%s:%d/metrics", address, port)
+    return server
+
+
+def _copy(histogram):
+    copy = Histogram()
+    copy.counts = list(histogram.counts)
+    copy.count = histogram.count
+    copy.sum = histogram.sum
+    return copy
+
+
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _render_histogram(lines, name, labels, histogram):
+    cumulative = 0
+    for bound, count in zip(BUCKETS, histogram.counts):
+        cumulative += count
+        lines.append('%s_bucket{%s,le="%g"} %d' % (name, labels, bound, cumulative))
+    lines.append('%s_bucket{%s,le="+Inf"} %d' % (name, labels, histogram.count))
+    lines.append("%s_sum{%s} %.9f" % (name, labels, histogram.sum))
+    lines.append("%s_count{%s} %d" % (name, labels, histogram.count))
+
+
+registry = Registry()
@@ -1,5 +1,4 @@
-import hashlib
-import pickle
+from server import passwords
 
 
 """
@@ -7,37 +6,41 @@ Manages the list of accounts.
 """
 class AccountManager:
     def __init__(self):
-        try:
-            with open('accounts.pickle', 'rb') as f:
-                self.accounts = pickle.load(f)
-        except FileNotFoundError:
-            self.accounts = {}
+        self.backend = None
+
+    """
+    Sets the storage backend to keep accounts in.
+    """
+    def open(self, backend):
+        self.backend = backend
 
     """
     Checks if a user exists.
     """
     def user_exists(self, username):
-        return username in self.accounts
+        return self.backend.get_account(username) is not None
 
     """
     Validates a given username.
     """
     def validate_user(self, username):
-        if not username in self.accounts:
+        if not self.user_exists(username):
             raise Exception("User " + username + " does not exist")
 
     """
     Gets a list of all users.
     """
     def get_users(self):
-        return list(self.accounts.keys())
+        return self.backend.get_usernames()
 
     """
     Gets information about a user by their username.
     """
     def get_user(self, username):
-        self.validate_user(username)
-        return self.accounts[username]
+        account = self.backend.get_account(username)
+        if account is None:
+            raise Exception("User " + username + " does not exist")
+        return account
 
     """
     Creates a new user.
@@ -49,42 +52,36 @@ class AccountManager:
         if len(password) < 6:
             raise Exception("Password must be at least 6 characters")
 
-        encrypted_password = hashlib.sha256(password.encode()).hexdigest()
+        encrypted_password = passwords.hasher.hash(password)
 
         account = Account(username, encrypted_password, first_name, last_name, email, address)
-        self.accounts[username] = account
-
-        self.save()
+        self.backend.put_account(account)
 
     """
     Deletes a user.
     """
     def delete_user(self, username):
         self.validate_user(username)
-        if self.user_exists(username):
-            del self.accounts[username]
-            self.save()
+        self.backend.delete_account(username)
 
     """
-    Validates a user's password.
+    Validates a user's password, upgrading its stored hash if it is outdated.
     """
     def validate_password(self, username, password):
-        if not self.user_exists(username):
+        account = self.backend.get_account(username)
+        if account is None:
             return False
 
-        encrypted_password = hashlib.sha256(password.encode()).hexdigest()
+        (valid, new_hash) = passwords.hasher.check(password, account.password)
 
-        if self.get_user(username).password != encrypted_password:
+        if not valid:
             return False
 
-        return True
+        if new_hash is not None:
+            account.password = new_hash
+            self.backend.put_account(account)
 
-    """
-    Save the list of accounts.
-    """
-    def save(self):
-        with open('accounts.pickle', 'wb') as f:
-            pickle.dump(self.accounts, f)
+        return True
 
 
 class Account:
@@ -0,0 +1,206 @@
+from collections import deque
+from server import workers
+import logging
+import threading
+import time
+
+
+"""
+Delivers messages to connected users in the background.
+
+Every recipient has a bounded queue of outbound messages and at most one task
+on the delivery pool sending them, in order, through the recipient's callback.
+Queueing a message never waits for the recipient, so a slow or dead client
+only delays its own messages. If a queue is full the oldest message is dropped;
+messages are already stored, so the client can still fetch them as history.
+
+When the server runs as several processes, a router (see broker.BrokerClient)
+is told about registered users and passed messages for users connected to
+other processes.
+"""
+class DeliveryManager:
+    def __init__(self, threads=16, queue_size=256, router=None):
+        self.queue_size = queue_size
+        self.router = router
+        # Only ever holds one task per recipient, so the queue is never full.
+        self.pool = workers.WorkerPool(threads, 1 << 30)
+        self.recipients = {}
+        self.lock = threading.Lock()
+
+    """
+    Sets the callback used to deliver messages to a user. It is called with the
+    name of the client method to call and its parameters.
+    """
+    def register(self, username, callback):
+        with self.lock:
+            if username in self.recipients:
+                self.recipients[username].callback = callback
+            else:
+                self.recipients[username] = Recipient(username, callback)
+
+        if self.router is not None:
+            self.router.register(username)
+
+    """
+    Stops delivering messages to a user, discarding any still queued. If a
+    callback is given, only does so if it is still the user's callback, so
+    that a closed connection cannot unregister a newer one. Returns whether
+    the user was unregistered.
+    """
+    def unregister(self, username, callback=None):
+        with self.lock:
+            recipient = self.recipients.get(username)
+            if recipient is None or (callback is not None and recipient.callback is not callback):
+                return False
+            del self.recipients[username]
+            recipient.queue.clear()
+
+        if self.router is not None:
+            self.router.unregister(username)
+        return True
+
+    """
+    Checks if messages are being delivered to a user.
+    """
+    def is_registered(self, username):
+        return username in self.recipients
+
+    """
+    Queues a message for a user, to be passed to the client method given. If
+    the user is not registered here, passes it to the router, unless route is
+    false.
+    """
+    def deliver(self, username, message, method="receive_message", route=True):
+        with self.lock:
+            recipient = self.recipients.get(username)
+            if recipient is not None:
+                if len(recipient.queue) >= self.queue_size:
+                    recipient.queue.popleft()
+                    recipient.dropped += 1
+                recipient.queue.append((time.time(), method, message))
+
+                if recipient.active:
+                    return
+                recipient.active = True
+
+        if recipient is not None:
+            self.pool.submit(lambda: self._drain(recipient))
+        elif route and self.router is not None:
+            # Sent outside the lock, since it writes to the broker's socket.
+            self.router.route(username, message, method)
+
+    """
+    Queues a message sent to a group for the given members, who must be
+    registered here. Unless route is false, also passes it to the router, so
+    that other processes can queue it for the members they hold.
+    """
+    def deliver_group(self, group, usernames, message, method="receive_message", route=True):
+        for username in usernames:
+            self.deliver(username, message, method, route=False)
+
+        if route and self.router is not None:
+            self.router.route_group(group, message, method)
+
+    """
+    Gets the number of messages waiting to be delivered to all users.
+    """
+    def get_backlog(self):
+        with self.lock:
+            return sum(len(recipient.queue) for recipient in self.recipients.values())
+
+    """
+    Gets delivery statistics for every registered user.
+
+    For each user, reports the number of queued messages, how long the oldest
+    one has waited, the time between queueing and delivery of the last message
+    and the highest such time, and counts of delivered, dropped and failed
+    messages. Times are in seconds.
+    """
+    def get_stats(self):
+        now = time.time()
+        stats = {}
+
+        with self.lock:
+            for username, recipient in self.recipients.items():
+                stats[username] = {
+                    "queued": len(recipient.queue),
+                    "oldest_age": now - recipient.queue[0][0] if recipient.queue else 0.0,
+                    "last_lag": recipient.last_lag,
+                    "max_lag": recipient.max_lag,
+                    "delivered": recipient.delivered,
+                    "dropped": recipient.dropped,
+                    "failed": recipient.failed
+                }
+
+        return stats
+
+    """
+    Gets the delivery statistics of get_stats() combined over every registered
+    user: the highest of the times, and the sums of the counts.
+    """
+    def get_summary(self):
+        summary = {
+            "queued": 0,
+            "oldest_age": 0.0,
+            "last_lag": 0.0,
+            "max_lag": 0.0,
+            "delivered": 0,
+            "dropped": 0,
+            "failed": 0
+        }
+        for stats in self.get_stats().values():
+            for name, value in stats.items():
+                if isinstance(value, float):
+                    summary[name] = max(summary[name], value)
+                else:
+                    summary[name] += value
+        return summary
+
+    """
+    Sends queued messages to a recipient. Gives up the worker after a few
+    messages and requeues itself, so that other recipients get a turn.
+    """
+    def _drain(self, recipient):
+        for _ in range(DRAIN_BATCH_SIZE):
+            with self.lock:
+                if not recipient.queue:
+                    recipient.active = False
+                    return
+                (queued_at, method, message) = recipient.queue.popleft()
+
+            try:
+                recipient.callback(method, message)
+                recipient.delivered += 1
+            except Exception as e:
+                recipient.failed += 1
+                logging.warning("Could not deliver message to %s: %s", recipient.username, e)
+
+            lag = time.time() - queued_at
+            recipient.last_lag = lag
+            recipient.max_lag = max(recipient.max_lag, lag)
+
+        self.pool.submit(lambda: self._drain(recipient))
+
+
+# Number of messages sent to one recipient before letting others have a turn.
+DRAIN_BATCH_SIZE = 16
+
+
+"""
+Outbound message queue and statistics for one user.
+"""
+class Recipient:
+    def __init__(self, username, callback):
+        self.username = username
+        self.callback = callback
+        self.queue = deque()
+        # Whether a task is sending this recipient's messages.
+        self.active = False
+        self.delivered = 0
+        self.dropped = 0
+        self.failed = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+
+
+manager = DeliveryManager()
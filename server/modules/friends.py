@@ -1,17 +1,31 @@
 from server.modules import accounts
-import pickle
 
 
 """
 Manages friend connections between users.
+
+Friend connections go one way: a user's friends are the users they have added,
+and their followers are the users who have added them. Other parts of the
+server can add listeners to be told when someone's friends change, and use
+get_followers() to reach everyone who follows a user.
 """
 class FriendManager:
     def __init__(self):
-        try:
-            with open('friends.pickle', 'rb') as f:
-                self.friends = pickle.load(f)
-        except FileNotFoundError:
-            self.friends = {}
+        self.backend = None
+        self.listeners = []
+
+    """
+    Sets the storage backend to keep friend connections in.
+    """
+    def open(self, backend):
+        self.backend = backend
+
+    """
+    Registers a function to be called with a username and the lists of
+    friends added and removed whenever that user's friends change.
+    """
+    def add_listener(self, listener):
+        self.listeners.append(listener)
 
     """
     Gets a list of friends for a given user.
@@ -19,43 +33,79 @@ class FriendManager:
     def get_friends(self, username):
         accounts.manager.validate_user(username)
 
-        if username in self.friends:
-            return self.friends[username]
-        # User has no friends. :(
-        return []
+        # An empty list means the user has no friends. :(
+        return self.backend.get_friends(username)
 
     """
-    Adds a user as a friend for a given user.
+    Gets a list of the users who have added a given user as a friend.
     """
-    def add_friend(self, username, friend_username):
+    def get_followers(self, username):
         accounts.manager.validate_user(username)
-        accounts.manager.validate_user(friend_username)
 
-        if not username in self.friends:
-            self.friends[username] = [friend_username]
-        elif not friend_username in self.friends[username]:
-            self.friends[username].append(friend_username)
+        return self.backend.get_followers(username)
 
-        self.save()
+    """
+    Adds a user as a friend for a given user.
+    """
+    def add_friend(self, username, friend_username):
+        self.add_friends(username, [friend_username])
 
     """
     Remove a user as a friend for a given user.
     """
     def remove_friend(self, username, friend_username):
+        self.remove_friends(username, [friend_username])
+
+    """
+    Adds several users as friends for a given user at once.
+    """
+    def add_friends(self, username, friend_usernames):
         accounts.manager.validate_user(username)
-        accounts.manager.validate_user(friend_username)
+        for friend_username in friend_usernames:
+            accounts.manager.validate_user(friend_username)
+
+        added = self.backend.add_friends(username, friend_usernames)
+        if added:
+            self._changed(username, added, [])
+
+    """
+    Removes several users as friends for a given user at once.
+    """
+    def remove_friends(self, username, friend_usernames):
+        accounts.manager.validate_user(username)
+        for friend_username in friend_usernames:
+            accounts.manager.validate_user(friend_username)
+
+        removed = self.backend.remove_friends(username, friend_usernames)
+        if removed:
+            self._changed(username, [], removed)
 
-        if username in self.friends and friend_username in self.friends[username]:
-            self.friends[username].remove(friend_username)
+    """
+    Gets the friends two users have in common.
+    """
+    def get_mutual_friends(self, username1, username2):
+        accounts.manager.validate_user(username1)
+        accounts.manager.validate_user(username2)
 
-        self.save()
+        return self.backend.get_mutual_friends(username1, username2)
 
     """
-    Saves the list of friend mappings.
+    Suggests friends for a user: the friends of their friends, with how many
+    of their friends each one is a friend of, most first.
     """
-    def save(self):
-        with open('friends.pickle', 'wb') as f:
-            pickle.dump(self.friends, f)
+    def get_friends_of_friends(self, username, limit=50):
+        accounts.manager.validate_user(username)
+        limit = max(1, min(limit, MAX_SUGGESTIONS))
+
+        return self.backend.get_friends_of_friends(username, limit)
+
+    def _changed(self, username, added, removed):
+        for listener in self.listeners:
+            listener(username, added, removed)
+
+
+# Largest number of friends of friends returned at once.
+MAX_SUGGESTIONS = 500
 
 
 manager = FriendManager()
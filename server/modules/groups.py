@@ -1,38 +1,54 @@
-from server.modules import accounts
-import pickle
+from server.modules import (accounts, delivery)
+import threading
 import uuid
 
 
 """
 Manages groups.
+
+Groups are stored by the backend, and cached in memory the first time they are
+used: their members as an ordered set, their display name, built only when it
+is first asked for after a change, and which members are connected to this
+process. Sending to a group only has to go through that last set, so it costs
+as much as the number of members online rather than the size of the group.
+
+When the server runs as several processes, a router (see broker.BrokerClient)
+is told about every change so that other processes can drop their copy.
 """
 class GroupManager:
-    def __init__(self):
-        try:
-            with open('groups.pickle', 'rb') as f:
-                (self.groups, self.user_map) = pickle.load(f)
-        except FileNotFoundError:
+    def __init__(self, router=None):
+        self.backend = None
+        self.router = router
+        # Cached groups by ID.
+        self.groups = {}
+        self.lock = threading.Lock()
+
+    """
+    Sets the storage backend to keep groups in.
+    """
+    def open(self, backend):
+        self.backend = backend
+        with self.lock:
             self.groups = {}
-            self.user_map = {}
 
     """
     Checks if a group exists.
     """
     def group_exists(self, id):
-        return id in self.groups
+        return self._get(id) is not None
 
     """
     Validates a group ID.
     """
     def validate_group(self, id):
-        if not id in self.groups:
+        if not self.group_exists(id):
             raise Exception("Group does not exist")
 
     """
     Gets a list of all groups.
     """
     def get_groups(self):
-        return list(self.groups.keys())
+        return self.backend.get_group_ids()
 
     """
     Gets a list of groups that contain a given user.
@@ -40,32 +56,75 @@ class GroupManager:
     def get_groups_with_user(self, username):
         accounts.manager.validate_user(username)
 
-        if not username in self.user_map:
-            return []
-
-        return self.user_map[username]
+        return self.backend.get_user_groups(username)
 
     """
     Gets details about a group.
     """
     def get_group(self, id):
-        self.validate_group(id)
+        group = self._get(id)
+        if group is None:
+            raise Exception("Group does not exist")
+
+        with self.lock:
+            if group.name is None:
+                group.name = ", ".join(group.users)
+            return {
+                "id": id,
+                "users": list(group.users),
+                "name": group.name
+            }
+
+    """
+    Checks if a user is in a group.
+    """
+    def is_member(self, id, username):
+        group = self._get(id)
+        return group is not None and username in group.users
+
+    """
+    Gets the members of a group that are connected to this process, so that
+    messages can be delivered to them.
+    """
+    def get_online_members(self, id):
+        group = self._get(id)
+        if group is None:
+            return []
+
+        with self.lock:
+            return list(group.online)
+
+    """
+    Records whether a user is connected to this process, for the groups of
+    theirs that are cached.
+    """
+    def set_online(self, username, online):
+        ids = self.backend.get_user_groups(username)
+
+        with self.lock:
+            for id in ids:
+                group = self.groups.get(id)
+                if group is None or not username in group.users:
+                    continue
+                if online:
+                    group.online.add(username)
+                else:
+                    group.online.discard(username)
 
-        group = self.groups[id]
-        group["name"] = ", ".join(group["users"])
-        return group
+    """
+    Drops a group from the cache, so that it is read from the backend again
+    the next time it is used. Called when another process has changed it.
+    """
+    def invalidate(self, id):
+        with self.lock:
+            self.groups.pop(id, None)
 
     """
     Creates a new group and returns its ID.
     """
     def create_group(self):
         id = str(uuid.uuid4())
-        self.groups[id] = {
-            "id": id,
-            "users": []
-        }
-
-        self.save()
+        self.backend.create_group(id)
         return id
 
     """
@@ -73,46 +132,89 @@ class GroupManager:
     """
     def delete_group(self, id):
         self.validate_group(id)
+        self.backend.delete_group(id)
 
-        for username in self.groups[id]["users"]:
-            self.user_map[username].remove(id)
-        del self.groups[id]
-
-        self.save()
+        with self.lock:
+            self.groups.pop(id, None)
+        self._changed(id)
 
     """
-    Adds a user to a group.
+    Adds a user to a group. Does nothing if they are already in it.
     """
     def add_user_to_group(self, username, id):
         accounts.manager.validate_user(username)
-        self.validate_group(id)
-
-        self.groups[id]["users"].append(username)
+        group = self._get(id)
+        if group is None:
+            raise Exception("Group does not exist")
+        if username in group.users:
+            return
 
-        if username in self.user_map:
-            self.user_map[username].append(id)
-        else:
-            self.user_map[username] = [id]
+        self.backend.add_group_user(id, username)
 
-        self.save()
+        with self.lock:
+            group.users[username] = None
+            group.name = None
+            if delivery.manager.is_registered(username):
+                group.online.add(username)
+        self._changed(id)
 
     """
     Removes a user from a group.
     """
     def remove_user_from_group(self, username, id):
-        self.validate_group(id)
+        group = self._get(id)
+        if group is None:
+            raise Exception("Group does not exist")
+        if not username in group.users:
+            raise Exception("User is not in the group")
 
-        self.groups[id]["users"].remove(username)
-        self.user_map[username].remove(id)
+        self.backend.remove_group_user(id, username)
 
-        self.save()
+        with self.lock:
+            group.users.pop(username, None)
+            group.name = None
+            group.online.discard(username)
+        self._changed(id)
 
     """
-    Saves the groups list.
+    Gets a group from the cache, reading it from the backend if it is not
+    there yet. Returns None if the group does not exist.
     """
-    def save(self):
-        with open('groups.pickle', 'wb') as f:
-            pickle.dump((self.groups, self.user_map), f)
+    def _get(self, id):
+        group = self.groups.get(id)
+        if group is not None:
+            return group
+
+        users = self.backend.get_group_users(id)
+        if users is None:
+            return None
+
+        with self.lock:
+            # Another thread may have got here first.
+            group = self.groups.get(id)
+            if group is None:
+                group = self.groups[id] = Group(users)
+                group.online = {username for username in users if delivery.manager.is_registered(username)}
+            return group
+
+    def _changed(self, id):
+        if self.router is not None:
+            self.router.group_changed(id)
+
+
+"""
+Cached members of a group.
+"""
+class Group:
+    __slots__ = ("users", "name", "online")
+
+    def __init__(self, users):
+        # Used as an ordered set, so members stay in the order they joined.
+        self.users = dict.fromkeys(users)
+        # Display name, or None if it has to be built again.
+        self.name = None
+        # Members connected to this process.
+        self.online = set()
 
 
 manager = GroupManager()
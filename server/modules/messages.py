@@ -1,31 +1,40 @@
-from server.modules import (accounts, groups)
-import pickle
+from server import search
+from server.modules import (accounts, delivery, groups)
+import sys
 import time
 
 
 """
 Manages and stores messages between users and in groups.
+
+Messages are kept by the storage backend, which indexes them by conversation,
+so reading a conversation does not scan unrelated messages. They are handled as
+Message records, and only turned into dictionaries when they are returned to
+clients. Connected recipients are sent new messages through the delivery
+manager, so sending returns once a message is stored and queued.
+
+Each user also has an inbox, which the backend updates as messages are sent:
+the last message of every conversation they are in, and how many messages they
+have not read. Listing conversations reads only the inbox, not their history.
+
+Searches go through the backend's full-text index, so they do not scan message
+text either.
 """
 class MessageManager:
     def __init__(self):
-        self.callbacks = {}
-        try:
-            with open('messages.pickle', 'rb') as f:
-                self.messages = pickle.load(f)
-        except FileNotFoundError:
-            self.messages = []
+        self.backend = None
+
+    """
+    Sets the storage backend to keep messages in.
+    """
+    def open(self, backend):
+        self.backend = backend
 
     """
     Gets all messages between two users.
     """
     def get_all_with_users(self, username1, username2):
-        messages = []
-        for message in self.messages:
-            if message["sender"] == username1 and message["receiver"]["type"] == "user" and message["receiver"]["username"] == username2:
-                messages.append(message)
-            elif message["sender"] == username2 and message["receiver"]["type"] == "user" and message["receiver"]["username"] == username1:
-                messages.append(message)
-        return messages
+        return _to_dicts(self.backend.get_conversation(user_conversation(username1, username2)))
 
     """
     Gets all messages in a group.
@@ -33,75 +42,272 @@ class MessageManager:
     def get_all_in_group(self, group):
         groups.manager.validate_group(group)
 
-        messages = []
-        for message in self.messages:
-            if message["receiver"]["type"] == "group" and message["receiver"]["id"] == group:
-                messages.append(message)
-        return messages
+        return _to_dicts(self.backend.get_conversation(group_conversation(group)))
 
     """
-    Sends a message.
+    Gets a page of messages between two users. See get_page().
     """
-    def send(self, sender, receiver_type, text, username=None, group=None):
-        message = {
-            "id": len(self.messages),
-            "sender": sender,
-            "receiver": {
-                "type": receiver_type
-            },
-            "timestamp": time.time(),
-            "text": text
+    def get_page_with_users(self, username1, username2, before_id=None, since_id=None, limit=50):
+        return self.get_page(user_conversation(username1, username2), before_id, since_id, limit)
+
+    """
+    Gets a page of messages in a group. See get_page().
+    """
+    def get_page_in_group(self, group, before_id=None, since_id=None, limit=50):
+        groups.manager.validate_group(group)
+
+        return self.get_page(group_conversation(group), before_id, since_id, limit)
+
+    """
+    Gets a page of at most limit messages from a conversation, oldest first.
+
+    With since_id, gets the oldest messages newer than that ID, so a client can
+    catch up on what it missed. Otherwise gets the newest messages older than
+    before_id, or the newest messages of all if before_id is not given.
+
+    Returns the messages along with a cursor to pass as the same argument to
+    get the next page, which is None if there are no more messages.
+    """
+    def get_page(self, conversation, before_id=None, since_id=None, limit=50):
+        if before_id is not None and since_id is not None:
+            raise Exception("Only one of before_id and since_id can be given")
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+
+        # Fetch one extra message to find out whether there is another page.
+        page = self.backend.get_conversation(conversation, before_id, since_id, limit + 1)
+        more = len(page) > limit
+
+        if since_id is not None:
+            page = page[:limit]
+            cursor = page[-1].id if more else None
+        else:
+            page = page[-limit:]
+            cursor = page[0].id if more else None
+
+        return {
+            "messages": _to_dicts(page),
+            "cursor": cursor
         }
 
+    """
+    Sends a message.
+    """
+    def send(self, sender, receiver_type, text, username=None, group=None):
         if receiver_type == "user":
             accounts.manager.validate_user(username)
-            message["receiver"]["username"] = username
+            message = Message(None, sender, USER, username, time.time(), text)
         elif receiver_type == "group":
             groups.manager.validate_group(group)
-            message["receiver"]["id"] = group
+            message = Message(None, sender, GROUP, group, time.time(), text)
         else:
             raise Exception("Invalid recipient type")
 
-        self.messages.append(message)
+        conversation = conversation_key(message)
+        self.backend.add_message(message, conversation)
 
-        # If a callback was set to send a message immediately, invoke it now.
+        # Queue the message for any recipients that have a callback set. Only
+        # the group members connected to some process are sent anything. All
+        # of them are sent the same dictionary.
+        payload = message.to_dict()
         if receiver_type == "user":
-            self.call_callback(sender, message)
-            self.call_callback(username, message)
-        elif receiver_type == "group":
-            for user in groups.manager.get_group(group)["users"]:
-                self.call_callback(user, message)
+            recipients = [sender] if username == sender else [sender, username]
+            self.backend.update_inbox(conversation, message, recipients)
+            for user in recipients:
+                self.call_callback(user, payload)
+        else:
+            self.backend.update_inbox(conversation, message, [])
+            delivery.manager.deliver_group(group, groups.manager.get_online_members(group), payload)
 
-        self.save()
+    """
+    Gets a user's conversations, most recently active first, each with its
+    last message and the number of messages the user has not read. A
+    conversation is given like the receiver of a message sent to it.
+    """
+    def get_inbox(self, username):
+        return [
+            {
+                "conversation": conversation_receiver(username, entry["conversation"]),
+                "last_message": entry["last_message"].to_dict(),
+                "read_id": entry["read_id"],
+                "unread": entry["unread"]
+            }
+            for entry in self.backend.get_inbox(username)
+        ]
+
+    """
+    Marks the messages of a conversation, given like the receiver of a
+    message, as read by a user up to and including an ID.
+    """
+    def mark_read(self, username, conversation, up_to_id):
+        self.backend.mark_read(username, receiver_conversation(username, conversation), up_to_id)
+
+    """
+    Searches the messages a user can read for ones containing every word of a
+    query, newest first, in pages of at most limit messages. If a conversation
+    is given, like the receiver of a message, only searches that one.
+
+    Returns the messages along with a cursor to pass to get the next page of
+    older results, which is None if there are no more.
+    """
+    def search(self, username, query, conversation=None, limit=50, cursor=None):
+        terms = search.tokenize(query)
+        if not terms:
+            raise Exception("Search query has no words in it")
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+
+        user_groups = self.backend.get_user_groups(username)
+        key = None
+        if conversation is not None:
+            key = receiver_conversation(username, conversation)
+            if key[0] == "group" and not key[1] in user_groups:
+                raise Exception("Not a member of this group")
+
+        # Fetch one extra message to find out whether there is another page.
+        results = self.backend.search_messages(terms, username, user_groups, key, cursor, limit + 1)
+        more = len(results) > limit
+        results = results[:limit]
+
+        return {
+            "messages": _to_dicts(results),
+            "cursor": results[-1].id if more else None
+        }
 
     """
     Sets a callback to be invoked when a given user gets a message.
     """
     def set_callback(self, username, callback):
-        self.callbacks[username] = callback
+        delivery.manager.register(username, callback)
+        groups.manager.set_online(username, True)
 
     """
-    Removes a callback.
+    Removes a user's callback, or only the given one if it is still set.
     """
-    def remove_callback(self, username):
-        del self.callbacks[username]
+    def remove_callback(self, username, callback=None):
+        if delivery.manager.unregister(username, callback):
+            groups.manager.set_online(username, False)
 
     """
-    Invokes a message callback.
+    Queues a message, as a dictionary, to be passed to a user's callback, if
+    they have one.
     """
     def call_callback(self, username, message):
-        try:
-            if username in self.callbacks:
-                return self.callbacks[username](message)
-        except:
-            pass
+        delivery.manager.deliver(username, message)
+
+
+# Largest number of messages returned in one page.
+MAX_PAGE_SIZE = 500
+
+
+"""
+Names of the types of receiver a message can have, indexed by the numbers
+Message records store instead.
+"""
+RECEIVER_TYPES = ("user", "group")
+USER = 0
+GROUP = 1
+
+
+"""
+A message, stored compactly.
+
+The receiver is the username or group ID the message was sent to, and
+receiver_type says which of them it is. Sender and receiver names are
+interned, so all the messages of a user or group share one copy of each
+string. The ID is None until the message is stored.
+"""
+class Message:
+    __slots__ = ("id", "sender", "receiver_type", "receiver", "timestamp", "text")
+
+    def __init__(self, id, sender, receiver_type, receiver, timestamp, text):
+        self.id = id
+        self.sender = sys.intern(sender)
+        self.receiver_type = receiver_type
+        self.receiver = sys.intern(receiver)
+        self.timestamp = timestamp
+        self.text = text
 
     """
-    Saves the message database.
+    Gets the message in the form clients are sent, with the receiver as a
+    dictionary of its type and its "username" or "id".
     """
-    def save(self):
-        with open('messages.pickle', 'wb') as f:
-            pickle.dump(self.messages, f)
+    def to_dict(self):
+        if self.receiver_type == USER:
+            receiver = {"type": "user", "username": self.receiver}
+        else:
+            receiver = {"type": "group", "id": self.receiver}
+
+        return {
+            "id": self.id,
+            "sender": self.sender,
+            "receiver": receiver,
+            "timestamp": self.timestamp,
+            "text": self.text
+        }
+
+
+"""
+Makes a Message from a message dictionary like those returned by to_dict(),
+which is also how older versions stored messages.
+"""
+def from_dict(message):
+    receiver = message["receiver"]
+    if receiver["type"] == "user":
+        return Message(message.get("id"), message["sender"], USER, receiver["username"], message["timestamp"], message["text"])
+    return Message(message.get("id"), message["sender"], GROUP, receiver["id"], message["timestamp"], message["text"])
+
+
+"""
+Gets the key for the direct conversation between two users, which is the same
+whichever order they are given in.
+"""
+def user_conversation(username1, username2):
+    if username1 <= username2:
+        return ("user", username1, username2)
+    return ("user", username2, username1)
+
+
+"""
+Gets the key for the conversation in a group.
+"""
+def group_conversation(group):
+    return ("group", group)
+
+
+"""
+Gets the key for the conversation a message belongs to.
+"""
+def conversation_key(message):
+    if message.receiver_type == USER:
+        return user_conversation(message.sender, message.receiver)
+    return group_conversation(message.receiver)
+
+
+"""
+Gets the key of a conversation a user is in, from the receiver of a message
+sent to it.
+"""
+def receiver_conversation(username, receiver):
+    if receiver["type"] == "user":
+        return user_conversation(username, receiver["username"])
+    if receiver["type"] == "group":
+        return group_conversation(receiver["id"])
+    raise Exception("Invalid conversation type")
+
+
+"""
+Gets the receiver a user would send a message to in a conversation, from the
+conversation's key.
+"""
+def conversation_receiver(username, conversation):
+    if conversation[0] == "group":
+        return {"type": "group", "id": conversation[1]}
+
+    other = conversation[2] if conversation[1] == username else conversation[1]
+    return {"type": "user", "username": other}
+
+
+def _to_dicts(messages):
+    return [message.to_dict() for message in messages]
 
 
 manager = MessageManager()
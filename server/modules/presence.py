@@ -0,0 +1,166 @@
+from server.modules import (delivery, friends, groups)
+import logging
+import threading
+import time
+
+
+"""
+Tracks which users are online and tells their followers and group members.
+
+A user is online while they have at least one logged in connection. Changes
+are not pushed straight away: they are collected and sent every interval
+seconds, so a user who disconnects and reconnects in between causes no
+notification at all, and every recipient gets one receive_presence call per
+interval listing all the changes they can see, however many users changed.
+
+Presence is kept in memory, so after a restart every user starts out offline.
+When the server runs as several processes, a router (see broker.BrokerClient)
+is told when a user comes online or goes offline in this process, and the
+broker tells every process when they do so across all of them. Each process
+then tells the recipients connected to it.
+"""
+class PresenceManager:
+    def __init__(self, interval=0.5, router=None):
+        self.interval = interval
+        self.router = router
+        # Number of logged in connections to this process for each user.
+        self.connections = {}
+        # Users online in any process.
+        self.online = set()
+        # Users whose presence changed since the last notifications were sent.
+        self.changed = set()
+        # Presence last sent out for each user, to skip changes that cancel out.
+        self.published = {}
+        self.lock = threading.Lock()
+        self.pending = threading.Condition(self.lock)
+        self.notifier = None
+
+    """
+    Records that a user has logged in on a connection.
+    """
+    def connected(self, username):
+        with self.lock:
+            count = self.connections.get(username, 0)
+            self.connections[username] = count + 1
+            if count == 0:
+                self._publish(username, True)
+
+    """
+    Records that one of a user's connections has logged out or closed.
+    Returns whether the user is now offline.
+    """
+    def disconnected(self, username):
+        with self.lock:
+            count = self.connections.get(username, 0)
+            if count <= 1:
+                self.connections.pop(username, None)
+                if count == 1:
+                    self._publish(username, False)
+                return True
+
+            self.connections[username] = count - 1
+            return False
+
+    """
+    Records that a user has come online or gone offline across every process.
+    Called by the broker.
+    """
+    def set_online(self, username, online):
+        with self.lock:
+            self._set_online(username, online)
+
+    """
+    Checks if a user is online. Users connected to this process count as
+    online before the broker has told every process about them.
+    """
+    def is_online(self, username):
+        return username in self.online or username in self.connections
+
+    def _publish(self, username, online):
+        if self.router is None:
+            self._set_online(username, online)
+        else:
+            # Sent while holding the lock, so that the broker gets a user's
+            # changes in the order they happened.
+            self.router.set_presence(username, online)
+
+    def _set_online(self, username, online):
+        if online:
+            self.online.add(username)
+        else:
+            self.online.discard(username)
+        self._changed(username)
+
+    def _changed(self, username):
+        self.changed.add(username)
+
+        if self.notifier is None:
+            # Started on first use, so that it runs in the process serving users.
+            self.notifier = threading.Thread(target=self._notify_periodically, daemon=True)
+            self.notifier.start()
+        self.pending.notify()
+
+    def _notify_periodically(self):
+        while True:
+            with self.lock:
+                while not self.changed:
+                    self.pending.wait()
+
+            # Let more changes collect before sending them.
+            time.sleep(self.interval)
+
+            try:
+                self.notify()
+            except Exception as e:
+                logging.warning("Could not send presence changes: %s", e)
+
+    """
+    Sends every change collected since the last call to the online friends and
+    group members of the users that changed.
+    """
+    def notify(self):
+        with self.lock:
+            changes = {}
+            for username in self.changed:
+                online = username in self.online
+                if self.published.get(username, False) != online:
+                    changes[username] = online
+                    self.published[username] = online
+            self.changed.clear()
+
+        # Group the changes by recipient, so each gets them in one call. The
+        # delivery manager skips recipients that are not connected, and every
+        # process sends them to its own, so they are not routed.
+        updates = {}
+        for username, online in changes.items():
+            for recipient in self._audience(username):
+                if recipient != username:
+                    updates.setdefault(recipient, []).append({
+                        "username": username,
+                        "online": online
+                    })
+
+        for recipient, users in updates.items():
+            delivery.manager.deliver(recipient, {"users": users}, "receive_presence", route=False)
+
+    """
+    Tells a user which of the friends they have just added are online, since
+    they were not told before. Called by the friend manager.
+    """
+    def friends_changed(self, username, added, removed):
+        users = [{"username": friend_username, "online": True} for friend_username in added if self.is_online(friend_username)]
+        if users:
+            delivery.manager.deliver(username, {"users": users}, "receive_presence")
+
+    """
+    Gets the users who can see a user's presence: the users who have them as a
+    friend and the members of their groups.
+    """
+    def _audience(self, username):
+        audience = set(friends.manager.get_followers(username))
+        for id in groups.manager.get_groups_with_user(username):
+            audience.update(groups.manager.get_group(id)["users"])
+        return audience
+
+
+manager = PresenceManager()
@@ -1,7 +1,9 @@
 from server.modules import accounts
-import hashlib
+import heapq
+import logging
+import secrets
+import threading
 import time
-import uuid
 
 
 class AuthenticationException(Exception):
@@ -10,10 +12,36 @@ class AuthenticationException(Exception):
 
 """
 Manages login sessions and user authentication.
+
+Sessions expire after Token.lifetime seconds without use. Besides the tokens
+themselves, the manager keeps a heap of tokens ordered by when they expire,
+and a background thread pops expired ones off it every sweep_interval seconds,
+so sessions that are never logged out do not pile up. Using a session moves
+its expiry time later without touching the heap; the sweeper notices and
+pushes it back with its new time instead of evicting it.
+
+Each user can have at most max_sessions_per_user sessions, and logging in
+again beyond that ends their oldest session.
 """
 class SessionManager:
-    def __init__(self):
+    def __init__(self, lifetime=None, max_sessions_per_user=16, sweep_interval=60, admins=()):
+        self.lifetime = Token.lifetime if lifetime is None else lifetime
+        # Usernames allowed to call administrative methods.
+        self.admins = set(admins)
+        self.max_sessions_per_user = max_sessions_per_user
+        self.sweep_interval = sweep_interval
         self.tokens = {}
+        # Tokens of each user, oldest first.
+        self.user_tokens = {}
+        # (expires, token) pairs, where expires may be earlier than the token's.
+        self.expiry = []
+        self.lock = threading.Lock()
+        self.sweeper = None
+
+        self.created = 0
+        self.logged_out = 0
+        self.expired = 0
+        self.capped = 0
 
     """
     Authenticates and logs in a user.
@@ -28,9 +56,25 @@ class SessionManager:
             raise AuthenticationException("Invalid password")
 
         # Generate a new access token.
-        token = Token(username, address)
-        # Store the token, along with the username and the time it expires.
-        self.tokens[token.token] = token
+        token = Token(username, address, self.lifetime)
+
+        with self.lock:
+            # Store the token, along with the username and the time it expires.
+            self.tokens[token.token] = token
+            user_tokens = self.user_tokens.setdefault(username, {})
+            user_tokens[token.token] = None
+            heapq.heappush(self.expiry, (token.expires, token.token))
+            self.created += 1
+
+            # End the user's oldest sessions if they have too many.
+            while len(user_tokens) > self.max_sessions_per_user:
+                self._remove(next(iter(user_tokens)))
+                self.capped += 1
+
+            if self.sweeper is None:
+                # Started on first use, so that it runs in the process serving users.
+                self.sweeper = threading.Thread(target=self._sweep_periodically, daemon=True)
+                self.sweeper.start()
 
         return token.token
 
@@ -38,7 +82,11 @@ class SessionManager:
     Logs a user out.
     """
     def logout(self, token):
-        del self.tokens[token]
+        with self.lock:
+            if token not in self.tokens:
+                raise AuthenticationException("Invalid token")
+            self._remove(token)
+            self.logged_out += 1
 
     """
     Get the user for a given token.
@@ -57,41 +105,125 @@ class SessionManager:
     """
     def validate_token(self, token):
         # Check if token exists.
-        if not token in self.tokens:
+        session = self.tokens.get(token)
+        if session is None:
             raise AuthenticationException("Invalid token")
 
         # Check if token expired.
-        if self.tokens[token].is_expired():
+        now = time.time()
+        if session.expires <= now:
             # Delete expired tokens to cleanup.
-            del self.tokens[token]
+            with self.lock:
+                if token in self.tokens:
+                    self._remove(token)
+                    self.expired += 1
             raise AuthenticationException("Invalid token")
 
         # Since the token didn't expire, update the expire time and return success.
-        self.tokens[token].update_expires()
+        session.expires = now + self.lifetime
+
+    """
+    Checks if a user may call administrative methods.
+    """
+    def is_admin(self, username):
+        return username in self.admins
+
+    """
+    Validates a token, and makes sure it belongs to an administrator.
+    """
+    def validate_admin(self, token):
+        self.validate_token(token)
+        if not self.is_admin(self.get_token_user(token)):
+            raise AuthenticationException("Not an administrator")
+
+    """
+    Evicts every expired session, and returns how many there were.
+    """
+    def sweep(self):
+        now = time.time()
+        count = 0
+
+        with self.lock:
+            while self.expiry and self.expiry[0][0] <= now:
+                (_, token) = heapq.heappop(self.expiry)
+                session = self.tokens.get(token)
+                if session is None:
+                    # Logged out or evicted already.
+                    continue
+
+                if session.expires > now:
+                    # Used since it was pushed, so check again when it expires.
+                    heapq.heappush(self.expiry, (session.expires, token))
+                else:
+                    self._remove(token)
+                    count += 1
+
+            self.expired += count
+
+            # Logged out tokens stay in the heap until they would have expired,
+            # so rebuild it if they have come to outnumber the live ones.
+            if len(self.expiry) > 2 * len(self.tokens) + 1024:
+                self.expiry = [(session.expires, token) for token, session in self.tokens.items()]
+                heapq.heapify(self.expiry)
+
+        return count
+
+    """
+    Gets the number of live sessions, and counts of sessions created, logged
+    out, expired and ended because their user had too many.
+    """
+    def get_stats(self):
+        return {
+            "live": len(self.tokens),
+            "created": self.created,
+            "logged_out": self.logged_out,
+            "expired": self.expired,
+            "capped": self.capped
+        }
+
+    def _sweep_periodically(self):
+        while True:
+            time.sleep(self.sweep_interval)
+
+            try:
+                count = self.sweep()
+            except Exception as e:
+                logging.warning("Could not sweep expired sessions: %s", e)
+                continue
+
+            if count:
+                logging.info("Evicted %d expired sessions", count)
+
+    """
+    Forgets a session. Its heap entry is skipped when it comes up.
+    """
+    def _remove(self, token):
+        session = self.tokens.pop(token)
+        user_tokens = self.user_tokens[session.username]
+        del user_tokens[token]
+        if not user_tokens:
+            del self.user_tokens[session.username]
 
 
 """
-Generates a new random authentication token.
+A login session, identified by a random authentication token.
 """
 class Token:
     lifetime = 86400 # 24 hours
 
-    def __init__(self, username, address):
+    __slots__ = ("token", "username", "address", "expires")
+
+    def __init__(self, username, address, lifetime=None):
         # Store info.
         self.username = username
         self.address = address
-        self.expires = time.time() + Token.lifetime
+        self.expires = time.time() + (Token.lifetime if lifetime is None else lifetime)
 
         # Generate token string.
-        random_bytes = str(uuid.uuid4()).encode()
-        time_bytes = int(time.time()).to_bytes(8, byteorder='big')
-        self.token = hashlib.sha256(random_bytes + time_bytes).hexdigest()
+        self.token = secrets.token_hex(32)
 
     def is_expired(self):
         return self.expires <= time.time()
 
-    def update_expires(self):
-        self.expires = time.time() + Token.lifetime
-
 
 manager = SessionManager()
@@ -0,0 +1,118 @@
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import hmac
+import multiprocessing
+import os
+import threading
+
+
+# Default scrypt cost: about 16 MiB of memory and a few tens of milliseconds.
+SCRYPT_N = 1 << 14
+SCRYPT_R = 8
+SCRYPT_P = 1
+
+SALT_SIZE = 16
+
+
+"""
+Hashes and checks passwords with scrypt, in a pool of separate processes.
+
+A password hash is stored as "scrypt$n$r$p$salt$hash", with the salt and hash
+in hex, so the cost parameters can be raised later. Hashes from before scrypt
+was used are a plain hex SHA-256 digest; they are still accepted, and replaced
+with an scrypt hash when the user next logs in.
+
+scrypt is slow on purpose, so it runs in other processes where it holds
+neither the GIL nor the request workers' CPU. At most queue_size hashes can be
+in progress or waiting, and any more are refused straight away, so a burst of
+logins can only ever tie up that many request workers.
+"""
+class PasswordHasher:
+    def __init__(self, processes=2, queue_size=16, n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P):
+        self.processes = processes
+        self.params = (n, r, p)
+        self.slots = threading.BoundedSemaphore(queue_size)
+        self.executor = None
+        self.lock = threading.Lock()
+
+    """
+    Hashes a new password.
+    """
+    def hash(self, password):
+        return self._run(hash_password, password, self.params)
+
+    """
+    Checks a password against a stored hash. Returns whether it matches, and a
+    new hash to store if the old one is outdated, or None.
+    """
+    def check(self, password, stored):
+        return self._run(check_password, password, stored, self.params)
+
+    """
+    Stops the hashing processes.
+    """
+    def close(self):
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown(cancel_futures=True)
+                self.executor = None
+
+    def _run(self, function, *args):
+        if not self.slots.acquire(blocking=False):
+            raise Exception("Server busy, try again later")
+
+        try:
+            return self._get_executor().submit(function, *args).result()
+        finally:
+            self.slots.release()
+
+    def _get_executor(self):
+        with self.lock:
+            if self.executor is None:
+                # Started on first use, from a fork server rather than by
+                # forking this process, which has other threads running.
+                self.executor = ProcessPoolExecutor(
+                    self.processes,
+                    mp_context=multiprocessing.get_context("forkserver")
+                )
+            return self.executor
+
+
+"""
+Hashes a password with scrypt and a random salt.
+"""
+def hash_password(password, params=(SCRYPT_N, SCRYPT_R, SCRYPT_P)):
+    (n, r, p) = params
+    salt = os.urandom(SALT_SIZE)
+    digest = _scrypt(password, salt, n, r, p)
+    return "scrypt$%d$%d$%d$%s$%s" % (n, r, p, salt.hex(), digest.hex())
+
+
+"""
+Checks a password against a stored hash. Returns whether it matches, and, if
+it does but the hash is a legacy SHA-256 digest or uses other scrypt
+parameters, a new hash to replace it with.
+"""
+def check_password(password, stored, params=(SCRYPT_N, SCRYPT_R, SCRYPT_P)):
+    if not stored.startswith("scrypt$"):
+        digest = hashlib.sha256(password.encode()).hexdigest()
+        if not hmac.compare_digest(digest, stored):
+            return (False, None)
+        return (True, hash_password(password, params))
+
+    (_, n, r, p, salt, expected) = stored.split("$")
+    (n, r, p) = (int(n), int(r), int(p))
+    digest = _scrypt(password, bytes.fromhex(salt), n, r, p)
+    if not hmac.compare_digest(digest.hex(), expected):
+        return (False, None)
+
+    if (n, r, p) != tuple(params):
+        return (True, hash_password(password, params))
+    return (True, None)
+
+
+def _scrypt(password, salt, n, r, p):
+    return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, maxmem=256 * n * r + (1 << 20))
+
+
+hasher = PasswordHasher()
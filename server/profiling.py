@@ -0,0 +1,330 @@
+import cProfile
+import logging
+import math
+import os
+import pstats
+import sys
+import threading
+import time
+import traceback
+
+
+"""
+Ways of profiling a window of time.
+
+"cprofile" runs matching RPC calls under cProfile and writes their combined
+statistics as a pstats file, which can be read with the pstats module or tools
+like snakeviz. "sample" takes a snapshot of every thread's stack at a fixed
+interval and writes the counts as collapsed stacks, the input format of
+flamegraph.pl and speedscope; it also sees time spent outside RPC calls.
+"""
+PROFILE_MODES = ("cprofile", "sample")
+
+# Seconds between stack samples in "sample" mode.
+SAMPLE_INTERVAL = 0.005
+
+# Whether cProfile can only profile one thing at a time in the whole process,
+# rather than in each thread, as is the case since it moved to sys.monitoring.
+CPROFILE_PROCESS_WIDE = sys.version_info >= (3, 12)
+
+# Innermost functions of threads that are waiting rather than working, which
+# are left out of samples.
+IDLE_FUNCTIONS = {"wait", "select", "poll", "accept", "recv_into", "_wait_for_tstate_lock", "sleep"}
+
+
+"""
+Profiles RPC calls on demand, and logs calls that take too long.
+
+The channel asks this object to run a call only while enabled is true, which
+is when a profiling window is open or slow requests are being logged. At all
+other times the only cost to a call is checking that flag.
+"""
+class Profiler:
+    def __init__(self, directory="profiles", slow_threshold=None):
+        self.directory = directory
+        # Seconds after which a call is logged as slow, or None to not log.
+        self.slow_threshold = slow_threshold
+        self.window = None
+        # Calls in progress by thread ID.
+        self.calls = {}
+        self.lock = threading.Lock()
+        self.enabled = False
+        self.watchdog = None
+        # Held while a call is profiled, if cProfile is process-wide.
+        self.cprofile_lock = threading.Lock()
+        self._update()
+
+    """
+    Starts profiling for the given number of seconds, in one of PROFILE_MODES,
+    for every RPC method or only those given. Returns the path the results
+    will be written to.
+    """
+    def start(self, seconds, mode="cprofile", methods=None):
+        if isinstance(seconds, bool) or not isinstance(seconds, (int, float)) or not math.isfinite(seconds) or seconds <= 0:
+            raise ValueError("Profiling time must be a positive number of seconds")
+        if not mode in PROFILE_MODES:
+            raise ValueError("Unknown profiling mode " + str(mode))
+
+        with self.lock:
+            if self.window is not None:
+                raise Exception("Profiling is already running")
+            if mode == "cprofile" and _profiler_active():
+                raise Exception("Another profiler is already running")
+
+            os.makedirs(self.directory, exist_ok=True)
+            name = "profile-%s-%d" % (time.strftime("%Y%m%d-%H%M%S"), os.getpid())
+            extension = ".pstats" if mode == "cprofile" else ".collapsed"
+            path = os.path.join(self.directory, name + extension)
+
+            window = ProfileWindow(mode, methods, path)
+            window.timer = threading.Timer(seconds, self._expire, args=(window,))
+            window.timer.daemon = True
+            self.window = window
+            self._update()
+
+        if mode == "sample":
+            threading.Thread(target=self._sample, args=(window,), daemon=True).start()
+
+        window.timer.start()
+
+        logging.info("Profiling for %g seconds in %s mode, writing to %s", seconds, mode, path)
+        return path
+
+    """
+    Ends the profiling window early, if one is open, and writes its results.
+    Returns the path written to, or None.
+    """
+    def stop(self):
+        with self.lock:
+            window = self.window
+            self.window = None
+            self._update()
+
+        return self._finish(window)
+
+    """
+    Ends a profiling window once its time is up, unless it has been stopped
+    already.
+    """
+    def _expire(self, window):
+        with self.lock:
+            if self.window is not window:
+                return
+            self.window = None
+            self._update()
+
+        self._finish(window)
+
+    def _finish(self, window):
+        if window is None:
+            return None
+
+        window.timer.cancel()
+        window.write()
+        logging.info("Wrote profile to %s", window.path)
+        return window.path
+
+    """
+    Sets the time in seconds after which calls are logged as slow, or None to
+    stop logging them.
+    """
+    def set_slow_threshold(self, seconds):
+        with self.lock:
+            self.slow_threshold = seconds
+            self._update()
+
+            if seconds is not None and self.watchdog is None:
+                self.watchdog = threading.Thread(target=self._watch, daemon=True)
+                self.watchdog.start()
+
+    """
+    Runs an RPC method with the given parameters, profiling it if it is being
+    profiled, and logging it if it is slow.
+    """
+    def call(self, method, function, params):
+        thread = threading.get_ident()
+        call = Call(method, params)
+        with self.lock:
+            self.calls[thread] = call
+            window = self.window
+
+        try:
+            if window is not None and window.mode == "cprofile" and window.includes(method) and self._acquire_cprofile():
+                try:
+                    profile = cProfile.Profile()
+                    try:
+                        return profile.runcall(function, **params)
+                    finally:
+                        window.add(profile)
+                finally:
+                    if CPROFILE_PROCESS_WIDE:
+                        self.cprofile_lock.release()
+            else:
+                return function(**params)
+        finally:
+            with self.lock:
+                del self.calls[thread]
+            self._check_slow(call)
+
+    """
+    Makes sure a call can be run under cProfile. Where cProfile is process-wide,
+    only one call is profiled at a time, and calls made meanwhile run without
+    it, since it would refuse to start. Returns whether the call can be
+    profiled.
+    """
+    def _acquire_cprofile(self):
+        if not CPROFILE_PROCESS_WIDE:
+            return not _profiler_active()
+
+        if not self.cprofile_lock.acquire(blocking=False):
+            return False
+        if _profiler_active():
+            self.cprofile_lock.release()
+            return False
+        return True
+
+    def _check_slow(self, call):
+        threshold = self.slow_threshold
+        if threshold is None:
+            return
+
+        elapsed = time.perf_counter() - call.start
+        if elapsed < threshold:
+            return
+
+        sizes = {name: _size(value) for name, value in call.params.items()}
+        stack = "".join(call.stack) if call.stack is not None else "  (finished before a stack was taken)\n"
+        logging.warning("Slow request %s took %.3fs, parameter sizes %s, stack:\n%s", call.method, elapsed, sizes, stack)
+
+    """
+    Takes a stack snapshot of every call that has run past the slow threshold,
+    while it is still running.
+    """
+    def _watch(self):
+        while True:
+            threshold = self.slow_threshold
+            time.sleep(max(threshold or 1.0, 0.02) / 2)
+            if threshold is None:
+                continue
+
+            now = time.perf_counter()
+            with self.lock:
+                late = [(thread, call) for thread, call in self.calls.items() if call.stack is None and now - call.start >= threshold]
+            if not late:
+                continue
+
+            frames = sys._current_frames()
+            for thread, call in late:
+                frame = frames.get(thread)
+                if frame is not None:
+                    call.stack = traceback.format_stack(frame)
+
+    def _sample(self, window):
+        me = threading.get_ident()
+
+        while self.window is window:
+            with self.lock:
+                methods = {thread: call.method for thread, call in self.calls.items()}
+
+            for thread, frame in sys._current_frames().items():
+                if thread == me or frame.f_code.co_name in IDLE_FUNCTIONS:
+                    continue
+                if window.methods is not None and not methods.get(thread) in window.methods:
+                    continue
+                window.add_sample(frame)
+
+            time.sleep(SAMPLE_INTERVAL)
+
+    # Must be called with the lock held.
+    def _update(self):
+        self.enabled = self.window is not None or self.slow_threshold is not None
+
+
+"""
+One profiling window and the results collected so far.
+"""
+class ProfileWindow:
+    def __init__(self, mode, methods, path):
+        self.mode = mode
+        self.methods = None if methods is None else set(methods)
+        self.path = path
+        # Ends the window when its time is up.
+        self.timer = None
+        self.stats = None
+        # Number of samples of each collapsed stack.
+        self.stacks = {}
+        self.lock = threading.Lock()
+
+    def includes(self, method):
+        return self.methods is None or method in self.methods
+
+    def add(self, profile):
+        with self.lock:
+            if self.stats is None:
+                self.stats = pstats.Stats(profile)
+            else:
+                self.stats.add(profile)
+
+    def add_sample(self, frame):
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append("%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+            frame = frame.f_back
+
+        stack = ";".join(reversed(names))
+        with self.lock:
+            self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+    def write(self):
+        with self.lock:
+            if self.mode == "cprofile":
+                if self.stats is None:
+                    # Nothing matched, so write an empty profile.
+                    profile = cProfile.Profile()
+                    profile.enable()
+                    profile.disable()
+                    self.stats = pstats.Stats(profile)
+                self.stats.dump_stats(self.path)
+            else:
+                with open(self.path, "w") as f:
+                    for stack, count in sorted(self.stacks.items()):
+                        f.write("%s %d\n" % (stack, count))
+
+
+"""
+An RPC call in progress.
+"""
+class Call:
+    __slots__ = ("method", "params", "start", "stack")
+
+    def __init__(self, method, params):
+        self.method = method
+        self.params = params
+        self.start = time.perf_counter()
+        # Stack snapshot taken once the call became slow.
+        self.stack = None
+
+
+"""
+Checks if a profiler is running, in the whole process where cProfile is
+process-wide, or else in the calling thread.
+"""
+def _profiler_active():
+    if CPROFILE_PROCESS_WIDE:
+        return sys.monitoring.get_tool(sys.monitoring.PROFILER_ID) is not None
+    return sys.getprofile() is not None
+
+
+"""
+Gets a rough size for a parameter value: the length of strings and
+containers, and 1 for anything else.
+"""
+def _size(value):
+    try:
+        return len(value)
+    except TypeError:
+        return 1
+
+
+profiler = Profiler()
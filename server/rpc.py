@@ -1,27 +1,102 @@
-import json
+from server import (encoding, framing, metrics, profiling, workers)
+from collections import deque
+import itertools
 import logging
+import select
 import socket
 import threading
+import time
 
 
 """
-Exception thrown if the peer sends an error.
+Pool that runs incoming requests for every channel. Replace it before opening
+any connections to change its size or overload policy.
+"""
+pool = workers.WorkerPool()
+
+
+"""
+JSON-RPC error code returned when a request is rejected because the server is
+overloaded.
+"""
+SERVER_BUSY = -32000
+
+"""
+JSON-RPC error code returned for messages that are not valid requests.
+"""
+INVALID_REQUEST = -32600
+
+"""
+JSON-RPC error code returned when a method is called with invalid parameters.
+"""
+INVALID_PARAMS = -32602
+
+"""
+Methods handled by the channel itself rather than the handler.
+"""
+BUILTIN_METHODS = ("close", "rpc.ordered", "rpc.hello", "rpc.framing")
+
+
+"""
+Exception thrown if the peer sends an error. Handlers can raise it with an
+error code and message to answer with that error.
 """
 class RpcException(Exception):
     pass
 
 
+"""
+Largest frame accepted from a peer. Replace it before opening any connections
+to change it.
+"""
+max_frame_size = framing.MAX_FRAME_SIZE
+
+"""
+Size in bytes above which outgoing payloads are compressed, on connections that
+negotiated compression.
+"""
+compression_threshold = encoding.COMPRESSION_THRESHOLD
+
+"""
+Limits on the data queued for a peer that is not reading it fast enough, in
+bytes and in messages. A message is always accepted when nothing is queued, so
+a single large message never counts as falling behind. Replace them before
+opening any connections to change them; None means no limit.
+"""
+max_outbound_bytes = 8 * 1024 * 1024
+max_outbound_messages = 4096
+
+"""
+What to do when a peer's outbound queue is full.
+
+"drop" first discards queued messages that are sent as droppable, like presence
+updates, and disconnects the peer only if that does not make enough room.
+"disconnect" disconnects the peer straight away. Droppable messages that do
+not fit are always discarded.
+"""
+SLOW_CONSUMER_POLICIES = ("drop", "disconnect")
+slow_consumer = "drop"
+
+
 """
 Connects to a remote RPC peer.
+
+If negotiate is true, agrees on the fastest framing, codec and compression
+that both peers support right away. Peers that do not support negotiation raise
+an RpcException.
 """
-def connect(address, port, handler, timeout=5):
+def connect(address, port, handler, timeout=5, negotiate=False):
     connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     connection.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
     connection.settimeout(timeout)
     connection.connect((address, port))
 
     listener = Listener(connection)
-    return Proxy(listener, handler)
+    proxy = Proxy(listener, handler)
+    if negotiate:
+        proxy.hello()
+    return proxy
 
 
 """
@@ -41,7 +116,7 @@ class Proxy:
         self.listener = listener
         self.listener.handler = handler(self) # Instantiate the handler class
         self.listener.start()
-        self.id_counter = 0
+        self.ids = itertools.count()
 
     """
     Gets the name of the remote peer as a tuple of the address and port.
@@ -53,22 +128,90 @@ class Proxy:
     Calls a method on the peer.
     """
     def invoke(self, name, params = {}):
-        request = {
-            "jsonrpc": "2.0",
-            "method": name,
-            "params": params,
-            "id": self.id_counter
-        }
-        self.id_counter += 1
+        request = self._request(name, params)
 
-        # Send the request and then read the response.
+        # Send the request and then read the response. The reply can arrive
+        # before send() returns, so start waiting for it first.
+        self.listener.expect(request["id"])
         self.listener.send(request)
         response = self.listener.receive_and_wait(request["id"])
 
-        if "error" in response:
-            raise RpcException(response["error"]["code"], response["error"]["message"])
+        return _result(response)
+
+    """
+    Sends a notification to the peer, which calls a method without waiting for
+    or getting a response. A droppable notification may be discarded if the
+    peer is falling behind.
+    """
+    def notify(self, name, params = {}, droppable=False):
+        self.listener.send({
+            "jsonrpc": "2.0",
+            "method": name,
+            "params": params
+        }, droppable)
+
+    """
+    Starts a batch of calls that are sent to the peer together.
+
+    Use the returned object as a context manager, and call methods on it in the
+    same way as on the proxy. Each call returns a BatchCall, whose result can
+    be read once the with block has ended. The whole batch takes a single
+    round trip:
 
-        return response["result"]
+        with proxy.batch() as batch:
+            friends = batch.get_friends(token=token)
+            groups = batch.get_groups(token=token)
+        print(friends.result(), groups.result())
+    """
+    def batch(self):
+        return Batch(self)
+
+    """
+    Negotiates the wire format with the peer: the framing, the codec used for
+    payloads, and payload compression. Codecs and compressors are given as
+    lists of names, most preferred first, and default to everything available
+    here. Returns the format the peer chose.
+
+    No other messages are sent until the peer has answered, since the peer
+    starts reading frames the new way as soon as it has read the request.
+    """
+    def hello(self, framing=framing.LENGTH, codecs=None, compression=None):
+        request = self._request("rpc.hello", {
+            "framing": framing,
+            "codecs": encoding.PREFERRED_CODECS if codecs is None else codecs,
+            "compression": encoding.PREFERRED_COMPRESSORS if compression is None else compression
+        })
+        listener = self.listener
+
+        with listener.frame_lock:
+            listener.expect(request["id"])
+            listener.format_requests.add(request["id"])
+            listener._send_framed(request)
+
+            try:
+                result = _result(listener.receive_and_wait(request["id"]))
+            finally:
+                listener.format_requests.discard(request["id"])
+
+            # The peer answered in the old format and switched right after.
+            listener._set_write_format(result)
+
+        return result
+
+    """
+    Switches the connection to a different framing, such as length prefixes,
+    keeping the current codec and compression.
+    """
+    def set_framing(self, name):
+        return self.hello(name, [self.listener.codec.name], [])["framing"]
+
+    def _request(self, name, params):
+        return {
+            "jsonrpc": "2.0",
+            "method": name,
+            "params": params,
+            "id": next(self.ids)
+        }
 
     """
     Informs the peer that the connection is closing and then closes the socket.
@@ -88,29 +231,145 @@ class Proxy:
 
 
 """
-Wrapper around a socket that provides message parsing, writing, and background
-reading.
+A group of calls sent to the peer as one JSON-RPC batch. See Proxy.batch().
+"""
+class Batch:
+    def __init__(self, proxy):
+        self.proxy = proxy
+        self.calls = []
+
+    """
+    Adds a call to the batch.
+    """
+    def invoke(self, name, params = {}):
+        call = BatchCall(self.proxy._request(name, params))
+        self.calls.append(call)
+        return call
+
+    """
+    Sends every call in the batch and waits for all of the responses.
+    """
+    def send(self):
+        if not self.calls:
+            return
+
+        listener = self.proxy.listener
+        for call in self.calls:
+            listener.expect(call.request["id"])
+        listener.send([call.request for call in self.calls])
+
+        for call in self.calls:
+            call.response = listener.receive_and_wait(call.request["id"])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.send()
+
+    def __getattr__(self, name):
+        def closure(**kwargs):
+            return self.invoke(name, kwargs)
+
+        return closure
+
 
-Uses a dedicated thread for reading and handling incoming messages from the
-remote peer.
 """
-class Listener(threading.Thread):
+A call in a batch, holding its response once the batch has been sent.
+"""
+class BatchCall:
+    def __init__(self, request):
+        self.request = request
+        self.response = None
+
     """
-    Creates a new listener for a given socket.
+    Gets the result of the call, or raises an RpcException if it failed.
     """
-    def __init__(self, socket, timeout = 1.0, bufsize = 4096):
-        threading.Thread.__init__(self)
+    def result(self):
+        if self.response is None:
+            raise Exception("Batch has not been sent yet")
+        return _result(self.response)
+
+
+"""
+Gets the result out of a response, raising an exception if it is an error.
+"""
+def _result(response):
+    if "error" in response:
+        raise RpcException(response["error"]["code"], response["error"]["message"])
+
+    return response["result"]
+
 
+"""
+Protocol state shared by every transport.
+
+A channel matches responses to pending requests, parses incoming frames,
+serializes outgoing messages and dispatches requests to the handler. Transports
+subclass it, read into the frame decoder and call _process_frames(), and
+provide _write(), close() and close_later().
+
+Outgoing frames are queued per channel and written without blocking the
+sender, so a peer that stops reading only holds up its own messages. The queue
+is bounded by max_outbound_bytes and max_outbound_messages, and the
+slow_consumer policy decides what happens when it is full.
+
+Frames start out delimited and hold uncompressed JSON. A peer can call
+"rpc.hello" to agree on another framing, codec and compression for both
+directions: the reply is sent in the old format and every frame after the
+request and the reply uses the new one.
+
+Requests run on the shared worker pool. By default a channel's requests run one
+at a time in the order they arrived; a peer can call "rpc.ordered" with
+ordered=false to let them run concurrently instead. The requests in a batch
+always run concurrently, and their responses are sent back together once they
+have all finished.
+"""
+class Channel:
+    # Whether _dispatch() may block the reading side while the pool is full.
+    blocking = True
+
+    def __init__(self):
         self.message_buffer = {}
         self.message_events = {}
         self.open = False
-        self.socket = socket
-        self.write_lock = threading.Lock()
         self.handler = None
-        self.bufsize = bufsize
+        self.address = None
+        self.decoder = framing.FrameDecoder(max_frame_size)
+        # Format of outgoing frames, which only changes while holding
+        # frame_lock, so frames are never written in the wrong format.
+        self.framing = framing.DELIMITED
+        self.codec = encoding.JSON
+        self.compression = None
+        self.frame_lock = threading.Lock()
+        # Frames waiting to be written, as [data, droppable] pairs, guarded
+        # by the write lock.
+        self.write_lock = threading.Lock()
+        self.outbound = deque()
+        self.outbound_bytes = 0
+        self.max_outbound_bytes = max_outbound_bytes
+        self.max_outbound_messages = max_outbound_messages
+        # When the peer stopped keeping up with writes, or None if it is.
+        self.stalled_since = None
+        # Format of incoming frames. The framing is kept by the decoder.
+        self.read_codec = encoding.JSON
+        self.read_compression = None
+        # IDs of our format negotiation requests that have not been answered.
+        self.format_requests = set()
+        self.strand = workers.Strand()
+        self.ordered = True
+        # Traffic on this connection, in bytes.
+        self.bytes_in = 0
+        self.bytes_out = 0
+        metrics.registry.opened(self)
 
-        socket.settimeout(timeout)
-        self.address = socket.getpeername()
+    """
+    Registers interest in a message with a given ID, so that it is kept if it
+    arrives before receive_and_wait() is called.
+    """
+    def expect(self, id):
+        self.message_events[id] = threading.Event()
 
     """
     Receives a message with a given ID, waiting until it arrives.
@@ -118,7 +377,8 @@ class Listener(threading.Thread):
     Returns the message as a dictionary.
     """
     def receive_and_wait(self, id, timeout=5.0):
-        self.message_events[id] = threading.Event()
+        if not id in self.message_events:
+            self.expect(id)
 
         # Block until the item in the buffer is accessible.
         if not self.message_events[id].wait(timeout):
@@ -126,119 +386,319 @@ class Listener(threading.Thread):
             raise Exception("Message timed out")
 
         # Get the message and remove it from the buffer.
-        message = self.message_buffer[id]
         del self.message_events[id]
-        del self.message_buffer[id]
+        if not id in self.message_buffer:
+            raise Exception("Connection closed")
+        message = self.message_buffer.pop(id)
 
         return message
 
     """
-    Sends a message to the peer and waits for the response.
+    Sends a message to the peer. A droppable message may be discarded if the
+    peer is falling behind.
     """
-    def send(self, message):
-        self.write_lock.acquire()
+    def send(self, message, droppable=False):
+        with self.frame_lock:
+            self._send_framed(message, droppable)
+
+    # Must be called with the frame lock held.
+    def _send_framed(self, message, droppable=False):
         logging.info("Sending message to %s", self.address)
 
         # Serialize the message.
-        serialized = json.dumps(message)
-        # Send a packet ending in a magic byte package separator.
-        self.socket.sendall(serialized.encode() + b"\0\0\0\0")
-        self.write_lock.release()
+        payload = self.codec.encode(message)
+
+        if self.compression is not None:
+            if len(payload) >= compression_threshold:
+                payload = encoding.COMPRESSED + self.compression.compress(payload)
+            else:
+                payload = encoding.UNCOMPRESSED + payload
+
+        # Send it as a frame in the current framing.
+        data = framing.frame(payload, self.framing)
+        self.bytes_out += len(data)
+        self._write(data, droppable)
 
     """
-    Runs the listener, which reads from the peer forever until close() is called.
+    Adds a frame to the outbound queue, applying the slow consumer policy if
+    it is full. Returns False if the peer has fallen so far behind that it
+    must be disconnected. Must be called with the write lock held.
     """
-    def run(self):
-        # Set up a local byte buffer.
-        buffer = bytearray()
+    def _enqueue(self, data, droppable):
+        if self.outbound and self._outbound_full(len(data)):
+            if droppable:
+                metrics.registry.record_slow_consumer(self, "dropped")
+                return True
+
+            if slow_consumer == "drop":
+                self._drop_droppable()
+            if self.outbound and self._outbound_full(len(data)):
+                logging.warning("Disconnecting %s, which is not reading its messages", self.address)
+                metrics.registry.record_slow_consumer(self, "disconnected")
+                return False
+
+        self.outbound.append([data, droppable])
+        self.outbound_bytes += len(data)
+        return True
+
+    def _outbound_full(self, size):
+        return ((self.max_outbound_bytes is not None and self.outbound_bytes + size > self.max_outbound_bytes) or
+            (self.max_outbound_messages is not None and len(self.outbound) >= self.max_outbound_messages))
+
+    # Must be called with the write lock held. Keeps the first frame, which
+    # may be partly written already.
+    def _drop_droppable(self):
+        kept = deque([self.outbound.popleft()])
+        for entry in self.outbound:
+            if entry[1]:
+                self.outbound_bytes -= len(entry[0])
+                metrics.registry.record_slow_consumer(self, "dropped")
+            else:
+                kept.append(entry)
+        self.outbound = kept
 
-        # Read forever until we are told to close.
-        self.open = True
-        while self.open:
-            # Read some data from the peer when it arrives.
-            try:
-                packet = self.socket.recv(self.bufsize)
-                buffer.extend(packet)
-            except socket.timeout:
-                continue
-            except (ConnectionError, OSError):
-                self.close()
-                break
+    """
+    Wakes everyone waiting for a reply once the connection has closed, and
+    discards anything still queued for the peer.
+    """
+    def _closed(self):
+        with self.write_lock:
+            self.outbound.clear()
+            self.outbound_bytes = 0
+            self.stalled_since = None
 
-            if len(packet) == 0:
-                self.close()
-                break
+        for event in list(self.message_events.values()):
+            event.set()
+        metrics.registry.closed(self)
+
+    """
+    Handles every complete message that has been read into the frame decoder.
+    Raises a FrameException if the peer sent a bad frame.
+    """
+    def _process_frames(self):
+        for frame in self.decoder.frames():
+            if self.read_compression is not None:
+                if frame[:1] == encoding.COMPRESSED:
+                    frame = self.read_compression.decompress(frame[1:], self.decoder.max_frame_size)
+                else:
+                    frame = frame[1:]
+
+            # Parse the message.
+            message = self.read_codec.decode(frame)
+            logging.info("Received message from %s", self.address)
+
+            self._receive(message)
+
+    """
+    Handles a single parsed message from the peer.
+    """
+    def _receive(self, message):
+        if isinstance(message, list):
+            self._receive_batch(message)
+        elif not isinstance(message, dict):
+            self.send(_error(None, INVALID_REQUEST, "Invalid request"))
+        elif not "method" in message:
+            # If the message is a response, put it into the shared buffer and alert consumers.
+            # Make sure the ID is valid.
+            if message["id"] is None and "error" in message:
+                logging.warning("Peer %s reported an error: %s", self.address, message["error"].get("message"))
+            elif not message["id"] in self.message_events:
+                logging.warning("Unknown reply ID %s", message["id"])
+            else:
+                # The peer writes in the new format after answering a format
+                # negotiation, so start reading that way before the next frame.
+                if message["id"] in self.format_requests and "result" in message:
+                    self._set_read_format(message["result"])
+
+                self.message_buffer[message["id"]] = message
+                self.message_events[message["id"]].set()
+        elif message["method"] in ("rpc.hello", "rpc.framing"):
+            # Switch format before reading the next frame.
+            self._negotiate(message)
+        else:
+            # The message is a request, so queue it to be handled.
+            self._dispatch(message)
+
+    """
+    Handles a request from the peer to change the wire format.
+
+    Picks the first codec and compressor in the peer's lists that are available
+    here. Binary codecs and compression are only used with length-prefixed
+    framing, since their payloads may contain the frame delimiter. The older
+    "rpc.framing" request only changes the framing, and is answered with the
+    framing's name.
+    """
+    def _negotiate(self, request):
+        params = request.get("params", {})
+        name = params.get("framing", self.framing)
+        if not name in framing.FRAMINGS:
+            self.send(_error(request.get("id"), 500, "Unknown framing " + str(name)))
+            return
+
+        if request["method"] == "rpc.framing":
+            codec = self.codec.name
+            compression = None if self.compression is None else self.compression.name
+        else:
+            codec = encoding.choose(params.get("codecs", []), encoding.CODECS, encoding.JSON.name)
+            compression = encoding.choose(params.get("compression", []), encoding.COMPRESSORS)
+
+        if name != framing.LENGTH:
+            codec = encoding.JSON.name
+            compression = None
+
+        result = {
+            "framing": name,
+            "codec": codec,
+            "compression": compression,
+            "compression_threshold": compression_threshold
+        }
+
+        with self.frame_lock:
+            self._send_framed({
+                "jsonrpc": "2.0",
+                "id": request.get("id"),
+                "result": name if request["method"] == "rpc.framing" else result
+            })
+            self._set_write_format(result)
+        self._set_read_format(result)
+
+    # Must be called with the frame lock held.
+    def _set_write_format(self, format):
+        self.framing = format["framing"]
+        self.codec = encoding.CODECS[format["codec"]]
+        self.compression = encoding.COMPRESSORS.get(format["compression"])
+
+    def _set_read_format(self, format):
+        self.decoder.framing = format["framing"]
+        self.read_codec = encoding.CODECS[format["codec"]]
+        self.read_compression = encoding.COMPRESSORS.get(format["compression"])
+
+    """
+    Handles a batch, which may contain requests or responses.
+    """
+    def _receive_batch(self, messages):
+        if not messages:
+            self.send(_error(None, INVALID_REQUEST, "Empty batch"))
+            return
+
+        requests = []
+        for message in messages:
+            if isinstance(message, dict) and not "method" in message and "id" in message:
+                self._receive(message)
+            else:
+                requests.append(message)
+
+        if requests:
+            self._dispatch_batch(requests)
 
-            # Look for any complete messages in the buffer.
-            while True:
-                # Look for the "magic string" at the end of each message.
-                pos = buffer.find(b"\0\0\0\0")
-                if pos < 0:
-                    break
-
-                # Slice the correct portion out of the buffer.
-                string = buffer[:pos].decode()
-                del buffer[:pos + 4]
-
-                # Parse the message as JSON.
-                message = json.loads(string)
-                logging.info("Received message from %s", self.address)
-
-                if not "method" in message:
-                    # If the message is a response, put it into the shared buffer and alert consumers.
-                    # Make sure the ID is valid.
-                    if not message["id"] in self.message_events:
-                        logging.warning("Unknown reply ID %d", message["id"])
-                    else:
-                        self.message_buffer[message["id"]] = message
-                        self.message_events[message["id"]].set()
+    """
+    Queues every request in a batch to be handled concurrently.
+    """
+    def _dispatch_batch(self, requests):
+        batch = PendingBatch(len(requests))
+        block = self.blocking and pool.overload == "wait"
+
+        for request in requests:
+            if not isinstance(request, dict) or not "method" in request:
+                self._finish_batch_entry(batch, None, _error(None, INVALID_REQUEST, "Invalid request"))
+            elif not self._submit(lambda request=request: self._finish_batch_entry(batch, request, self._call(request)), None, block):
+                if pool.overload == "shed":
+                    self._finish_batch_entry(batch, request, None)
                 else:
-                    # The message is a request, so handle it now.
-                    threading.Thread(target=lambda: self._handle_request(message)).start()
+                    self._finish_batch_entry(batch, request, _error(request.get("id"), SERVER_BUSY, "Server busy"))
 
-        # Make sure the socket gets closed if we were asked politely to close.
-        self.close()
+    """
+    Records the response to one request in a batch, and sends every response
+    once the last one is in.
+    """
+    def _finish_batch_entry(self, batch, request, response):
+        if not batch.finish(request, response):
+            return
+
+        if batch.responses:
+            self.send(batch.responses)
+        if batch.closing:
+            self.close_later()
 
     """
-    Closes the listener politely whenever the loop runs around next.
+    Queues a request to be handled on the worker pool.
     """
-    def close_later(self):
-        self.open = False
+    def _dispatch(self, request):
+        strand = self.strand if self.ordered else None
+        block = self.blocking and pool.overload == "wait"
+
+        if not self._submit(lambda: self._handle_request(request), strand, block):
+            self._overloaded(request)
 
     """
-    Closes the listener immediately.
+    Submits a task to the worker pool. Returns False if the pool is too busy
+    to accept it.
     """
-    def close(self):
-        self.open = False
-        self.write_lock.acquire()
-        try:
-            self.socket.shutdown(socket.SHUT_RDWR)
-            self.socket.close()
-        except OSError:
-            pass
-        finally:
-            self.write_lock.release()
+    def _submit(self, task, strand, block):
+        return pool.submit(task, strand, block)
+
+    """
+    Called when the worker pool is too busy to accept a request.
+    """
+    def _overloaded(self, request):
+        if pool.overload == "busy":
+            self.send(_error(request.get("id"), SERVER_BUSY, "Server busy"))
+        else:
+            logging.warning("Dropped request from %s, server is overloaded", self.address)
 
     def _handle_request(self, request):
+        response = self._call(request)
+
+        # Send back a response to the peer.
+        if response is not None:
+            self.send(response)
+
+        # If the method is "close", close the connection once we reply.
+        if request["method"] == "close":
+            self.close_later()
+
+    """
+    Runs a request and returns the response, or None if the request is a
+    notification, which gets no response.
+    """
+    def _call(self, request):
+        if not isinstance(request["method"], str):
+            if not "id" in request:
+                return None
+            return _error(request["id"], INVALID_REQUEST, "Invalid request")
+
         response = {
             "jsonrpc": "2.0",
-            "id": request["id"]
+            "id": request.get("id")
         }
+        start = time.perf_counter()
 
         # Attempt to invoke the requested method.
         try:
-            # If the method is "close", close the connection.
             if request["method"] == "close":
-                self.close_later()
                 response["result"] = True
 
+            # Lets the peer choose whether its requests are run in order.
+            elif request["method"] == "rpc.ordered":
+                self.ordered = bool(request["params"]["ordered"])
+                response["result"] = self.ordered
+
             # For any other method, invoke it on the handler.
             else:
                 func = getattr(self.handler, request["method"])
-                args = request["params"]
-                return_val = func(**args)
+                args = request.get("params", {})
+                if profiling.profiler.enabled:
+                    return_val = profiling.profiler.call(request["method"], func, args)
+                else:
+                    return_val = func(**args)
 
                 response["result"] = return_val
+        except RpcException as e:
+            (code, message) = e.args
+            response["error"] = {
+                "code": code,
+                "message": message
+            }
         except Exception as e:
             # Method errored, so respond with an error instead.
             response["error"] = {
@@ -246,8 +706,215 @@ class Listener(threading.Thread):
                 "message": str(e)
             }
 
-        # Send back a response to the peer.
-        self.send(response)
+        # Unknown methods are counted together, so peers cannot add metrics.
+        method = request["method"]
+        if not method in BUILTIN_METHODS and not hasattr(self.handler, method):
+            method = "unknown"
+        metrics.registry.record_call(method, time.perf_counter() - start, "error" in response)
+
+        if not "id" in request:
+            return None
+        return response
+
+
+"""
+Collects the responses to a batch of requests as they finish.
+"""
+class PendingBatch:
+    def __init__(self, size):
+        self.remaining = size
+        self.responses = []
+        self.closing = False
+        self.lock = threading.Lock()
+
+    """
+    Records a response, which may be None. Returns True once every request in
+    the batch has finished.
+    """
+    def finish(self, request, response):
+        with self.lock:
+            if response is not None:
+                self.responses.append(response)
+            if request is not None and request["method"] == "close":
+                self.closing = True
+
+            self.remaining -= 1
+            return self.remaining == 0
+
+
+"""
+Creates an error response.
+"""
+def _error(id, code, message):
+    return {
+        "jsonrpc": "2.0",
+        "id": id,
+        "error": {
+            "code": code,
+            "message": message
+        }
+    }
+
+
+"""
+Wrapper around a socket that provides message parsing, writing, and background
+reading.
+
+Uses a dedicated thread for reading and handling incoming messages from the
+remote peer. The socket is non-blocking: senders write what the socket takes
+straight away, and if the peer is not keeping up, a writer thread is started to
+send the rest as the peer reads it, and exits once the queue is empty.
+"""
+class Listener(Channel, threading.Thread):
+    """
+    Creates a new listener for a given socket.
+    """
+    def __init__(self, socket, timeout = 1.0):
+        Channel.__init__(self)
+        threading.Thread.__init__(self)
+
+        self.socket = socket
+        self.timeout = timeout
+        # Bytes of the first queued frame that have been written already.
+        self.written = 0
+        self.writer = None
+        self.closed = False
+
+        socket.setblocking(False)
+        self.address = socket.getpeername()
+
+    """
+    Queues raw bytes to be written to the socket, and writes as much as it
+    takes without blocking.
+    """
+    def _write(self, data, droppable=False):
+        with self.write_lock:
+            if not self._enqueue(data, droppable):
+                disconnect = True
+            else:
+                disconnect = False
+                if self.writer is None:
+                    disconnect = not self._write_queued()
+                    if self.outbound and not disconnect:
+                        self.stalled_since = time.time()
+                        self.writer = threading.Thread(target=self._write_in_background, daemon=True)
+                        self.writer.start()
+
+        if disconnect:
+            self.close()
+
+    """
+    Writes queued frames until the socket is full. Returns False if the
+    connection has failed. Must be called with the write lock held.
+    """
+    def _write_queued(self):
+        while self.outbound:
+            data = self.outbound[0][0]
+            try:
+                sent = self.socket.send(memoryview(data)[self.written:])
+            except BlockingIOError:
+                return True
+            except OSError:
+                return False
+
+            self.written += sent
+            self.outbound_bytes -= sent
+            if self.written == len(data):
+                self.outbound.popleft()
+                self.written = 0
+
+        self.stalled_since = None
+        return True
+
+    def _write_in_background(self):
+        poller = select.poll()
+        poller.register(self.socket, select.POLLOUT)
+
+        while True:
+            try:
+                poller.poll(self.timeout * 1000)
+            except (OSError, ValueError):
+                return
+
+            with self.write_lock:
+                if self.closed:
+                    self.writer = None
+                    return
+
+                if not self._write_queued():
+                    self.writer = None
+                    failed = True
+                elif not self.outbound:
+                    self.writer = None
+                    return
+                else:
+                    failed = False
+
+            if failed:
+                self.close()
+                return
+
+    """
+    Runs the listener, which reads from the peer forever until close() is called.
+    """
+    def run(self):
+        poller = select.poll()
+        poller.register(self.socket, select.POLLIN)
+
+        # Read forever until we are told to close.
+        self.open = True
+        while self.open:
+            # Read some data from the peer when it arrives.
+            try:
+                if not poller.poll(self.timeout * 1000):
+                    continue
+                count = self.socket.recv_into(self.decoder.get_buffer())
+            except BlockingIOError:
+                continue
+            except (ConnectionError, OSError, ValueError):
+                self.close()
+                break
+
+            if count == 0:
+                self.close()
+                break
+
+            self.decoder.buffer_updated(count)
+            self.bytes_in += count
+            try:
+                self._process_frames()
+            except (framing.FrameException, ValueError) as e:
+                logging.warning("Closing connection to %s: %s", self.address, e)
+                self.close()
+                break
+
+        # Make sure the socket gets closed if we were asked politely to close,
+        # after giving the writer a chance to send what is left.
+        deadline = time.time() + self.timeout
+        while not self.closed and self.outbound and time.time() < deadline:
+            time.sleep(0.01)
+        self.close()
+
+    """
+    Closes the listener politely whenever the loop runs around next, once
+    everything queued has been written.
+    """
+    def close_later(self):
+        self.open = False
+
+    """
+    Closes the listener immediately.
+    """
+    def close(self):
+        self.open = False
+        with self.write_lock:
+            self.closed = True
+            try:
+                self.socket.shutdown(socket.SHUT_RDWR)
+                self.socket.close()
+            except OSError:
+                pass
+        self._closed()
 
 
 """
@@ -0,0 +1,124 @@
+from server import metrics
+import array
+import bisect
+import logging
+import os
+import pickle
+import re
+import threading
+import time
+import unicodedata
+
+
+# Runs of letters and digits, which is how SQLite's FTS5 splits text too.
+WORD = re.compile(r"[^\W_]+")
+
+
+"""
+Splits text into search terms: lowercased words with accents removed, so that
+"Café" matches "cafe".
+"""
+def tokenize(text):
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return WORD.findall(text)
+
+
+"""
+Inverted index from search terms to the IDs of the messages containing them.
+
+Each term has a posting list of message IDs in increasing order, kept as an
+array of 64-bit integers rather than a list of objects. Messages must be added
+in ID order, which lets a search walk the shortest posting list from newest to
+oldest and look IDs up in the others by bisection, so it only touches the
+messages that could match.
+
+The index is saved to a single file by save() and read back by load(). It
+records the ID after the last message it contains, so that messages stored
+after it was saved, or before a crash, can be added when it is loaded.
+"""
+class SearchIndex:
+    def __init__(self, path):
+        self.path = path
+        self.postings = {}
+        # ID of the next message to be added.
+        self.next_id = 0
+        self.loaded = False
+        self.changed = False
+        self.lock = threading.Lock()
+
+    """
+    Reads the index from its file, if it has one, and then adds the messages
+    it is missing, which messages_since() returns given the ID of the first.
+    """
+    def load(self, messages_since):
+        start = time.perf_counter()
+        try:
+            with open(self.path, "rb") as f:
+                (self.next_id, self.postings) = pickle.load(f)
+        except FileNotFoundError:
+            pass
+
+        for message in messages_since(self.next_id):
+            self.add(message.id, message.text)
+
+        self.loaded = True
+        logging.info("Loaded search index of %d terms in %.3fs", len(self.postings), time.perf_counter() - start)
+
+    """
+    Adds a message to the index. Its ID must be higher than any added before.
+    """
+    def add(self, id, text):
+        with self.lock:
+            for term in set(tokenize(text)):
+                posting = self.postings.get(term)
+                if posting is None:
+                    posting = self.postings[term] = array.array("q")
+                posting.append(id)
+
+            self.next_id = id + 1
+            self.changed = True
+
+    """
+    Yields the IDs of messages containing every term, newest first, starting
+    below before_id if it is given. If within is given, only yields IDs that
+    are also in that sorted sequence.
+    """
+    def search(self, terms, before_id=None, within=None):
+        with self.lock:
+            postings = [self.postings.get(term) for term in set(terms)]
+        if within is not None:
+            postings.append(within)
+        if not postings or any(not posting for posting in postings):
+            return
+
+        postings.sort(key=len)
+        (rarest, others) = (postings[0], postings[1:])
+
+        end = len(rarest) if before_id is None else bisect.bisect_left(rarest, before_id)
+        for i in range(end - 1, -1, -1):
+            id = rarest[i]
+            if all(_contains(posting, id) for posting in others):
+                yield id
+
+    """
+    Writes the index to its file if it has changed since it was loaded.
+    """
+    def save(self):
+        with self.lock:
+            if not self.changed:
+                return
+            data = pickle.dumps((self.next_id, self.postings), pickle.HIGHEST_PROTOCOL)
+            self.changed = False
+
+        start = time.perf_counter()
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, self.path)
+        metrics.registry.record_flush("search", time.perf_counter() - start)
+
+
+def _contains(posting, id):
+    i = bisect.bisect_left(posting, id)
+    return i < len(posting) and posting[i] == id
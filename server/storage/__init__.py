@@ -0,0 +1,279 @@
+from server.modules import messages
+import logging
+
+
+"""
+Storage backends that persist accounts, friends, groups and messages.
+
+Managers validate requests and then read and write through a backend, so the
+same server can keep its data in pickle files or in an SQLite database.
+"""
+
+
+"""
+Names of the available backends, for use with open_backend().
+"""
+BACKENDS = ("files", "sqlite")
+
+
+"""
+Opens the named backend, storing its data in the given directory.
+
+The flush and hot message options only apply to the files backend, which saves
+changes in the background and keeps only recent messages in memory; see
+FileBackend. So does read_only, since opening a files backend otherwise brings
+its files up to date, while SQLite only creates the tables it is missing.
+"""
+def open_backend(name, directory=".", fsync="batch", fsync_interval=0.05, flush_interval=1.0, flush_threshold=100, hot_messages=100000, hot_age=None, read_only=False):
+    if name == "files":
+        from server.storage import files
+        return files.FileBackend(directory, fsync, fsync_interval, flush_interval, flush_threshold, hot_messages, hot_age, read_only)
+    if name == "sqlite":
+        from server.storage import sqlite
+        return sqlite.SqliteBackend(directory, fsync)
+    raise ValueError("Unknown storage backend " + name)
+
+
+"""
+Interface implemented by every storage backend.
+
+Backends must be safe to call from many threads at once. Messages are
+messages.Message records, and conversations are identified by the keys returned
+by messages.conversation_key().
+"""
+class Backend:
+    """
+    Gets an account by username, or None if it does not exist.
+    """
+    def get_account(self, username):
+        raise NotImplementedError()
+
+    """
+    Gets the usernames of every account.
+    """
+    def get_usernames(self):
+        raise NotImplementedError()
+
+    """
+    Stores an account, replacing any account with the same username.
+    """
+    def put_account(self, account):
+        raise NotImplementedError()
+
+    """
+    Deletes an account.
+    """
+    def delete_account(self, username):
+        raise NotImplementedError()
+
+    """
+    Gets the usernames a user has added as friends, in the order they were added.
+    """
+    def get_friends(self, username):
+        raise NotImplementedError()
+
+    """
+    Gets the usernames of the users who have added a user as a friend.
+    """
+    def get_followers(self, username):
+        raise NotImplementedError()
+
+    """
+    Adds a friend for a user. Does nothing if they are already friends.
+    """
+    def add_friend(self, username, friend_username):
+        self.add_friends(username, [friend_username])
+
+    """
+    Removes a friend for a user. Does nothing if they are not friends.
+    """
+    def remove_friend(self, username, friend_username):
+        self.remove_friends(username, [friend_username])
+
+    """
+    Adds several friends for a user at once, skipping any they already have.
+    Returns the usernames that were added.
+    """
+    def add_friends(self, username, friend_usernames):
+        raise NotImplementedError()
+
+    """
+    Removes several friends for a user at once, skipping any they do not have.
+    Returns the usernames that were removed.
+    """
+    def remove_friends(self, username, friend_usernames):
+        raise NotImplementedError()
+
+    """
+    Gets the friends two users have in common, in the order the first user
+    added them.
+    """
+    def get_mutual_friends(self, username1, username2):
+        raise NotImplementedError()
+
+    """
+    Gets the friends of a user's friends who are not the user's friends yet,
+    as dictionaries with the "username" and the number of the user's friends
+    who have them as a friend ("mutual"), most mutual first. Returns at most
+    limit of them if it is not None.
+    """
+    def get_friends_of_friends(self, username, limit=None):
+        raise NotImplementedError()
+
+    """
+    Gets the IDs of every group.
+    """
+    def get_group_ids(self):
+        raise NotImplementedError()
+
+    """
+    Gets the usernames of the members of a group in the order they joined, or
+    None if the group does not exist.
+    """
+    def get_group_users(self, id):
+        raise NotImplementedError()
+
+    """
+    Gets the IDs of the groups a user is in.
+    """
+    def get_user_groups(self, username):
+        raise NotImplementedError()
+
+    """
+    Creates an empty group.
+    """
+    def create_group(self, id):
+        raise NotImplementedError()
+
+    """
+    Deletes a group and its memberships, and removes it from its members'
+    inboxes.
+    """
+    def delete_group(self, id):
+        raise NotImplementedError()
+
+    """
+    Adds a user to a group, and the group to their inbox with its earlier
+    messages read. Does nothing if they are already in it.
+    """
+    def add_group_user(self, id, username):
+        raise NotImplementedError()
+
+    """
+    Removes a user from a group, and the group from their inbox.
+    """
+    def remove_group_user(self, id, username):
+        raise NotImplementedError()
+
+    """
+    Stores a new message in a conversation and returns its ID. If the message's
+    ID is None the next one is assigned; IDs only ever increase.
+    """
+    def add_message(self, message, conversation):
+        raise NotImplementedError()
+
+    """
+    Gets messages in a conversation, oldest first.
+
+    With since_id, gets the oldest messages newer than that ID. Otherwise gets
+    the newest messages older than before_id, or the newest of all if
+    before_id is not given. If limit is None, every matching message is
+    returned.
+    """
+    def get_conversation(self, conversation, before_id=None, since_id=None, limit=None):
+        raise NotImplementedError()
+
+    """
+    Iterates over every message in ID order.
+    """
+    def iter_messages(self):
+        raise NotImplementedError()
+
+    """
+    Finds messages whose text contains every one of the given terms, as split
+    by search.tokenize(), newest first. Only searches the given conversation,
+    or if there is none, the direct conversations of username and the
+    conversations of the given groups. Gets messages older than before_id if
+    it is given, and at most limit if that is not None.
+    """
+    def search_messages(self, terms, username, groups, conversation=None, before_id=None, limit=None):
+        raise NotImplementedError()
+
+    """
+    Records a message just stored in a conversation in the inboxes of the
+    users who have the conversation in theirs: it is their last message, and
+    unread by all of them but its sender. The given users get the conversation
+    added to their inbox first if they do not have it.
+
+    Group members are given the group's conversation by add_group_user(), so
+    only direct conversations need to pass any users.
+    """
+    def update_inbox(self, conversation, message, usernames):
+        raise NotImplementedError()
+
+    """
+    Gets a user's inbox, most recently active conversation first, leaving out
+    conversations without messages. Each entry is a dictionary with the
+    "conversation" key, "last_message", the "read_id" of the last message the
+    user has read (or -1) and the number of "unread" messages.
+    """
+    def get_inbox(self, username):
+        raise NotImplementedError()
+
+    """
+    Marks the messages of a conversation up to and including an ID as read by
+    a user. IDs past the conversation's last message count as that message.
+    Does nothing if they already were read, or the conversation is not in the
+    user's inbox.
+    """
+    def mark_read(self, username, conversation, up_to_id):
+        raise NotImplementedError()
+
+    """
+    Adds a conversation to a user's inbox, or replaces it, with the messages
+    up to and including read_id read.
+    """
+    def put_inbox_entry(self, username, conversation, read_id):
+        raise NotImplementedError()
+
+    """
+    Builds the inboxes of data stored before inboxes were kept, with every
+    message marked as read.
+    """
+    def _rebuild_inbox(self):
+        last_ids = {}
+        for message in self.iter_messages():
+            last_ids[messages.conversation_key(message)] = message.id
+
+        for conversation, last_id in last_ids.items():
+            if conversation[0] == "user":
+                usernames = set(conversation[1:])
+            else:
+                usernames = self.get_group_users(conversation[1]) or []
+
+            for username in usernames:
+                self.put_inbox_entry(username, conversation, last_id)
+
+        # Members of groups without messages need the group in their inbox too.
+        for id in self.get_group_ids():
+            conversation = messages.group_conversation(id)
+            if not conversation in last_ids:
+                for username in self.get_group_users(id):
+                    self.put_inbox_entry(username, conversation, -1)
+
+        if last_ids:
+            logging.info("Built inboxes for %d conversations", len(last_ids))
+
+    """
+    Makes sure everything written so far is on disk and releases resources.
+    """
+    def close(self):
+        pass
+
+
+"""
+Checks that a message ID given by a client is an integer.
+"""
+def validate_message_id(id):
+    if isinstance(id, bool) or not isinstance(id, int):
+        raise Exception("Message ID must be an integer")
@@ -0,0 +1,730 @@
+from server import (log, metrics, search)
+from server.modules import messages
+from server.storage import (Backend, validate_message_id)
+import array
+import bisect
+import heapq
+import logging
+import os
+import pickle
+import threading
+import time
+
+
+# Number of friend changes logged before they are folded into friends.pickle.
+FRIEND_LOG_LIMIT = 100000
+
+# Number of inbox changes logged before they are folded into inbox.pickle. The
+# log may also grow to as many records as there are inbox entries, so that
+# folding it never costs more than the changes it saves.
+INBOX_LOG_LIMIT = 100000
+
+# Number of messages stored before the conversation index is saved again.
+CONVERSATION_INDEX_LIMIT = 100000
+
+# Size of message log segments. Only the last one is read when the backend is
+# opened, so smaller segments make opening faster.
+MESSAGE_SEGMENT_SIZE = 16 * 1024 * 1024
+
+
+"""
+Backend that keeps everything in memory and persists it to files.
+
+Accounts and groups are each pickled to a file of their own. Changes only
+mark a file as dirty; a background thread rewrites dirty files every
+flush_interval seconds, or sooner once a file has flush_threshold unsaved
+changes, and close() writes whatever is left. Files are replaced atomically, so
+a crash leaves either the old or the new version.
+
+The friend graph is kept as sets of friends and of followers (the users who
+have someone as a friend). Changes to it are appended to a log of their own,
+so changing a friend list costs the size of the change rather than of the
+graph; the log is folded into friends.pickle when the backend is opened or
+closed, and whenever it grows past FRIEND_LOG_LIMIT records.
+
+Messages are appended to a log, and each conversation is indexed by the IDs of
+its messages so that reading it does not scan other messages. Only the newest
+messages stored since the backend was opened are kept in memory: the last
+hot_messages of them, and if hot_age is given, only those from the last hot_age
+seconds. Other messages are read from the log when they are needed, so memory
+use depends on the recent traffic rather than on the whole history. The
+conversation index is saved to conversations.pickle when the backend is closed
+and every CONVERSATION_INDEX_LIMIT messages, and only messages stored after
+that need to be read from the log when it is opened.
+
+Inboxes are kept per user: for each conversation, the last message the user has
+read, how many messages there were up to it, and how many the user has sent
+since. The index of a conversation gives its last message and number of
+messages, so a new message only changes its sender's inbox. Like the friend
+graph, changed entries are appended to a log of their own, which is folded into
+inbox.pickle when the backend is opened or closed, and whenever it has grown
+past both INBOX_LOG_LIMIT records and the number of entries.
+
+The search index is only loaded from its file the first time a search is made,
+and is saved when the backend is closed.
+
+A backend opened with read_only never writes to its directory, so that data
+can be copied out of it without changing it. Nothing is flushed, compacted or
+saved, and messages in a messages.pickle file and inboxes that have to be built
+are only kept in memory. It is meant to be read from: storing messages or
+changing friends is an error.
+"""
+class FileBackend(Backend):
+    def __init__(self, directory=".", fsync="batch", fsync_interval=0.05, flush_interval=1.0, flush_threshold=100, hot_messages=100000, hot_age=None, read_only=False):
+        self.directory = directory
+        self.read_only = read_only
+        self.fsync = fsync
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+        self.hot_messages = hot_messages
+        self.hot_age = hot_age
+        # Guards accounts and groups, which are pickled as a whole.
+        self.data_lock = threading.Lock()
+        self.flush_needed = threading.Condition(self.data_lock)
+        # Makes sure snapshots are written in the order they were taken.
+        self.flush_lock = threading.Lock()
+        # Guards the messages in memory and the indexes.
+        self.lock = threading.Lock()
+        self.closed = False
+
+        if not read_only:
+            os.makedirs(directory, exist_ok=True)
+        self.accounts = self._load("accounts.pickle", {})
+        # Members of each group and groups of each user, in dictionaries used
+        # as ordered sets.
+        (self.groups, self.user_map) = self._load("groups.pickle", ({}, {}))
+        if self.groups and isinstance(next(iter(self.groups.values()))["users"], list):
+            self._convert_groups()
+
+        # Number of unsaved changes to each file.
+        self.dirty = {}
+        self.snapshots = {
+            "accounts.pickle": lambda: self.accounts,
+            "groups.pickle": lambda: (self.groups, self.user_map)
+        }
+        self.flusher = threading.Thread(target=self._flush_periodically, daemon=True)
+        self.flusher.start()
+
+        # Friends and followers of each user, in dictionaries used as ordered
+        # sets.
+        self.friends_lock = threading.Lock()
+        self.friends = {}
+        self.followers = {}
+        self._open_friend_log(fsync, fsync_interval)
+
+        # The newest messages by ID, which run from hot_start to the end of the
+        # log.
+        self.hot = {}
+        self.hot_start = 0
+        # Arrays of message IDs keyed by conversation, in order.
+        self.conversations = {}
+        # Number of messages in the saved conversation index.
+        self.conversations_saved = 0
+        # Messages read from a messages.pickle file when read-only.
+        self.legacy_messages = None
+        self._open_log(fsync, fsync_interval)
+        self.search_index = search.SearchIndex(self._path("search.pickle"))
+
+        # [read ID, messages up to it, messages sent since] keyed by username
+        # and conversation.
+        self.inboxes = {}
+        self.inbox_entries = 0
+        self._open_inbox_log(fsync, fsync_interval)
+
+    def get_account(self, username):
+        return self.accounts.get(username)
+
+    def get_usernames(self):
+        return list(self.accounts.keys())
+
+    def put_account(self, account):
+        with self.data_lock:
+            self.accounts[account.username] = account
+            self._changed("accounts.pickle")
+
+    def delete_account(self, username):
+        with self.data_lock:
+            if username in self.accounts:
+                del self.accounts[username]
+                self._changed("accounts.pickle")
+
+    def get_friends(self, username):
+        return list(self.friends.get(username, {}))
+
+    def get_followers(self, username):
+        return list(self.followers.get(username, {}))
+
+    def add_friends(self, username, friend_usernames):
+        with self.friends_lock:
+            friends = self.friends.get(username, {})
+            added = [friend_username for friend_username in dict.fromkeys(friend_usernames) if not friend_username in friends]
+            if added:
+                self.friend_log.append((username, added, []))
+                self._apply_friend_change(username, added, [])
+            return added
+
+    def remove_friends(self, username, friend_usernames):
+        with self.friends_lock:
+            friends = self.friends.get(username, {})
+            removed = [friend_username for friend_username in dict.fromkeys(friend_usernames) if friend_username in friends]
+            if removed:
+                self.friend_log.append((username, [], removed))
+                self._apply_friend_change(username, [], removed)
+            return removed
+
+    def get_mutual_friends(self, username1, username2):
+        with self.friends_lock:
+            friends = self.friends.get(username1, {})
+            others = self.friends.get(username2, {})
+            return [friend_username for friend_username in friends if friend_username in others]
+
+    def get_friends_of_friends(self, username, limit=None):
+        counts = {}
+        with self.friends_lock:
+            friends = self.friends.get(username, {})
+            for friend_username in friends:
+                for candidate in self.friends.get(friend_username, {}):
+                    if candidate != username and not candidate in friends:
+                        counts[candidate] = counts.get(candidate, 0) + 1
+
+        ranked = sorted(counts.items(), key=lambda item: (-item[1], item[0]))
+        if limit is not None:
+            ranked = ranked[:limit]
+        return [{"username": candidate, "mutual": count} for candidate, count in ranked]
+
+    def get_group_ids(self):
+        return list(self.groups.keys())
+
+    def get_group_users(self, id):
+        if not id in self.groups:
+            return None
+        return list(self.groups[id]["users"])
+
+    def get_user_groups(self, username):
+        return list(self.user_map.get(username, {}))
+
+    def create_group(self, id):
+        with self.data_lock:
+            self.groups[id] = {
+                "id": id,
+                "users": {}
+            }
+
+            self._changed("groups.pickle")
+
+    def delete_group(self, id):
+        conversation = messages.group_conversation(id)
+        with self.data_lock:
+            for username in self.groups[id]["users"]:
+                del self.user_map[username][id]
+                self._put_inbox_entry(username, conversation, None)
+            del self.groups[id]
+
+            self._changed("groups.pickle")
+
+    def add_group_user(self, id, username):
+        with self.data_lock:
+            users = self.groups[id]["users"]
+            if username in users:
+                return
+            users[username] = None
+
+            if username in self.user_map:
+                self.user_map[username][id] = None
+            else:
+                self.user_map[username] = {id: None}
+
+            # Earlier messages in the group count as read.
+            conversation = messages.group_conversation(id)
+            ids = self.conversations.get(conversation)
+            self._set_read(username, conversation, ids[-1] if ids else -1)
+
+            self._changed("groups.pickle")
+
+    def remove_group_user(self, id, username):
+        with self.data_lock:
+            self.groups[id]["users"].pop(username, None)
+            self.user_map.get(username, {}).pop(id, None)
+            self._put_inbox_entry(username, messages.group_conversation(id), None)
+
+            self._changed("groups.pickle")
+
+    def add_message(self, message, conversation):
+        # Assign the next ID and write the message to the log together, so IDs
+        # match positions in the log.
+        with self.lock:
+            if message.id is None:
+                message.id = self.log.count
+            elif message.id != self.log.count:
+                raise Exception("Message IDs must be consecutive")
+            self.log.append(_record(message))
+            self.hot[message.id] = message
+            self._evict()
+            self._index(message, conversation)
+            # Until the index is loaded, new messages are added when it is.
+            if self.search_index.loaded:
+                self.search_index.add(message.id, message.text)
+
+        return message.id
+
+    def get_conversation(self, conversation, before_id=None, since_id=None, limit=None):
+        ids = self.conversations.get(conversation, [])
+
+        if since_id is not None:
+            start = bisect.bisect_right(ids, since_id)
+            end = len(ids) if limit is None else min(start + limit, len(ids))
+        else:
+            end = len(ids) if before_id is None else bisect.bisect_left(ids, before_id)
+            start = 0 if limit is None else max(end - limit, 0)
+
+        return [self._get_message(id) for id in ids[start:end]]
+
+    def iter_messages(self):
+        if self.legacy_messages is not None:
+            return iter(self.legacy_messages)
+        return _messages(self.log.scan())
+
+    def search_messages(self, terms, username, groups, conversation=None, before_id=None, limit=None):
+        index = self._get_search_index()
+        if conversation is not None:
+            conversations = [conversation]
+        else:
+            # Only the user's own conversations are searched, so that messages
+            # of others are never read. Direct conversations are never removed
+            # from inboxes, so the user's inbox has every one of them.
+            with self.data_lock:
+                conversations = [key for key in self.inboxes.get(username, {}) if key[0] == "user"]
+            conversations += [messages.group_conversation(id) for id in groups]
+
+        # Each search yields the matches in one conversation, newest first.
+        searches = []
+        for key in conversations:
+            ids = self.conversations.get(key)
+            if ids:
+                searches.append(index.search(terms, before_id, ids))
+
+        results = []
+        for id in heapq.merge(*searches, reverse=True):
+            results.append(self._get_message(id))
+            if limit is not None and len(results) >= limit:
+                break
+
+        return results
+
+    def update_inbox(self, conversation, message, usernames):
+        with self.data_lock:
+            for username in usernames:
+                if not conversation in self.inboxes.get(username, {}):
+                    self._put_inbox_entry(username, conversation, [-1, 0, 0])
+
+            entry = self.inboxes.get(message.sender, {}).get(conversation)
+            if entry is not None:
+                self._put_inbox_entry(message.sender, conversation, [entry[0], entry[1], entry[2] + 1])
+
+    def get_inbox(self, username):
+        entries = []
+        with self.data_lock:
+            for conversation, (read_id, read_count, sent) in self.inboxes.get(username, {}).items():
+                ids = self.conversations.get(conversation)
+                if ids:
+                    entries.append((conversation, ids[-1], read_id, len(ids) - read_count - sent))
+
+        entries.sort(key=lambda entry: entry[1], reverse=True)
+        return [
+            {
+                "conversation": conversation,
+                "last_message": self._get_message(last_id),
+                "read_id": read_id,
+                # Can be briefly off while a message is being sent.
+                "unread": max(unread, 0)
+            }
+            for conversation, last_id, read_id, unread in entries
+        ]
+
+    def mark_read(self, username, conversation, up_to_id):
+        validate_message_id(up_to_id)
+        with self.data_lock:
+            entry = self.inboxes.get(username, {}).get(conversation)
+            if entry is None:
+                return
+            # Messages that have not been sent yet cannot have been read.
+            ids = self.conversations.get(conversation)
+            up_to_id = min(up_to_id, ids[-1] if ids else -1)
+            if up_to_id <= entry[0]:
+                return
+
+            self._set_read(username, conversation, up_to_id)
+
+    def put_inbox_entry(self, username, conversation, read_id):
+        with self.data_lock:
+            self._set_read(username, conversation, read_id)
+
+    """
+    Writes every dirty file now.
+    """
+    def flush(self):
+        if self.read_only:
+            return
+
+        with self.flush_lock:
+            # Take consistent snapshots, then write them without blocking
+            # further changes.
+            with self.data_lock:
+                snapshots = [(name, pickle.dumps(self.snapshots[name](), pickle.HIGHEST_PROTOCOL)) for name in self.dirty]
+                self.dirty = {}
+
+            for name, data in snapshots:
+                start = time.perf_counter()
+                self._write_atomically(name, data)
+                metrics.registry.record_flush(name, time.perf_counter() - start)
+
+        if self.friend_log.count >= FRIEND_LOG_LIMIT:
+            self._compact_friend_log()
+        if self.inbox_log.count >= max(INBOX_LOG_LIMIT, self.inbox_entries):
+            self._compact_inbox_log()
+        if self.log.count - self.conversations_saved >= CONVERSATION_INDEX_LIMIT:
+            self._save_conversations()
+
+        # Messages also age out of memory when none are being stored.
+        if self.hot_age is not None:
+            with self.lock:
+                self._evict()
+
+    def close(self):
+        with self.data_lock:
+            self.closed = True
+            self.flush_needed.notify()
+        self.flusher.join()
+
+        if self.read_only:
+            self.friend_log.close()
+            self.inbox_log.close()
+            self.log.close()
+            return
+
+        self.flush()
+        self._compact_friend_log()
+        self.friend_log.close()
+        self._compact_inbox_log()
+        self.inbox_log.close()
+        self._save_conversations()
+        self.log.close()
+        if self.search_index.loaded:
+            self.search_index.save()
+
+    """
+    Gets the search index, loading it first if this is the first search, and
+    adding any messages it is missing.
+    """
+    def _get_search_index(self):
+        if self.search_index.loaded:
+            return self.search_index
+
+        with self.lock:
+            if not self.search_index.loaded:
+                self.search_index.load(lambda id: _messages(self.log.scan(id)))
+        return self.search_index
+
+    """
+    Sets the last message a user has read in a conversation, adding it to
+    their inbox if needed, and counts the messages up to it and the user's own
+    messages after it. Must be called with the data lock held.
+    """
+    def _set_read(self, username, conversation, read_id):
+        ids = self.conversations.get(conversation, [])
+        read_count = bisect.bisect_right(ids, read_id)
+        sent = sum(1 for id in ids[read_count:] if self._get_message(id).sender == username)
+        self._put_inbox_entry(username, conversation, [read_id, read_count, sent])
+
+    """
+    Sets an entry of a user's inbox, or removes it if entry is None, and logs
+    the change. Must be called with the data lock held.
+    """
+    def _put_inbox_entry(self, username, conversation, entry):
+        if entry is None and not conversation in self.inboxes.get(username, {}):
+            return
+
+        if not self.read_only:
+            self.inbox_log.append((username, conversation, entry))
+        self._apply_inbox_change(username, conversation, entry)
+
+    """
+    Sets or removes an inbox entry in memory. Must be called with the data
+    lock held, or before other threads can see the backend.
+    """
+    def _apply_inbox_change(self, username, conversation, entry):
+        inbox = self.inboxes.get(username)
+        if entry is None:
+            if inbox is not None and inbox.pop(conversation, None) is not None:
+                self.inbox_entries -= 1
+            return
+
+        if inbox is None:
+            inbox = self.inboxes[username] = {}
+        if not conversation in inbox:
+            self.inbox_entries += 1
+        inbox[conversation] = entry
+
+    """
+    Loads the inboxes from their last snapshot and the changes logged since,
+    and folds those into a new snapshot. Builds the inboxes if there are
+    neither, for data stored before inboxes were kept.
+    """
+    def _open_inbox_log(self, fsync, fsync_interval):
+        snapshot = self._load("inbox.pickle", None)
+        for username, inbox in (snapshot or {}).items():
+            for conversation, entry in inbox.items():
+                self._apply_inbox_change(username, conversation, entry)
+
+        self.inbox_log = log.Log(self._path("inbox"), fsync, fsync_interval, read_only=self.read_only)
+        # Entries are logged whole, so ones that are also in the snapshot, left
+        # by a crash while compacting, can be applied again.
+        for (username, conversation, entry) in self.inbox_log.replay():
+            self._apply_inbox_change(username, conversation, entry)
+
+        if snapshot is None and self.inbox_log.count == 0:
+            self._rebuild_inbox()
+        if not self.read_only:
+            self._compact_inbox_log(snapshot is None)
+
+    """
+    Writes the inboxes to inbox.pickle and empties the inbox log. Inbox changes
+    wait until this is done, so that none can be lost. The snapshot is written
+    even if nothing has changed when force is true.
+    """
+    def _compact_inbox_log(self, force=False):
+        with self.data_lock:
+            if self.inbox_log.count == 0 and not force:
+                return
+
+            start = time.perf_counter()
+            self._write_atomically("inbox.pickle", pickle.dumps(self.inboxes, pickle.HIGHEST_PROTOCOL))
+            self.inbox_log.reset()
+            metrics.registry.record_flush("inbox.pickle", time.perf_counter() - start)
+
+    """
+    Converts group members and user groups pickled as lists by older versions
+    into ordered sets, dropping duplicate members.
+    """
+    def _convert_groups(self):
+        for group in self.groups.values():
+            group["users"] = dict.fromkeys(group["users"])
+        for username, ids in self.user_map.items():
+            self.user_map[username] = dict.fromkeys(ids)
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _load(self, name, default):
+        try:
+            with open(self._path(name), "rb") as f:
+                return pickle.load(f)
+        except FileNotFoundError:
+            return default
+
+    """
+    Marks a file as changed. Must be called with the data lock held.
+    """
+    def _changed(self, name):
+        self.dirty[name] = self.dirty.get(name, 0) + 1
+        if self.dirty[name] == self.flush_threshold:
+            self.flush_needed.notify()
+
+    """
+    Replaces a file by writing a temporary file and renaming it over the old one.
+    """
+    def _write_atomically(self, name, data):
+        path = self._path(name)
+        temp_path = path + ".tmp"
+
+        with open(temp_path, "wb") as f:
+            f.write(data)
+            if self.fsync != "os":
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(temp_path, path)
+
+        if self.fsync != "os":
+            directory = os.open(self.directory, os.O_RDONLY)
+            try:
+                os.fsync(directory)
+            finally:
+                os.close(directory)
+
+    def _flush_periodically(self):
+        while True:
+            with self.data_lock:
+                self.flush_needed.wait_for(
+                    lambda: self.closed or any(count >= self.flush_threshold for count in self.dirty.values()),
+                    self.flush_interval
+                )
+                if self.closed:
+                    return
+
+            try:
+                self.flush()
+            except OSError:
+                logging.exception("Failed to save data in %s", self.directory)
+
+    """
+    Loads the friend graph from its last snapshot and the changes logged
+    since, and folds those into a new snapshot.
+    """
+    def _open_friend_log(self, fsync, fsync_interval):
+        for username, friends in self._load("friends.pickle", {}).items():
+            self._apply_friend_change(username, friends, [])
+
+        self.friend_log = log.Log(self._path("friends"), fsync, fsync_interval, read_only=self.read_only)
+        # Changes are idempotent, so ones that are also in the snapshot, left
+        # by a crash while compacting, can be applied again.
+        for (username, added, removed) in self.friend_log.replay():
+            self._apply_friend_change(username, added, removed)
+
+        if not self.read_only:
+            self._compact_friend_log()
+
+    """
+    Writes the friend graph to friends.pickle and empties the friend log.
+    Friend changes wait until this is done, so that none can be lost.
+    """
+    def _compact_friend_log(self):
+        with self.friends_lock:
+            if self.friend_log.count == 0:
+                return
+
+            start = time.perf_counter()
+            snapshot = {username: list(friends) for username, friends in self.friends.items() if friends}
+            self._write_atomically("friends.pickle", pickle.dumps(snapshot, pickle.HIGHEST_PROTOCOL))
+            self.friend_log.reset()
+            metrics.registry.record_flush("friends.pickle", time.perf_counter() - start)
+
+    """
+    Adds and removes friends of a user in memory. Must be called with the
+    friends lock held, or before other threads can see the backend.
+    """
+    def _apply_friend_change(self, username, added, removed):
+        friends = self.friends.get(username)
+        if friends is None:
+            friends = self.friends[username] = {}
+
+        for friend_username in added:
+            friends[friend_username] = None
+            followers = self.followers.get(friend_username)
+            if followers is None:
+                followers = self.followers[friend_username] = {}
+            followers[username] = None
+
+        for friend_username in removed:
+            friends.pop(friend_username, None)
+            self.followers.get(friend_username, {}).pop(username, None)
+
+    """
+    Opens the message log and brings the conversation index up to date with
+    it.
+
+    Messages in a messages.pickle file left by older versions are moved into
+    the log the first time it is opened, or only read into memory if the
+    backend is read-only.
+    """
+    def _open_log(self, fsync, fsync_interval):
+        self.log = log.Log(self._path("messages"), fsync, fsync_interval, MESSAGE_SEGMENT_SIZE, self.read_only)
+        self.log.recover()
+
+        legacy_path = self._path("messages.pickle")
+        if self.log.count == 0 and os.path.exists(legacy_path):
+            with open(legacy_path, "rb") as f:
+                legacy_messages = pickle.load(f)
+            if self.read_only:
+                self.legacy_messages = [messages.from_dict(message) for message in legacy_messages]
+                for message in self.legacy_messages:
+                    self.hot[message.id] = message
+                    self._index(message, messages.conversation_key(message))
+                return
+            for message in legacy_messages:
+                self.log.append(_record(messages.from_dict(message)))
+            self.log.sync()
+            os.rename(legacy_path, legacy_path + ".migrated")
+            logging.info("Moved %d messages from %s into the message log", len(legacy_messages), legacy_path)
+
+        (count, self.conversations) = self._load("conversations.pickle", (0, {}))
+        if count > self.log.count:
+            # The log lost messages the index has in a machine crash.
+            logging.warning("Rebuilding the conversation index, which is ahead of the message log")
+            (count, self.conversations) = (0, {})
+        self.conversations_saved = count
+        for message in _messages(self.log.scan(count)):
+            self._index(message, messages.conversation_key(message))
+
+        # Messages stored before opening are read from the log as needed.
+        self.hot_start = self.log.count
+
+    """
+    Adds a message to the index of its conversation.
+    """
+    def _index(self, message, conversation):
+        if conversation in self.conversations:
+            self.conversations[conversation].append(message.id)
+        else:
+            self.conversations[conversation] = array.array("q", [message.id])
+
+    """
+    Gets a message by ID, from memory if it is recent enough and otherwise
+    from the log.
+    """
+    def _get_message(self, id):
+        message = self.hot.get(id)
+        if message is None:
+            message = _message(self.log.read(id))
+        return message
+
+    """
+    Drops the oldest messages from memory while there are more than
+    hot_messages, or they are older than hot_age seconds. Must be called with
+    the lock held.
+    """
+    def _evict(self):
+        cutoff = None if self.hot_age is None else time.time() - self.hot_age
+        while self.hot:
+            if len(self.hot) <= self.hot_messages and (cutoff is None or self.hot[self.hot_start].timestamp >= cutoff):
+                break
+            del self.hot[self.hot_start]
+            self.hot_start += 1
+
+    """
+    Writes the conversation index to conversations.pickle, along with the
+    number of messages it covers.
+    """
+    def _save_conversations(self):
+        with self.flush_lock:
+            with self.lock:
+                count = self.log.count
+                if count == self.conversations_saved:
+                    return
+                data = pickle.dumps((count, self.conversations), pickle.HIGHEST_PROTOCOL)
+
+            start = time.perf_counter()
+            self._write_atomically("conversations.pickle", data)
+            self.conversations_saved = count
+            metrics.registry.record_flush("conversations.pickle", time.perf_counter() - start)
+
+
+"""
+Gets the record a message is written to the log as: a tuple of its fields,
+which pickles smaller than the message itself.
+"""
+def _record(message):
+    return (message.id, message.sender, message.receiver_type, message.receiver, message.timestamp, message.text)
+
+
+"""
+Gets a message from its record in the log. Older versions logged message
+dictionaries.
+"""
+def _message(record):
+    if isinstance(record, dict):
+        return messages.from_dict(record)
+    return messages.Message(*record)
+
+
+def _messages(records):
+    return (_message(record) for record in records)
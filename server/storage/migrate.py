@@ -0,0 +1,81 @@
+from server import storage
+from server.modules import messages
+import argparse
+import array
+import bisect
+import logging
+
+
+"""
+Copies every account, friend connection, group, message and inbox from one
+backend into another.
+
+Messages are numbered again from 0 in the order of their old IDs, since the
+files backend needs consecutive IDs, while SQLite's start from 1 and can have
+gaps. Data written by the files backend keeps its IDs. The last read message
+of each inbox entry is mapped to its new ID.
+
+The destination should be empty, since records that already exist there are
+replaced or duplicated. A files backend source should be opened read-only, so
+that it is left as it was.
+"""
+def migrate(source, destination):
+    usernames = source.get_usernames()
+    for username in usernames:
+        destination.put_account(source.get_account(username))
+    logging.info("Copied %d accounts", len(usernames))
+
+    count = 0
+    for username in usernames:
+        friend_usernames = source.get_friends(username)
+        destination.add_friends(username, friend_usernames)
+        count += len(friend_usernames)
+    logging.info("Copied %d friend connections", count)
+
+    ids = source.get_group_ids()
+    for id in ids:
+        destination.create_group(id)
+        for username in source.get_group_users(id):
+            destination.add_group_user(id, username)
+    logging.info("Copied %d groups", len(ids))
+
+    old_ids = array.array("q")
+    for message in source.iter_messages():
+        old_ids.append(message.id)
+        message.id = len(old_ids) - 1
+        destination.add_message(message, messages.conversation_key(message))
+    logging.info("Copied %d messages", len(old_ids))
+
+    count = 0
+    for username in usernames:
+        for entry in source.get_inbox(username):
+            # The new ID of the last message up to the old read ID.
+            read_id = bisect.bisect_right(old_ids, entry["read_id"]) - 1
+            destination.put_inbox_entry(username, entry["conversation"], read_id)
+            count += 1
+    logging.info("Copied %d inbox entries", count)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Copy chat server data between storage backends")
+    parser.add_argument("source", help="directory to read data from")
+    parser.add_argument("destination", help="directory to write data to")
+    parser.add_argument("--from", dest="source_backend", choices=storage.BACKENDS, default="files",
+        help="backend to read from")
+    parser.add_argument("--to", dest="destination_backend", choices=storage.BACKENDS, default="sqlite",
+        help="backend to write to")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s: %(message)s")
+
+    source = storage.open_backend(args.source_backend, args.source, read_only=True)
+    destination = storage.open_backend(args.destination_backend, args.destination, fsync="os")
+    try:
+        migrate(source, destination)
+    finally:
+        destination.close()
+        source.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,439 @@
+from server import metrics
+from server.modules import (accounts, messages)
+from server.storage import (Backend, validate_message_id)
+import contextlib
+import os
+import sqlite3
+import threading
+import time
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS accounts (
+    username TEXT PRIMARY KEY,
+    password TEXT NOT NULL,
+    first_name TEXT,
+    last_name TEXT,
+    email TEXT,
+    address TEXT
+);
+
+CREATE TABLE IF NOT EXISTS friends (
+    username TEXT NOT NULL,
+    friend TEXT NOT NULL,
+    PRIMARY KEY (username, friend)
+);
+CREATE INDEX IF NOT EXISTS friends_by_friend ON friends (friend, username);
+
+CREATE TABLE IF NOT EXISTS groups (
+    id TEXT PRIMARY KEY
+);
+
+CREATE TABLE IF NOT EXISTS group_members (
+    group_id TEXT NOT NULL,
+    username TEXT NOT NULL,
+    UNIQUE (group_id, username)
+);
+CREATE INDEX IF NOT EXISTS group_members_by_user ON group_members (username, group_id);
+
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    conversation TEXT NOT NULL,
+    sender TEXT NOT NULL,
+    receiver_type TEXT NOT NULL,
+    receiver TEXT NOT NULL,
+    timestamp REAL NOT NULL,
+    text TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_by_conversation ON messages (conversation, id);
+CREATE INDEX IF NOT EXISTS messages_by_conversation_time ON messages (conversation, timestamp);
+
+-- Full-text index of message text, kept up to date by a trigger. Messages are
+-- never changed or deleted, so inserts are all it needs to follow.
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_search USING fts5 (text, content = 'messages', content_rowid = 'id');
+CREATE TRIGGER IF NOT EXISTS messages_search_insert AFTER INSERT ON messages BEGIN
+    INSERT INTO messages_search (rowid, text) VALUES (new.id, new.text);
+END;
+
+-- Last message and number of messages of every conversation.
+CREATE TABLE IF NOT EXISTS conversations (
+    conversation TEXT PRIMARY KEY,
+    last_id INTEGER NOT NULL,
+    count INTEGER NOT NULL
+);
+CREATE TRIGGER IF NOT EXISTS conversations_insert AFTER INSERT ON messages BEGIN
+    INSERT INTO conversations VALUES (new.conversation, new.id, 1)
+        ON CONFLICT (conversation) DO UPDATE SET last_id = MAX(last_id, excluded.last_id), count = count + 1;
+END;
+
+-- For each user and conversation, the last message read, the number of
+-- messages up to it, and the number the user has sent since.
+CREATE TABLE IF NOT EXISTS inbox (
+    username TEXT NOT NULL,
+    conversation TEXT NOT NULL,
+    read_id INTEGER NOT NULL,
+    read_count INTEGER NOT NULL,
+    sent INTEGER NOT NULL,
+    PRIMARY KEY (username, conversation)
+);
+"""
+
+# Separates the parts of a conversation key stored as text.
+KEY_SEPARATOR = "\x1f"
+
+
+"""
+Backend that stores everything in an SQLite database in write-ahead logging
+mode.
+
+Nothing is cached in memory, so the data set can grow past the size of RAM and
+opening the database does not load it. Every thread gets a connection of its
+own; WAL mode lets them read concurrently while one of them writes.
+"""
+class SqliteBackend(Backend):
+    def __init__(self, directory=".", fsync="batch"):
+        self.path = os.path.join(directory, "chat.db")
+        # WAL mode only needs a full sync at checkpoints for durability.
+        self.synchronous = "FULL" if fsync == "always" else "NORMAL"
+        self.local = threading.local()
+        self.connections = []
+        # Guards the list of connections. Connections are opened while the
+        # write lock is held, so they cannot share it.
+        self.connections_lock = threading.Lock()
+        self.write_lock = threading.Lock()
+
+        os.makedirs(directory, exist_ok=True)
+        connection = self._connection()
+        tables = {row[0] for row in connection.execute("SELECT name FROM sqlite_master")}
+        new_database = not "accounts" in tables
+        connection.executescript(SCHEMA)
+
+        # Fill in the tables that databases from older versions do not have.
+        if not new_database and not "messages_search" in tables:
+            with self._transaction() as connection:
+                connection.execute("INSERT INTO messages_search (messages_search) VALUES ('rebuild')")
+        if not new_database and not "conversations" in tables:
+            with self._transaction() as connection:
+                connection.execute("INSERT INTO conversations SELECT conversation, MAX(id), COUNT(*) FROM messages GROUP BY conversation")
+        if not new_database and not "inbox" in tables:
+            self._rebuild_inbox()
+
+    def get_account(self, username):
+        row = self._connection().execute(
+            "SELECT username, password, first_name, last_name, email, address FROM accounts WHERE username = ?",
+            (username,)
+        ).fetchone()
+
+        if row is None:
+            return None
+        return accounts.Account(*row)
+
+    def get_usernames(self):
+        return [row[0] for row in self._connection().execute("SELECT username FROM accounts")]
+
+    def put_account(self, account):
+        self._write(
+            "INSERT OR REPLACE INTO accounts VALUES (?, ?, ?, ?, ?, ?)",
+            (account.username, account.password, account.first_name, account.last_name, account.email, account.address)
+        )
+
+    def delete_account(self, username):
+        self._write("DELETE FROM accounts WHERE username = ?", (username,))
+
+    def get_friends(self, username):
+        rows = self._connection().execute(
+            "SELECT friend FROM friends WHERE username = ? ORDER BY rowid",
+            (username,)
+        )
+        return [row[0] for row in rows]
+
+    def get_followers(self, username):
+        rows = self._connection().execute(
+            "SELECT username FROM friends WHERE friend = ?",
+            (username,)
+        )
+        return [row[0] for row in rows]
+
+    def add_friends(self, username, friend_usernames):
+        added = []
+        with self._transaction() as connection:
+            for friend_username in dict.fromkeys(friend_usernames):
+                cursor = connection.execute("INSERT OR IGNORE INTO friends VALUES (?, ?)", (username, friend_username))
+                if cursor.rowcount:
+                    added.append(friend_username)
+        return added
+
+    def remove_friends(self, username, friend_usernames):
+        removed = []
+        with self._transaction() as connection:
+            for friend_username in dict.fromkeys(friend_usernames):
+                cursor = connection.execute("DELETE FROM friends WHERE username = ? AND friend = ?", (username, friend_username))
+                if cursor.rowcount:
+                    removed.append(friend_username)
+        return removed
+
+    def get_mutual_friends(self, username1, username2):
+        rows = self._connection().execute(
+            "SELECT mine.friend FROM friends AS mine "
+            "JOIN friends AS theirs ON theirs.username = ? AND theirs.friend = mine.friend "
+            "WHERE mine.username = ? ORDER BY mine.rowid",
+            (username2, username1)
+        )
+        return [row[0] for row in rows]
+
+    def get_friends_of_friends(self, username, limit=None):
+        rows = self._connection().execute(
+            "SELECT second.friend, COUNT(*) AS mutual FROM friends AS first "
+            "JOIN friends AS second ON second.username = first.friend "
+            "WHERE first.username = ? AND second.friend != ? "
+            "AND second.friend NOT IN (SELECT friend FROM friends WHERE username = ?) "
+            "GROUP BY second.friend ORDER BY mutual DESC, second.friend LIMIT ?",
+            (username, username, username, -1 if limit is None else limit)
+        )
+        return [{"username": row[0], "mutual": row[1]} for row in rows]
+
+    def get_group_ids(self):
+        return [row[0] for row in self._connection().execute("SELECT id FROM groups")]
+
+    def get_group_users(self, id):
+        connection = self._connection()
+        if connection.execute("SELECT 1 FROM groups WHERE id = ?", (id,)).fetchone() is None:
+            return None
+
+        rows = connection.execute(
+            "SELECT username FROM group_members WHERE group_id = ? ORDER BY rowid",
+            (id,)
+        )
+        return [row[0] for row in rows]
+
+    def get_user_groups(self, username):
+        rows = self._connection().execute(
+            "SELECT group_id FROM group_members WHERE username = ? ORDER BY rowid",
+            (username,)
+        )
+        return [row[0] for row in rows]
+
+    def create_group(self, id):
+        self._write("INSERT INTO groups VALUES (?)", (id,))
+
+    def delete_group(self, id):
+        with self._transaction() as connection:
+            connection.execute(
+                "DELETE FROM inbox WHERE conversation = ? AND username IN (SELECT username FROM group_members WHERE group_id = ?)",
+                (KEY_SEPARATOR.join(messages.group_conversation(id)), id)
+            )
+            connection.execute("DELETE FROM group_members WHERE group_id = ?", (id,))
+            connection.execute("DELETE FROM groups WHERE id = ?", (id,))
+
+    def add_group_user(self, id, username):
+        key = KEY_SEPARATOR.join(messages.group_conversation(id))
+        with self._transaction() as connection:
+            cursor = connection.execute("INSERT OR IGNORE INTO group_members VALUES (?, ?)", (id, username))
+            if cursor.rowcount == 0:
+                return
+
+            # Earlier messages in the group count as read.
+            row = connection.execute("SELECT last_id FROM conversations WHERE conversation = ?", (key,)).fetchone()
+            self._set_read(connection, username, key, -1 if row is None else row[0])
+
+    def remove_group_user(self, id, username):
+        with self._transaction() as connection:
+            connection.execute("DELETE FROM group_members WHERE group_id = ? AND username = ?", (id, username))
+            connection.execute(
+                "DELETE FROM inbox WHERE username = ? AND conversation = ?",
+                (username, KEY_SEPARATOR.join(messages.group_conversation(id)))
+            )
+
+    def add_message(self, message, conversation):
+        # SQLite picks the next ID if none is given.
+        with self._transaction() as connection:
+            cursor = connection.execute(
+                "INSERT INTO messages VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    message.id,
+                    KEY_SEPARATOR.join(conversation),
+                    message.sender,
+                    messages.RECEIVER_TYPES[message.receiver_type],
+                    message.receiver,
+                    message.timestamp,
+                    message.text
+                )
+            )
+
+        message.id = cursor.lastrowid
+        return message.id
+
+    def get_conversation(self, conversation, before_id=None, since_id=None, limit=None):
+        sql = "SELECT id, sender, receiver_type, receiver, timestamp, text FROM messages WHERE conversation = ?"
+        params = [KEY_SEPARATOR.join(conversation)]
+
+        if since_id is not None:
+            sql += " AND id > ? ORDER BY id"
+            params.append(since_id)
+        elif before_id is not None:
+            sql += " AND id < ? ORDER BY id DESC"
+            params.append(before_id)
+        else:
+            sql += " ORDER BY id DESC"
+
+        # A negative limit means no limit.
+        sql += " LIMIT ?"
+        params.append(-1 if limit is None else limit)
+
+        rows = self._connection().execute(sql, params).fetchall()
+        if since_id is None:
+            rows.reverse()
+
+        return [self._message(row) for row in rows]
+
+    def iter_messages(self):
+        rows = self._connection().execute("SELECT id, sender, receiver_type, receiver, timestamp, text FROM messages ORDER BY id")
+        for row in rows:
+            yield self._message(row)
+
+    def search_messages(self, terms, username, groups, conversation=None, before_id=None, limit=None):
+        # Quoted, so that each term is matched as a word rather than parsed
+        # as query syntax; terms next to each other must all match.
+        sql = (
+            "SELECT messages.id, sender, receiver_type, receiver, timestamp, messages.text "
+            "FROM messages_search JOIN messages ON messages.id = messages_search.rowid "
+            "WHERE messages_search MATCH ?"
+        )
+        params = [" ".join('"%s"' % term for term in terms)]
+
+        if conversation is not None:
+            sql += " AND conversation = ?"
+            params.append(KEY_SEPARATOR.join(conversation))
+        else:
+            groups = list(groups)
+            sql += " AND ((receiver_type = 'user' AND (sender = ? OR receiver = ?)) OR (receiver_type = 'group' AND receiver IN (%s)))" % ", ".join("?" * len(groups))
+            params += [username, username] + groups
+
+        if before_id is not None:
+            sql += " AND messages_search.rowid < ?"
+            params.append(before_id)
+
+        sql += " ORDER BY messages_search.rowid DESC LIMIT ?"
+        params.append(-1 if limit is None else limit)
+
+        return [self._message(row) for row in self._connection().execute(sql, params)]
+
+    def update_inbox(self, conversation, message, usernames):
+        key = KEY_SEPARATOR.join(conversation)
+        with self._transaction() as connection:
+            connection.executemany(
+                "INSERT OR IGNORE INTO inbox VALUES (?, ?, -1, 0, 0)",
+                [(username, key) for username in usernames]
+            )
+            connection.execute(
+                "UPDATE inbox SET sent = sent + 1 WHERE username = ? AND conversation = ?",
+                (message.sender, key)
+            )
+
+    def get_inbox(self, username):
+        rows = self._connection().execute(
+            "SELECT inbox.conversation, inbox.read_id, conversations.count - inbox.read_count - inbox.sent, "
+            "messages.id, messages.sender, messages.receiver_type, messages.receiver, messages.timestamp, messages.text "
+            "FROM inbox "
+            "JOIN conversations ON conversations.conversation = inbox.conversation "
+            "JOIN messages ON messages.id = conversations.last_id "
+            "WHERE inbox.username = ? ORDER BY conversations.last_id DESC",
+            (username,)
+        )
+
+        return [
+            {
+                "conversation": tuple(row[0].split(KEY_SEPARATOR)),
+                "last_message": self._message(row[3:]),
+                "read_id": row[1],
+                # Can be briefly off while a message is being sent.
+                "unread": max(row[2], 0)
+            }
+            for row in rows
+        ]
+
+    def mark_read(self, username, conversation, up_to_id):
+        validate_message_id(up_to_id)
+        key = KEY_SEPARATOR.join(conversation)
+        with self._transaction() as connection:
+            row = connection.execute(
+                "SELECT inbox.read_id, conversations.last_id FROM inbox "
+                "LEFT JOIN conversations ON conversations.conversation = inbox.conversation "
+                "WHERE inbox.username = ? AND inbox.conversation = ?",
+                (username, key)
+            ).fetchone()
+            if row is None:
+                return
+            # Messages that have not been sent yet cannot have been read.
+            up_to_id = min(up_to_id, -1 if row[1] is None else row[1])
+            if up_to_id <= row[0]:
+                return
+
+            self._set_read(connection, username, key, up_to_id)
+
+    def put_inbox_entry(self, username, conversation, read_id):
+        with self._transaction() as connection:
+            self._set_read(connection, username, KEY_SEPARATOR.join(conversation), read_id)
+
+    def close(self):
+        with self.write_lock, self.connections_lock:
+            for connection in self.connections:
+                connection.close()
+            self.connections = []
+            self.local = threading.local()
+
+    """
+    Gets the connection for the calling thread, opening it if needed.
+    """
+    def _connection(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode = WAL")
+            connection.execute("PRAGMA synchronous = " + self.synchronous)
+            self.local.connection = connection
+            with self.connections_lock:
+                self.connections.append(connection)
+        return connection
+
+    """
+    Runs a single write statement in its own transaction.
+    """
+    def _write(self, sql, params):
+        with self._transaction() as connection:
+            connection.execute(sql, params)
+
+    """
+    Holds the write lock for a transaction on the calling thread's connection,
+    which is committed when the block ends, and records how long it took.
+    """
+    @contextlib.contextmanager
+    def _transaction(self):
+        with self.write_lock:
+            start = time.perf_counter()
+            with self._connection() as connection:
+                yield connection
+            metrics.registry.record_flush("sqlite", time.perf_counter() - start)
+
+    """
+    Sets the last message a user has read in a conversation, adding it to
+    their inbox if needed. The messages up to it are counted from the end, so
+    that this costs as much as the number of messages after it.
+    """
+    def _set_read(self, connection, username, key, read_id):
+        row = connection.execute("SELECT count FROM conversations WHERE conversation = ?", (key,)).fetchone()
+        count = 0 if row is None else row[0]
+
+        (after, sent) = connection.execute(
+            "SELECT COUNT(*), COUNT(CASE WHEN sender = ? THEN 1 END) FROM messages WHERE conversation = ? AND id > ?",
+            (username, key, read_id)
+        ).fetchone()
+
+        connection.execute(
+            "INSERT OR REPLACE INTO inbox VALUES (?, ?, ?, ?, ?)",
+            (username, key, read_id, count - after, sent)
+        )
+
+    def _message(self, row):
+        (id, sender, receiver_type, receiver, timestamp, text) = row
+        return messages.Message(id, sender, messages.USER if receiver_type == "user" else messages.GROUP, receiver, timestamp, text)
@@ -0,0 +1,148 @@
+from collections import deque
+import logging
+import threading
+
+
+"""
+Ways a pool can react when its queue is full.
+
+"wait" makes the submitter wait for room, "shed" drops the task, and "busy"
+drops the task and lets the submitter report that the server is busy.
+"""
+OVERLOAD_POLICIES = ("wait", "shed", "busy")
+
+
+"""
+Thread pool with a bounded queue of pending tasks, shared by every connection.
+
+Tasks can be submitted on their own, or through a Strand, which runs its tasks
+one at a time in the order they were submitted. This keeps requests from one
+peer in order without dedicating a thread to each peer. Threads are started on
+demand, up to the configured maximum.
+"""
+class WorkerPool:
+    def __init__(self, threads=32, queue_size=1024, overload="wait"):
+        if not overload in OVERLOAD_POLICIES:
+            raise ValueError("Unknown overload policy " + overload)
+
+        self.max_threads = threads
+        self.queue_size = queue_size
+        self.overload = overload
+
+        # Runnable items: plain tasks, or strands with at least one task.
+        self.queue = deque()
+        # Number of accepted tasks that have not started running yet.
+        self.pending = 0
+        # Number of tasks running right now.
+        self.running = 0
+        self.threads = []
+        self.idle = 0
+
+        self.lock = threading.Lock()
+        self.work = threading.Condition(self.lock)
+        self.space = threading.Condition(self.lock)
+        self.done = threading.Condition(self.lock)
+
+    """
+    Submits a task to be run by the pool, optionally as part of a strand.
+
+    Returns False if the queue is full and the task was not accepted. If block
+    is true, waits for room in the queue instead.
+    """
+    def submit(self, task, strand=None, block=False):
+        with self.lock:
+            while self.pending >= self.queue_size:
+                if not block:
+                    return False
+                self.space.wait()
+
+            self.pending += 1
+
+            if strand is None:
+                self._schedule(task)
+            else:
+                strand.tasks.append(task)
+                if not strand.scheduled:
+                    strand.scheduled = True
+                    self._schedule(strand)
+
+        return True
+
+    """
+    Waits until every accepted task has finished running, or until timeout
+    seconds have passed. Returns whether the pool is idle.
+    """
+    def wait(self, timeout=None):
+        with self.lock:
+            return self.done.wait_for(lambda: self.pending == 0 and self.running == 0, timeout)
+
+    """
+    Gets the number of tasks waiting to run.
+    """
+    def depth(self):
+        return self.pending
+
+    """
+    Gets the number of worker threads started so far.
+    """
+    def size(self):
+        return len(self.threads)
+
+    # Must be called with the lock held.
+    def _schedule(self, item):
+        self.queue.append(item)
+
+        if self.idle < len(self.queue) and len(self.threads) < self.max_threads:
+            thread = threading.Thread(target=self._work, daemon=True)
+            self.threads.append(thread)
+            thread.start()
+        else:
+            self.work.notify()
+
+    def _work(self):
+        while True:
+            with self.lock:
+                while not self.queue:
+                    self.idle += 1
+                    self.work.wait()
+                    self.idle -= 1
+
+                item = self.queue.popleft()
+                if isinstance(item, Strand):
+                    strand = item
+                    task = strand.tasks.popleft()
+                else:
+                    strand = None
+                    task = item
+
+                self.pending -= 1
+                self.running += 1
+                self.space.notify()
+
+            try:
+                task()
+            except Exception:
+                logging.exception("Unhandled exception in worker task")
+
+            with self.lock:
+                self.running -= 1
+
+                # Put the strand at the back of the queue if it has more work,
+                # so that one busy peer cannot monopolize a worker.
+                if strand is not None:
+                    if strand.tasks:
+                        self._schedule(strand)
+                    else:
+                        strand.scheduled = False
+
+                if self.pending == 0 and self.running == 0:
+                    self.done.notify_all()
+
+
+"""
+A sequence of tasks that run one after another, in submission order.
+"""
+class Strand:
+    def __init__(self):
+        self.tasks = deque()
+        self.scheduled = False
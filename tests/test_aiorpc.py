@@ -0,0 +1,119 @@
+from server import (aiorpc, rpc)
+import unittest
+
+
+"""
+Worker pool that accepts a set number of tasks and runs them when asked.
+"""
+class StubPool:
+    overload = "wait"
+
+    def __init__(self):
+        self.capacity = 0
+        self.tasks = []
+
+    def submit(self, task, strand=None, block=False):
+        if self.capacity <= 0:
+            return False
+        self.capacity -= 1
+        self.tasks.append(task)
+        return True
+
+    def run(self):
+        (tasks, self.tasks) = (self.tasks, [])
+        for task in tasks:
+            task()
+
+
+class StubLoop:
+    def __init__(self):
+        self.later = []
+
+    def call_later(self, delay, callback):
+        self.later.append(callback)
+
+    def call_soon_threadsafe(self, callback, *args):
+        callback(*args)
+
+
+class StubTransport:
+    def __init__(self):
+        self.reading = True
+
+    def get_extra_info(self, name):
+        return None
+
+    def pause_reading(self):
+        self.reading = False
+
+    def resume_reading(self):
+        self.reading = True
+
+    def is_closing(self):
+        return False
+
+
+class EchoHandler(rpc.Handler):
+    def echo(self, value):
+        return value
+
+
+class BacklogTest(unittest.TestCase):
+    def setUp(self):
+        self.pool = rpc.pool
+        rpc.pool = StubPool()
+
+    def tearDown(self):
+        rpc.pool = self.pool
+
+    def test_backlogged_requests_each_get_one_response(self):
+        loop = StubLoop()
+        transport = StubTransport()
+        listener = aiorpc.AsyncListener(loop, EchoHandler)
+        listener.connection_made(transport)
+        responses = []
+        listener.send = responses.append
+
+        for id in range(5):
+            listener._dispatch({"jsonrpc": "2.0", "id": id, "method": "echo", "params": {"value": id}})
+        self.assertEqual(len(listener.backlog), 5)
+        self.assertFalse(transport.reading)
+
+        # Room for only some of the backlog, then for the rest.
+        rpc.pool.capacity = 3
+        loop.later.pop(0)()
+        rpc.pool.run()
+        rpc.pool.capacity = 10
+        loop.later.pop(0)()
+        rpc.pool.run()
+
+        self.assertEqual(sorted(response["id"] for response in responses), list(range(5)))
+        for response in responses:
+            self.assertEqual(response["result"], response["id"])
+        self.assertEqual(len(listener.backlog), 0)
+        self.assertTrue(transport.reading)
+
+    def test_batch_waits_for_room(self):
+        loop = StubLoop()
+        transport = StubTransport()
+        listener = aiorpc.AsyncListener(loop, EchoHandler)
+        listener.connection_made(transport)
+        responses = []
+        listener.send = responses.append
+
+        rpc.pool.capacity = 1
+        listener._receive([{"jsonrpc": "2.0", "id": id, "method": "echo", "params": {"value": id}} for id in range(3)])
+        self.assertEqual(len(listener.backlog), 2)
+        self.assertFalse(transport.reading)
+
+        rpc.pool.capacity = 10
+        loop.later.pop(0)()
+        rpc.pool.run()
+
+        self.assertEqual(len(responses), 1)
+        self.assertEqual(sorted((response["id"], response["result"]) for response in responses[0]), [(0, 0), (1, 1), (2, 2)])
+        self.assertTrue(transport.reading)
+
+
+if __name__ == "__main__":
+    unittest.main()
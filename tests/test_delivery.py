@@ -0,0 +1,55 @@
+from server.modules import delivery
+import threading
+import unittest
+
+
+class DeliveryStatsTest(unittest.TestCase):
+    def setUp(self):
+        self.manager = delivery.DeliveryManager(threads=2, queue_size=2)
+
+    def test_stats(self):
+        received = []
+        done = threading.Event()
+
+        def callback(method, message):
+            received.append(message)
+            if len(received) == 2:
+                done.set()
+
+        self.manager.register("alice", callback)
+        self.manager.deliver("alice", {"text": "one"})
+        self.manager.deliver("alice", {"text": "two"})
+        self.assertTrue(done.wait(5))
+
+        stats = self.manager.get_stats()["alice"]
+        self.assertEqual(stats["delivered"], 2)
+        self.assertEqual(stats["queued"], 0)
+        self.assertGreaterEqual(stats["max_lag"], stats["last_lag"])
+
+    def test_summary(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def callback(method, message):
+            started.set()
+            release.wait(5)
+
+        self.manager.register("alice", callback)
+        self.manager.register("bob", lambda method, message: None)
+
+        # The first message holds up alice's queue, so the fourth pushes out the second.
+        self.manager.deliver("alice", {"text": "one"})
+        self.assertTrue(started.wait(5))
+        for text in ("two", "three", "four"):
+            self.manager.deliver("alice", {"text": text})
+        summary = self.manager.get_summary()
+        release.set()
+
+        self.assertEqual(summary["dropped"], 1)
+        self.assertEqual(summary["queued"], 2)
+        self.assertGreaterEqual(summary["oldest_age"], 0.0)
+        self.assertEqual(set(self.manager.get_stats()), {"alice", "bob"})
+
+
+if __name__ == "__main__":
+    unittest.main()
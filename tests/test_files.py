@@ -0,0 +1,84 @@
+from server import storage
+from server.modules import messages
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+
+class TieredStorageTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.backend = self.open()
+
+    def tearDown(self):
+        self.backend.close()
+        shutil.rmtree(self.directory)
+
+    def open(self, **kwargs):
+        kwargs.setdefault("hot_messages", 3)
+        return storage.open_backend("files", self.directory, fsync="os", **kwargs)
+
+    def reopen(self, **kwargs):
+        self.backend.close()
+        self.backend = self.open(**kwargs)
+
+    def send(self, count, timestamp=None):
+        for i in range(count):
+            receiver = "bob" if i % 2 == 0 else "carol"
+            message = messages.Message(None, "alice", messages.USER, receiver, timestamp or time.time(), "message " + str(i))
+            conversation = messages.conversation_key(message)
+            self.backend.add_message(message, conversation)
+            self.backend.update_inbox(conversation, message, ["alice", receiver])
+
+    def texts(self, receiver, **kwargs):
+        conversation = messages.user_conversation("alice", receiver)
+        return [message.text for message in self.backend.get_conversation(conversation, **kwargs)]
+
+    def test_only_newest_kept_in_memory(self):
+        self.send(10)
+        self.assertEqual(sorted(self.backend.hot), [7, 8, 9])
+        self.assertEqual(self.texts("bob"), ["message " + str(i) for i in range(0, 10, 2)])
+        self.assertEqual(self.texts("carol", before_id=7, limit=2), ["message 3", "message 5"])
+        self.assertEqual(self.texts("carol", since_id=1, limit=1), ["message 3"])
+
+    def test_cold_after_reopening(self):
+        self.send(10)
+        self.reopen()
+        self.assertEqual(self.backend.hot, {})
+        self.assertEqual(self.texts("bob"), ["message " + str(i) for i in range(0, 10, 2)])
+        self.assertEqual([message.id for message in self.backend.iter_messages()], list(range(10)))
+
+        inbox = self.backend.get_inbox("alice")
+        self.assertEqual([entry["last_message"].text for entry in inbox], ["message 9", "message 8"])
+
+        # New messages carry on from the end of the log.
+        self.send(1)
+        self.assertEqual(sorted(self.backend.hot), [10])
+        self.assertEqual(self.texts("bob")[-1], "message 0")
+
+    def test_old_messages_age_out(self):
+        self.reopen(hot_messages=100, hot_age=60)
+        self.send(4, time.time() - 120)
+        self.send(2)
+        self.assertEqual(sorted(self.backend.hot), [4, 5])
+        self.assertEqual(len(self.texts("bob")), 3)
+
+    def test_index_ahead_of_log_rebuilt(self):
+        self.send(10)
+        self.backend.close()
+        # The log lost its last messages, as if the machine crashed before
+        # they reached the disk.
+        path = os.path.join(self.directory, "messages", "%020d.log" % 0)
+        with open(path, "r+b") as f:
+            f.truncate(os.path.getsize(path) - 1)
+
+        self.backend = self.open()
+        self.assertEqual(self.backend.log.count, 9)
+        self.assertEqual(self.texts("carol"), ["message 1", "message 3", "message 5", "message 7"])
+        self.assertEqual(len(self.texts("bob")), 5)
+
+
+if __name__ == "__main__":
+    unittest.main()
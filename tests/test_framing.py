@@ -0,0 +1,90 @@
+from server import framing
+import unittest
+
+
+"""
+Feeds data to a decoder the way a reader would, in reads of at most size
+bytes, and returns the payloads of the frames it yields.
+"""
+def feed(decoder, data, size=None):
+    payloads = []
+    while data:
+        view = decoder.get_buffer()
+        count = min(len(view), len(data), size or len(data))
+        view[:count] = data[:count]
+        decoder.buffer_updated(count)
+        data = data[count:]
+        payloads.extend(bytes(frame) for frame in decoder.frames())
+    return payloads
+
+
+class DecoderTest(unittest.TestCase):
+    def check_partial_frames(self, framing_name):
+        payloads = [b"first", b"", b"x" * 10000, b"\0\0\0" + b"last"]
+        data = b"".join(framing.frame(payload, framing_name) for payload in payloads)
+        # Every read size splits frames, lengths and delimiters differently.
+        for size in (1, 3, 5, 4096, len(data)):
+            decoder = framing.FrameDecoder(framing=framing_name)
+            self.assertEqual(feed(decoder, data, size), payloads)
+
+    def test_partial_delimited_frames(self):
+        self.check_partial_frames(framing.DELIMITED)
+
+    def test_partial_length_frames(self):
+        self.check_partial_frames(framing.LENGTH)
+
+    def test_oversized_delimited_frame(self):
+        decoder = framing.FrameDecoder(max_frame_size=100)
+        self.assertEqual(feed(decoder, b"x" * 100 + framing.DELIMITER), [b"x" * 100])
+        with self.assertRaises(framing.FrameException):
+            feed(decoder, b"x" * 101)
+
+    def test_oversized_length_frame(self):
+        decoder = framing.FrameDecoder(max_frame_size=100, framing=framing.LENGTH)
+        self.assertEqual(feed(decoder, framing.frame(b"x" * 100, framing.LENGTH)), [b"x" * 100])
+        # Rejected from the length alone, before the payload arrives.
+        with self.assertRaises(framing.FrameException):
+            feed(decoder, (101).to_bytes(framing.LENGTH_SIZE, "big"))
+
+    def test_switch_framing_between_frames(self):
+        decoder = framing.FrameDecoder()
+        data = framing.frame(b"hello") + framing.frame(b"length", framing.LENGTH)
+        view = decoder.get_buffer(len(data))
+        view[:len(data)] = data
+        decoder.buffer_updated(len(data))
+
+        frames = decoder.frames()
+        self.assertEqual(bytes(next(frames)), b"hello")
+        decoder.framing = framing.LENGTH
+        self.assertEqual([bytes(frame) for frame in frames], [b"length"])
+
+
+class BufferTest(unittest.TestCase):
+    def test_no_buffer_until_data_arrives(self):
+        decoder = framing.FrameDecoder()
+        self.assertEqual(len(decoder.buffer), 0)
+        self.assertGreaterEqual(len(decoder.get_buffer()), framing.MIN_READ_SIZE)
+
+    def test_buffer_released_once_parsed(self):
+        decoder = framing.FrameDecoder(framing=framing.LENGTH)
+        self.assertEqual(feed(decoder, framing.frame(b"hello", framing.LENGTH)), [b"hello"])
+        self.assertEqual(len(decoder.buffer), 0)
+
+    def test_large_frame_does_not_keep_buffer_large(self):
+        decoder = framing.FrameDecoder(bufsize=8192)
+        payload = b"x" * 100000
+        self.assertEqual(feed(decoder, framing.frame(payload), 4096), [payload])
+        self.assertEqual(len(decoder.buffer), 0)
+
+        self.assertEqual(feed(decoder, framing.frame(b"small")), [b"small"])
+        decoder.get_buffer()
+        self.assertEqual(len(decoder.buffer), 8192)
+
+    def test_partial_frame_kept(self):
+        decoder = framing.FrameDecoder()
+        self.assertEqual(feed(decoder, b"one" + framing.DELIMITER + b"tw"), [b"one"])
+        self.assertEqual(feed(decoder, b"o" + framing.DELIMITER), [b"two"])
+
+
+if __name__ == "__main__":
+    unittest.main()
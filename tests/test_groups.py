@@ -0,0 +1,76 @@
+from server import storage
+from server.main import Handler
+from server.modules import (accounts, groups, messages, session)
+import shutil
+import tempfile
+import unittest
+
+
+class GroupPermissionTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.backend = storage.open_backend("files", self.directory, fsync="os")
+        for module in (accounts, groups, messages):
+            module.manager.open(self.backend)
+        for username in ("owner", "member", "outsider", "admin"):
+            self.backend.put_account(accounts.Account(username, "hash", "First", "Last", username + "@example.com", "here"))
+
+        self.session_manager = session.manager
+        session.manager = session.SessionManager(admins=["admin"])
+        self.handler = Handler(None)
+
+        self.group = groups.manager.create_group()
+        for username in ("owner", "member", "admin"):
+            groups.manager.add_user_to_group(username, self.group)
+
+    def tearDown(self):
+        session.manager = self.session_manager
+        self.backend.close()
+        shutil.rmtree(self.directory)
+
+    """
+    Gets a token for a user without going through the password hasher.
+    """
+    def sign_in(self, username):
+        token = session.Token(username, ("127.0.0.1", 0))
+        session.manager.tokens[token.token] = token
+        return token.token
+
+    def members(self):
+        return groups.manager.get_group(self.group)["users"]
+
+    def test_outsider_cannot_remove_member(self):
+        with self.assertRaisesRegex(Exception, "not in the group"):
+            self.handler.remove_group_user(self.sign_in("outsider"), self.group, "member")
+        self.assertIn("member", self.members())
+
+    def test_member_cannot_remove_other_member(self):
+        with self.assertRaisesRegex(Exception, "Only administrators"):
+            self.handler.remove_group_user(self.sign_in("owner"), self.group, "member")
+        self.assertIn("member", self.members())
+
+    def test_member_can_leave(self):
+        self.handler.remove_group_user(self.sign_in("member"), self.group, "member")
+        self.assertNotIn("member", self.members())
+
+    def test_admin_can_remove_member(self):
+        self.handler.remove_group_user(self.sign_in("admin"), self.group, "member")
+        self.assertNotIn("member", self.members())
+
+    def test_outsider_cannot_read_group_history(self):
+        with self.assertRaisesRegex(Exception, "not in the group"):
+            self.handler.get_message_page_in_group(self.sign_in("outsider"), self.group)
+        self.assertEqual(self.handler.get_message_page_in_group(self.sign_in("member"), self.group)["messages"], [])
+
+    def test_outsider_cannot_delete_group(self):
+        with self.assertRaisesRegex(Exception, "not in the group"):
+            self.handler.delete_group(self.sign_in("outsider"), self.group)
+        self.assertTrue(groups.manager.group_exists(self.group))
+
+    def test_member_can_delete_group(self):
+        self.handler.delete_group(self.sign_in("member"), self.group)
+        self.assertFalse(groups.manager.group_exists(self.group))
+
+
+if __name__ == "__main__":
+    unittest.main()
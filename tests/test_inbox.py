@@ -0,0 +1,118 @@
+from server import storage
+from server.modules import (accounts, messages)
+from server.storage import files
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+
+"""
+Runs the same inbox tests against every backend.
+"""
+class InboxTest:
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.backend = storage.open_backend(self.name, self.directory, fsync="os")
+        for username in ("alice", "bob"):
+            self.backend.put_account(accounts.Account(username, "hash", "First", "Last", username + "@example.com", "here"))
+        self.conversation = messages.user_conversation("alice", "bob")
+
+    def tearDown(self):
+        self.backend.close()
+        shutil.rmtree(self.directory)
+
+    def send(self, sender, receiver, text):
+        message = messages.Message(None, sender, messages.USER, receiver, time.time(), text)
+        id = self.backend.add_message(message, self.conversation)
+        self.backend.update_inbox(self.conversation, message, [sender, receiver])
+        return id
+
+    def entry(self, username):
+        (entry,) = self.backend.get_inbox(username)
+        return entry
+
+    def summary(self, username):
+        entry = self.entry(username)
+        return (entry["last_message"].id, entry["read_id"], entry["unread"])
+
+    def test_read_id_past_last_message(self):
+        self.send("bob", "alice", "one")
+        last_id = self.send("bob", "alice", "two")
+
+        self.backend.mark_read("alice", self.conversation, 10 ** 6)
+        self.assertEqual(self.entry("alice")["read_id"], last_id)
+        self.assertEqual(self.entry("alice")["unread"], 0)
+
+        last_id = self.send("bob", "alice", "three")
+        self.assertEqual(self.entry("alice")["unread"], 1)
+        self.backend.mark_read("alice", self.conversation, last_id)
+        self.assertEqual(self.entry("alice")["read_id"], last_id)
+        self.assertEqual(self.entry("alice")["unread"], 0)
+
+    def test_read_id_must_be_integer(self):
+        last_id = self.send("bob", "alice", "one")
+        for up_to_id in (str(last_id), float(last_id), None, True):
+            with self.assertRaises(Exception):
+                self.backend.mark_read("alice", self.conversation, up_to_id)
+        self.assertEqual(self.entry("alice")["unread"], 1)
+
+    def test_own_messages_are_not_unread(self):
+        self.send("bob", "alice", "one")
+        self.send("alice", "bob", "two")
+        self.assertEqual(self.entry("alice")["unread"], 1)
+        self.assertEqual(self.entry("bob")["unread"], 1)
+
+
+class FileInboxTest(InboxTest, unittest.TestCase):
+    name = "files"
+
+    def test_flush_only_logs_changes(self):
+        self.send("bob", "alice", "one")
+        self.backend.flush()
+        self.assertFalse(os.path.exists(os.path.join(self.directory, "inbox.pickle.tmp")))
+        snapshot = os.stat(os.path.join(self.directory, "inbox.pickle")).st_mtime_ns
+
+        for text in ("two", "three"):
+            self.send("bob", "alice", text)
+        self.backend.flush()
+        self.assertEqual(os.stat(os.path.join(self.directory, "inbox.pickle")).st_mtime_ns, snapshot)
+        self.assertGreater(self.backend.inbox_log.count, 0)
+
+    def test_changes_survive_crash(self):
+        self.send("bob", "alice", "one")
+        last_id = self.send("bob", "alice", "two")
+        self.backend.mark_read("alice", self.conversation, last_id)
+        self.send("bob", "alice", "three")
+
+        # Open the same directory again without closing, as after a crash.
+        expected = {username: self.summary(username) for username in ("alice", "bob")}
+        self.backend = storage.open_backend(self.name, self.directory, fsync="os")
+        for username, summary in expected.items():
+            self.assertEqual(self.summary(username), summary)
+        self.assertEqual(self.backend.inbox_log.count, 0)
+
+    def test_compaction(self):
+        inbox_log_limit = files.INBOX_LOG_LIMIT
+        files.INBOX_LOG_LIMIT = 2
+        try:
+            for text in ("one", "two", "three"):
+                self.send("bob", "alice", text)
+            self.backend.flush()
+        finally:
+            files.INBOX_LOG_LIMIT = inbox_log_limit
+
+        self.assertEqual(self.backend.inbox_log.count, 0)
+        self.backend.close()
+        self.backend = storage.open_backend(self.name, self.directory, fsync="os")
+        self.assertEqual(self.entry("alice")["unread"], 3)
+        self.assertEqual(self.entry("bob")["unread"], 0)
+
+
+class SqliteInboxTest(InboxTest, unittest.TestCase):
+    name = "sqlite"
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,158 @@
+from server import log
+import os
+import shutil
+import tempfile
+import unittest
+
+
+class LogTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.logs = []
+
+    def tearDown(self):
+        for opened in self.logs:
+            opened.close()
+        shutil.rmtree(self.directory)
+
+    """
+    Opens the log, with segments small enough to roll every few records.
+    """
+    def open(self, segment_size=1024):
+        opened = log.Log(self.directory, "os", segment_size=segment_size)
+        self.logs.append(opened)
+        return opened
+
+    def reopen(self, opened, **kwargs):
+        opened.close()
+        self.logs.remove(opened)
+        return self.open(**kwargs)
+
+    def fill(self, opened, count):
+        for i in range(count):
+            self.assertEqual(opened.append(("record", i, "x" * 50)), i)
+
+    def segment_path(self, start):
+        return os.path.join(self.directory, "%020d.log" % start)
+
+    def test_reads_across_segments(self):
+        opened = self.open()
+        self.fill(opened, 300)
+        self.assertGreater(len(opened.segments), 2)
+
+        # The sparse index of every full segment is written when it rolls.
+        for start in opened.segments[:-1]:
+            self.assertTrue(os.path.exists(os.path.join(self.directory, "%020d.idx" % start)))
+        for i in (0, 1, 63, 64, 65, 150, 299):
+            self.assertEqual(opened.read(i)[1], i)
+        self.assertEqual([record[1] for record in opened.scan(100)], list(range(100, 300)))
+        with self.assertRaises(IndexError):
+            opened.read(300)
+
+    def test_recover_after_roll(self):
+        opened = self.open()
+        self.fill(opened, 300)
+        segments = opened.segments
+
+        opened = self.reopen(opened)
+        opened.recover()
+        self.assertEqual(opened.count, 300)
+        self.assertEqual(opened.segments, segments)
+        self.assertEqual([opened.read(i)[1] for i in (0, 64, 200, 299)], [0, 64, 200, 299])
+
+        # Appending carries on in the last segment.
+        self.assertEqual(opened.append(("record", 300, "")), 300)
+        self.assertEqual(opened.read(300)[1], 300)
+
+    def test_truncated_tail(self):
+        opened = self.open()
+        self.fill(opened, 300)
+        path = self.segment_path(opened.segments[-1])
+        opened.close()
+        with open(path, "ab") as f:
+            f.write(log.HEADER.pack(100, 0) + b"partial")
+        size = os.path.getsize(path)
+
+        opened = self.reopen(opened)
+        opened.recover()
+        self.assertEqual(opened.count, 300)
+        self.assertEqual(os.path.getsize(path), size - log.HEADER.size - len(b"partial"))
+        self.assertEqual(opened.append(("record", 300, "")), 300)
+
+        opened = self.reopen(opened)
+        self.assertEqual([record[1] for record in opened.replay()], list(range(301)))
+
+    def test_replay_truncates_tail(self):
+        opened = self.open(segment_size=1024 * 1024)
+        self.fill(opened, 10)
+        opened.close()
+        path = self.segment_path(0)
+        with open(path, "r+b") as f:
+            f.truncate(os.path.getsize(path) - 1)
+
+        opened = self.reopen(opened, segment_size=1024 * 1024)
+        self.assertEqual([record[1] for record in opened.replay()], list(range(9)))
+        self.assertEqual(opened.append(("record", 9, "")), 9)
+        self.assertEqual(opened.read(9)[1], 9)
+
+    def test_missing_index_rebuilt(self):
+        opened = self.open()
+        self.fill(opened, 300)
+        opened.close()
+        first = os.path.join(self.directory, "%020d.idx" % 0)
+        with open(first, "rb") as f:
+            index = f.read()
+        os.remove(first)
+
+        opened = self.reopen(opened)
+        opened.recover()
+        with open(first, "rb") as f:
+            self.assertEqual(f.read(), index)
+        self.assertEqual([opened.read(i)[1] for i in range(300)], list(range(300)))
+
+    def test_corrupt_full_segment(self):
+        opened = self.open()
+        self.fill(opened, 300)
+        opened.close()
+        path = self.segment_path(0)
+        with open(path, "r+b") as f:
+            f.truncate(os.path.getsize(path) - 1)
+        os.remove(os.path.join(self.directory, "%020d.idx" % 0))
+
+        opened = self.reopen(opened)
+        with self.assertRaisesRegex(Exception, "is corrupt"):
+            opened.recover()
+
+    def test_read_only(self):
+        opened = self.open()
+        self.fill(opened, 300)
+        path = self.segment_path(opened.segments[-1])
+        opened.close()
+        with open(path, "ab") as f:
+            f.write(b"partial")
+        os.remove(os.path.join(self.directory, "%020d.idx" % 0))
+        before = sorted(os.listdir(self.directory))
+        size = os.path.getsize(path)
+
+        opened = log.Log(self.directory, "os", segment_size=1024, read_only=True)
+        self.logs.append(opened)
+        opened.recover()
+        self.assertEqual(opened.count, 300)
+        self.assertEqual([record[1] for record in opened.scan()], list(range(300)))
+        with self.assertRaisesRegex(Exception, "read-only"):
+            opened.append(("record", 300, ""))
+        self.assertEqual(sorted(os.listdir(self.directory)), before)
+        self.assertEqual(os.path.getsize(path), size)
+
+    def test_reset(self):
+        opened = self.open()
+        self.fill(opened, 300)
+        opened.reset()
+        self.assertEqual(opened.count, 0)
+        self.assertEqual(os.listdir(self.directory), [])
+        self.assertEqual(opened.append(("record", 0, "")), 0)
+        self.assertEqual(opened.read(0)[1], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
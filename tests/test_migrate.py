@@ -0,0 +1,161 @@
+from server import storage
+from server.modules import (accounts, messages)
+from server.storage import migrate
+import os
+import pickle
+import shutil
+import tempfile
+import time
+import unittest
+
+
+class MigrateTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.backends = []
+
+    def tearDown(self):
+        for backend in self.backends:
+            backend.close()
+        shutil.rmtree(self.directory)
+
+    def open(self, name, subdirectory, read_only=False):
+        backend = storage.open_backend(name, self.directory + "/" + subdirectory, fsync="os", read_only=read_only)
+        self.backends.append(backend)
+        return backend
+
+    """
+    Gets the contents of every file under a directory, keyed by path.
+    """
+    def contents(self, subdirectory):
+        files = {}
+        for root, _, names in os.walk(self.directory + "/" + subdirectory):
+            for name in names:
+                with open(os.path.join(root, name), "rb") as f:
+                    files[os.path.join(root, name)] = f.read()
+        return files
+
+    def fill(self, backend):
+        for username in ("alice", "bob", "carol"):
+            backend.put_account(accounts.Account(username, "hash", "First", "Last", username + "@example.com", "here"))
+        backend.add_friends("alice", ["bob", "carol"])
+        backend.create_group("g")
+        for username in ("alice", "bob", "carol"):
+            backend.add_group_user("g", username)
+
+        sent = [
+            messages.Message(None, "alice", messages.USER, "bob", time.time(), "hello bob"),
+            messages.Message(None, "bob", messages.USER, "alice", time.time(), "hi alice"),
+            messages.Message(None, "carol", messages.GROUP, "g", time.time(), "hello group"),
+            messages.Message(None, "alice", messages.GROUP, "g", time.time(), "hello again"),
+            messages.Message(None, "bob", messages.USER, "alice", time.time(), "still there?")
+        ]
+        ids = []
+        for message in sent:
+            conversation = messages.conversation_key(message)
+            ids.append(backend.add_message(message, conversation))
+            usernames = [] if message.receiver_type == messages.GROUP else [message.sender, message.receiver]
+            backend.update_inbox(conversation, message, usernames)
+
+        # Alice has read the first group message and the first reply from Bob.
+        backend.mark_read("alice", ("group", "g"), ids[2])
+        backend.mark_read("alice", messages.user_conversation("alice", "bob"), ids[1])
+
+    def snapshot(self, backend):
+        conversations = [messages.user_conversation("alice", "bob"), ("group", "g")]
+        history = {
+            conversation: [(message.sender, message.receiver, message.text) for message in backend.get_conversation(conversation)]
+            for conversation in conversations
+        }
+        inboxes = {}
+        for username in ("alice", "bob", "carol"):
+            inboxes[username] = sorted(
+                (entry["conversation"], entry["last_message"].text, entry["unread"])
+                for entry in backend.get_inbox(username)
+            )
+        return {
+            "accounts": sorted(backend.get_usernames()),
+            "friends": backend.get_friends("alice"),
+            "groups": backend.get_group_users("g"),
+            "history": history,
+            "inboxes": inboxes
+        }
+
+    def check_round_trip(self, first, second):
+        source = self.open(first, "source")
+        self.fill(source)
+        middle = self.open(second, "middle")
+        migrate.migrate(source, middle)
+        destination = self.open(first, "destination")
+        migrate.migrate(middle, destination)
+
+        expected = self.snapshot(source)
+        self.assertEqual(self.snapshot(middle), expected)
+        self.assertEqual(self.snapshot(destination), expected)
+        self.assertEqual(expected["inboxes"]["alice"][1][2], 1)
+
+        # New messages can be added after a migration.
+        message = messages.Message(None, "carol", messages.GROUP, "g", time.time(), "after")
+        for backend in (middle, destination):
+            backend.add_message(message, ("group", "g"))
+            message.id = None
+
+    def test_files_to_sqlite_and_back(self):
+        self.check_round_trip("files", "sqlite")
+
+    def test_sqlite_to_files_and_back(self):
+        self.check_round_trip("sqlite", "files")
+
+    def test_source_left_unchanged(self):
+        source = self.open("files", "source")
+        self.fill(source)
+        source.close()
+        self.backends.remove(source)
+        # Friend and inbox changes still in their logs, as after a crash.
+        source = self.open("files", "source")
+        source.add_friends("bob", ["alice"])
+        source.mark_read("bob", ("group", "g"), 3)
+        source.flush()
+        source.friend_log.close()
+        source.inbox_log.close()
+        source.log.close()
+        self.backends.remove(source)
+        before = self.contents("source")
+
+        source = self.open("files", "source", read_only=True)
+        destination = self.open("sqlite", "destination")
+        migrate.migrate(source, destination)
+        self.assertEqual(self.snapshot(destination), self.snapshot(source))
+        self.assertEqual(destination.get_friends("bob"), ["alice"])
+        source.close()
+        self.backends.remove(source)
+        self.assertEqual(self.contents("source"), before)
+
+    def test_legacy_source_left_unchanged(self):
+        os.makedirs(self.directory + "/source")
+        sent = [
+            messages.Message(0, "alice", messages.USER, "bob", time.time(), "hello bob"),
+            messages.Message(1, "bob", messages.USER, "alice", time.time(), "hi alice")
+        ]
+        with open(self.directory + "/source/messages.pickle", "wb") as f:
+            pickle.dump([message.to_dict() for message in sent], f)
+        with open(self.directory + "/source/accounts.pickle", "wb") as f:
+            pickle.dump({
+                username: accounts.Account(username, "hash", "First", "Last", username + "@example.com", "here")
+                for username in ("alice", "bob")
+            }, f)
+        before = self.contents("source")
+
+        source = self.open("files", "source", read_only=True)
+        destination = self.open("sqlite", "destination")
+        migrate.migrate(source, destination)
+        conversation = messages.user_conversation("alice", "bob")
+        self.assertEqual([message.text for message in destination.get_conversation(conversation)], ["hello bob", "hi alice"])
+        self.assertEqual([entry["unread"] for entry in destination.get_inbox("alice")], [0])
+        source.close()
+        self.backends.remove(source)
+        self.assertEqual(self.contents("source"), before)
+
+
+if __name__ == "__main__":
+    unittest.main()
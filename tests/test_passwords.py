@@ -0,0 +1,67 @@
+from server import (passwords, storage)
+from server.modules import accounts
+import hashlib
+import shutil
+import tempfile
+import unittest
+
+
+# Cheap scrypt cost, so that tests do not spend their time hashing.
+PARAMS = (16, 1, 1)
+
+
+class CheckPasswordTest(unittest.TestCase):
+    def test_scrypt_hash(self):
+        stored = passwords.hash_password("secret", PARAMS)
+        self.assertTrue(stored.startswith("scrypt$16$1$1$"))
+        self.assertEqual(passwords.check_password("secret", stored, PARAMS), (True, None))
+        self.assertEqual(passwords.check_password("wrong", stored, PARAMS), (False, None))
+
+    def test_legacy_hash_upgraded(self):
+        stored = hashlib.sha256(b"secret").hexdigest()
+        (valid, new_hash) = passwords.check_password("secret", stored, PARAMS)
+        self.assertTrue(valid)
+        self.assertTrue(new_hash.startswith("scrypt$"))
+        self.assertEqual(passwords.check_password("secret", new_hash, PARAMS), (True, None))
+
+        self.assertEqual(passwords.check_password("wrong", stored, PARAMS), (False, None))
+
+    def test_other_params_upgraded(self):
+        stored = passwords.hash_password("secret", (32, 1, 1))
+        (valid, new_hash) = passwords.check_password("secret", stored, PARAMS)
+        self.assertTrue(valid)
+        self.assertTrue(new_hash.startswith("scrypt$16$1$1$"))
+
+
+class UpgradeTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.backend = storage.open_backend("files", self.directory, fsync="os")
+        accounts.manager.open(self.backend)
+        self.hasher = passwords.hasher
+        passwords.hasher = passwords.PasswordHasher(processes=1, n=PARAMS[0], r=PARAMS[1], p=PARAMS[2])
+
+    def tearDown(self):
+        passwords.hasher.close()
+        passwords.hasher = self.hasher
+        self.backend.close()
+        shutil.rmtree(self.directory)
+
+    def test_legacy_hash_replaced_on_login(self):
+        legacy = hashlib.sha256(b"secret").hexdigest()
+        self.backend.put_account(accounts.Account("alice", legacy, "First", "Last", "alice@example.com", "here"))
+
+        self.assertFalse(accounts.manager.validate_password("alice", "wrong"))
+        self.assertEqual(self.backend.get_account("alice").password, legacy)
+
+        self.assertTrue(accounts.manager.validate_password("alice", "secret"))
+        stored = self.backend.get_account("alice").password
+        self.assertTrue(stored.startswith("scrypt$"))
+
+        # The new hash is kept from then on.
+        self.assertTrue(accounts.manager.validate_password("alice", "secret"))
+        self.assertEqual(self.backend.get_account("alice").password, stored)
+
+
+if __name__ == "__main__":
+    unittest.main()
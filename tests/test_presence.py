@@ -0,0 +1,84 @@
+from server import broker
+from server.modules import presence
+import unittest
+
+
+"""
+Stands in for a worker's connection in the broker. Presence changes are kept
+until deliver() passes them to the worker's presence manager, since the real
+connection does not call back into the worker while the broker is running.
+"""
+class StubWorker:
+    def __init__(self):
+        self.manager = None
+        self.changes = []
+        self.pending = []
+
+    def notify(self, method, params):
+        if method == "presence_changed":
+            self.changes.append((params["username"], params["online"]))
+            self.pending.append((params["username"], params["online"]))
+
+    def deliver(self):
+        for username, online in self.pending:
+            self.manager.set_online(username, online)
+        self.pending = []
+
+
+"""
+Stands in for a worker's broker client, passing presence to the broker.
+"""
+class StubRouter:
+    def __init__(self, broker, worker):
+        self.broker = broker
+        self.worker = worker
+
+    def set_presence(self, username, online):
+        self.broker.set_presence(self.worker, username, online)
+
+
+class SharedPresenceTest(unittest.TestCase):
+    def setUp(self):
+        self.broker = broker.Broker(None)
+        self.workers = [StubWorker(), StubWorker()]
+        self.managers = []
+        for worker in self.workers:
+            self.broker.workers.add(worker)
+            # Long enough that no notifications are sent during the test.
+            worker.manager = presence.PresenceManager(3600, StubRouter(self.broker, worker))
+            self.managers.append(worker.manager)
+
+    def deliver(self):
+        for worker in self.workers:
+            worker.deliver()
+
+    def test_online_in_every_process(self):
+        self.managers[0].connected("alice")
+        self.deliver()
+        self.assertTrue(self.managers[1].is_online("alice"))
+        self.assertEqual(self.workers[1].changes, [("alice", True)])
+        self.assertIn("alice", self.managers[1].changed)
+
+        self.managers[0].disconnected("alice")
+        self.deliver()
+        self.assertFalse(self.managers[1].is_online("alice"))
+
+    def test_online_elsewhere_stays_online(self):
+        self.managers[0].connected("alice")
+        self.managers[1].connected("alice")
+        self.managers[0].disconnected("alice")
+        self.deliver()
+        for manager in self.managers:
+            self.assertTrue(manager.is_online("alice"))
+        self.assertEqual(self.workers[0].changes, [("alice", True)])
+
+    def test_worker_disconnecting(self):
+        self.managers[0].connected("alice")
+        self.broker.disconnected(self.workers[0])
+        self.deliver()
+        self.assertFalse(self.managers[1].is_online("alice"))
+        self.assertEqual(self.workers[1].changes, [("alice", True), ("alice", False)])
+
+
+if __name__ == "__main__":
+    unittest.main()
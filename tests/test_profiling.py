@@ -0,0 +1,76 @@
+from server import profiling
+import cProfile
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+
+class ProfilerTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.profiler = profiling.Profiler(self.directory)
+
+    def tearDown(self):
+        self.profiler.stop()
+        shutil.rmtree(self.directory)
+
+    def test_rejects_invalid_seconds(self):
+        for seconds in (0, -1, "30", None, True, float("nan"), float("inf")):
+            with self.assertRaises(ValueError):
+                self.profiler.start(seconds)
+        self.assertIsNone(self.profiler.window)
+
+    def test_rejects_unknown_mode(self):
+        with self.assertRaises(ValueError):
+            self.profiler.start(30, "trace")
+
+    def test_old_timer_does_not_end_new_window(self):
+        self.profiler.start(0.1)
+        self.profiler.stop()
+        path = self.profiler.start(30)
+        time.sleep(0.3)
+        self.assertIsNotNone(self.profiler.window)
+        self.assertEqual(self.profiler.stop(), path)
+
+    def test_window_ends_when_time_is_up(self):
+        path = self.profiler.start(0.1)
+        time.sleep(0.3)
+        self.assertIsNone(self.profiler.window)
+        self.assertTrue(os.path.exists(path))
+
+    def test_refuses_to_start_under_another_profiler(self):
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            with self.assertRaisesRegex(Exception, "Another profiler"):
+                self.profiler.start(30)
+        finally:
+            profile.disable()
+        self.assertIsNone(self.profiler.window)
+
+    def test_concurrent_calls_are_answered(self):
+        self.profiler.start(30)
+        inside = threading.Barrier(2, timeout=5)
+        results = []
+
+        def method():
+            # Both calls are running at once when they pass the barrier.
+            inside.wait()
+            return 1
+
+        def call():
+            results.append(self.profiler.call("method", method, {}))
+
+        threads = [threading.Thread(target=call) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [1, 1])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,67 @@
+from server import (aiorpc, rpc)
+from tests.test_aiorpc import (EchoHandler, StubLoop, StubPool, StubTransport)
+import unittest
+
+
+class InvalidMethodTest(unittest.TestCase):
+    def setUp(self):
+        self.pool = rpc.pool
+        rpc.pool = StubPool()
+        rpc.pool.capacity = 10
+
+        self.listener = aiorpc.AsyncListener(StubLoop(), EchoHandler)
+        self.listener.connection_made(StubTransport())
+        self.responses = []
+        self.listener.send = self.responses.append
+
+    def tearDown(self):
+        rpc.pool = self.pool
+
+    def test_request(self):
+        self.listener._receive({"jsonrpc": "2.0", "id": 1, "method": 5})
+        rpc.pool.run()
+        self.assertEqual(len(self.responses), 1)
+        self.assertEqual(self.responses[0]["id"], 1)
+        self.assertEqual(self.responses[0]["error"]["code"], rpc.INVALID_REQUEST)
+
+    def test_batch(self):
+        self.listener._receive([
+            {"jsonrpc": "2.0", "id": 1, "method": ["echo"]},
+            {"jsonrpc": "2.0", "method": None},
+            {"jsonrpc": "2.0", "id": 2, "method": "echo", "params": {"value": 2}}
+        ])
+        rpc.pool.run()
+        self.assertEqual(len(self.responses), 1)
+        responses = {response["id"]: response for response in self.responses[0]}
+        self.assertEqual(sorted(responses), [1, 2])
+        self.assertEqual(responses[1]["error"]["code"], rpc.INVALID_REQUEST)
+        self.assertEqual(responses[2]["result"], 2)
+
+
+class ErrorHandler(rpc.Handler):
+    def fail(self):
+        raise rpc.RpcException(rpc.INVALID_PARAMS, "Bad parameters")
+
+
+class HandlerErrorTest(unittest.TestCase):
+    def setUp(self):
+        self.pool = rpc.pool
+        rpc.pool = StubPool()
+        rpc.pool.capacity = 10
+
+    def tearDown(self):
+        rpc.pool = self.pool
+
+    def test_error_code_from_handler(self):
+        listener = aiorpc.AsyncListener(StubLoop(), ErrorHandler)
+        listener.connection_made(StubTransport())
+        responses = []
+        listener.send = responses.append
+
+        listener._receive({"jsonrpc": "2.0", "id": 1, "method": "fail"})
+        rpc.pool.run()
+        self.assertEqual(responses[0]["error"], {"code": rpc.INVALID_PARAMS, "message": "Bad parameters"})
+
+
+if __name__ == "__main__":
+    unittest.main()
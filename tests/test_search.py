@@ -0,0 +1,93 @@
+from server import (search, storage)
+from server.modules import messages
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+
+class SearchIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.index = search.SearchIndex(os.path.join(self.directory, "search.pickle"))
+        self.index.load(lambda id: [])
+        self.texts = ["Café at noon", "coffee at the cafe", "noon meeting", "CAFE, noon?"]
+        for id, text in enumerate(self.texts):
+            self.index.add(id, text)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_tokenize(self):
+        self.assertEqual(search.tokenize("Café_au-lait, 2 cups!"), ["cafe", "au", "lait", "2", "cups"])
+
+    def test_every_term_newest_first(self):
+        self.assertEqual(list(self.index.search(["cafe"])), [3, 1, 0])
+        self.assertEqual(list(self.index.search(["noon", "cafe"])), [3, 0])
+        self.assertEqual(list(self.index.search(["cafe", "missing"])), [])
+        self.assertEqual(list(self.index.search([])), [])
+
+    def test_before_and_within(self):
+        self.assertEqual(list(self.index.search(["cafe"], before_id=3)), [1, 0])
+        self.assertEqual(list(self.index.search(["noon"], within=[0, 1, 3])), [3, 0])
+        self.assertEqual(list(self.index.search(["noon"], 3, [0, 1, 3])), [0])
+
+    def test_saved_and_caught_up(self):
+        self.index.save()
+        index = search.SearchIndex(self.index.path)
+        # Messages stored after the index was saved are added on load.
+        index.load(lambda id: [messages.Message(id, "alice", messages.USER, "bob", time.time(), "late cafe")])
+        self.assertEqual(index.next_id, 5)
+        self.assertEqual(list(index.search(["cafe"])), [4, 3, 1, 0])
+
+
+class BackendSearchTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.backend = storage.open_backend("files", self.directory, fsync="os")
+        self.backend.create_group("g")
+        self.backend.create_group("other")
+        for username in ("alice", "bob"):
+            self.backend.add_group_user("g", username)
+        self.backend.add_group_user("other", "carol")
+
+        self.send("alice", messages.USER, "bob", "lunch at noon")
+        self.send("carol", messages.USER, "dave", "lunch tomorrow")
+        self.send("bob", messages.GROUP, "g", "lunch is ready")
+        self.send("carol", messages.GROUP, "other", "lunch plans")
+        self.send("bob", messages.USER, "alice", "see you at lunch")
+
+    def tearDown(self):
+        self.backend.close()
+        shutil.rmtree(self.directory)
+
+    def send(self, sender, receiver_type, receiver, text):
+        message = messages.Message(None, sender, receiver_type, receiver, time.time(), text)
+        conversation = messages.conversation_key(message)
+        self.backend.add_message(message, conversation)
+        usernames = [] if receiver_type == messages.GROUP else [sender, receiver]
+        self.backend.update_inbox(conversation, message, usernames)
+
+    def search(self, *args, **kwargs):
+        return [message.text for message in self.backend.search_messages(["lunch"], *args, **kwargs)]
+
+    def test_only_own_conversations(self):
+        self.assertEqual(self.search("alice", ["g"]), ["see you at lunch", "lunch is ready", "lunch at noon"])
+        self.assertEqual(self.search("dave", []), ["lunch tomorrow"])
+
+    def test_other_messages_not_read(self):
+        read = []
+        get_message = self.backend._get_message
+        self.backend._get_message = lambda id: read.append(id) or get_message(id)
+        self.search("alice", ["g"])
+        self.assertEqual(read, [4, 2, 0])
+
+    def test_pages(self):
+        self.assertEqual(self.search("alice", ["g"], limit=2), ["see you at lunch", "lunch is ready"])
+        self.assertEqual(self.search("alice", ["g"], before_id=2), ["lunch at noon"])
+        self.assertEqual(self.search("alice", ["g"], conversation=("group", "g")), ["lunch is ready"])
+
+
+if __name__ == "__main__":
+    unittest.main()
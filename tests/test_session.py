@@ -0,0 +1,87 @@
+from server.modules import session
+import time
+import unittest
+
+
+"""
+Stands in for the account manager, accepting any password for any user.
+"""
+class StubAccounts:
+    def user_exists(self, username):
+        return True
+
+    def validate_password(self, username, password):
+        return True
+
+
+class SessionTest(unittest.TestCase):
+    def setUp(self):
+        self.accounts = session.accounts.manager
+        session.accounts.manager = StubAccounts()
+
+    def tearDown(self):
+        session.accounts.manager = self.accounts
+
+    def login(self, manager, username="alice"):
+        return manager.login(username, "password", ("127.0.0.1", 0))
+
+    def test_expiry_slides_with_use(self):
+        manager = session.SessionManager(lifetime=0.5, sweep_interval=3600)
+        token = self.login(manager)
+        time.sleep(0.25)
+        manager.validate_token(token)
+
+        # Past the first expiry time, but not the one moved by using it.
+        time.sleep(0.35)
+        self.assertEqual(manager.sweep(), 0)
+        self.assertIn(token, manager.tokens)
+
+        time.sleep(0.25)
+        self.assertEqual(manager.sweep(), 1)
+        with self.assertRaises(session.AuthenticationException):
+            manager.validate_token(token)
+        self.assertEqual(manager.get_stats()["expired"], 1)
+
+    def test_expired_on_use(self):
+        manager = session.SessionManager(lifetime=3600, sweep_interval=3600)
+        token = self.login(manager)
+        manager.tokens[token].expires = time.time() - 1
+        with self.assertRaises(session.AuthenticationException):
+            manager.validate_token(token)
+        self.assertNotIn("alice", manager.user_tokens)
+        self.assertEqual(manager.get_stats()["expired"], 1)
+
+    def test_sweeper_evicts_in_background(self):
+        manager = session.SessionManager(lifetime=0.1, sweep_interval=0.05)
+        self.login(manager)
+        self.login(manager, "bob")
+
+        deadline = time.time() + 5
+        while manager.tokens and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(manager.tokens, {})
+        self.assertEqual(manager.user_tokens, {})
+
+    def test_logged_out_tokens_dropped_from_heap(self):
+        manager = session.SessionManager(lifetime=3600, sweep_interval=3600)
+        for _ in range(1100):
+            manager.logout(self.login(manager))
+        token = self.login(manager)
+        manager.sweep()
+        self.assertEqual(manager.expiry, [(manager.tokens[token].expires, token)])
+
+    def test_sessions_per_user_capped(self):
+        manager = session.SessionManager(max_sessions_per_user=2, sweep_interval=3600)
+        tokens = [self.login(manager) for _ in range(3)]
+        other = self.login(manager, "bob")
+
+        with self.assertRaises(session.AuthenticationException):
+            manager.validate_token(tokens[0])
+        for token in tokens[1:] + [other]:
+            manager.validate_token(token)
+        self.assertEqual(list(manager.user_tokens["alice"]), tokens[1:])
+        self.assertEqual(manager.get_stats(), {"live": 3, "created": 4, "logged_out": 0, "expired": 0, "capped": 1})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,135 @@
+from server import (aiorpc, rpc, workers)
+from tests.test_aiorpc import (EchoHandler, StubLoop, StubPool, StubTransport)
+import threading
+import time
+import unittest
+
+
+class WorkerPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.release = threading.Event()
+
+    def tearDown(self):
+        self.release.set()
+
+    """
+    Fills a pool of one thread: one task running until release is set, and
+    queue_size more waiting behind it.
+    """
+    def fill(self, pool):
+        started = threading.Event()
+        self.assertTrue(pool.submit(lambda: (started.set(), self.release.wait())))
+        started.wait()
+        for _ in range(pool.queue_size):
+            self.assertTrue(pool.submit(lambda: None))
+
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            workers.WorkerPool(overload="drop")
+
+    def test_strands_run_in_order(self):
+        pool = workers.WorkerPool(threads=4, queue_size=1000)
+        strands = [workers.Strand() for _ in range(3)]
+        results = {strand: [] for strand in strands}
+        running = {strand: 0 for strand in strands}
+        overlapped = []
+
+        def task(strand, i):
+            running[strand] += 1
+            if running[strand] > 1:
+                overlapped.append(strand)
+            time.sleep(0.0005)
+            results[strand].append(i)
+            running[strand] -= 1
+
+        for i in range(50):
+            for strand in strands:
+                self.assertTrue(pool.submit(lambda strand=strand, i=i: task(strand, i), strand))
+        self.assertTrue(pool.wait(10))
+
+        for strand in strands:
+            self.assertEqual(results[strand], list(range(50)))
+        self.assertEqual(overlapped, [])
+        # Strands share the threads rather than getting one each.
+        self.assertLessEqual(pool.size(), 4)
+
+    def test_full_queue_rejects(self):
+        pool = workers.WorkerPool(threads=1, queue_size=2, overload="busy")
+        self.fill(pool)
+        self.assertEqual(pool.depth(), 2)
+        self.assertFalse(pool.submit(lambda: None))
+
+        self.release.set()
+        self.assertTrue(pool.wait(10))
+        self.assertTrue(pool.submit(lambda: None))
+
+    def test_blocking_submit_waits_for_room(self):
+        pool = workers.WorkerPool(threads=1, queue_size=2)
+        self.fill(pool)
+
+        submitted = threading.Event()
+        thread = threading.Thread(target=lambda: (pool.submit(lambda: None, block=True), submitted.set()))
+        thread.start()
+        self.assertFalse(submitted.wait(0.05))
+
+        self.release.set()
+        self.assertTrue(submitted.wait(10))
+        thread.join()
+        self.assertTrue(pool.wait(10))
+
+
+class OverloadPolicyTest(unittest.TestCase):
+    def setUp(self):
+        self.pool = rpc.pool
+        rpc.pool = StubPool()
+
+        self.loop = StubLoop()
+        self.transport = StubTransport()
+        self.listener = aiorpc.AsyncListener(self.loop, EchoHandler)
+        self.listener.connection_made(self.transport)
+        self.responses = []
+        self.listener.send = self.responses.append
+
+    def tearDown(self):
+        rpc.pool = self.pool
+
+    def request(self, id):
+        return {"jsonrpc": "2.0", "id": id, "method": "echo", "params": {"value": id}}
+
+    def test_busy(self):
+        rpc.pool.overload = "busy"
+        rpc.pool.capacity = 1
+        self.listener._dispatch(self.request(1))
+        self.listener._dispatch(self.request(2))
+        rpc.pool.run()
+
+        self.assertEqual(sorted(self.responses, key=lambda response: response["id"]), [
+            {"jsonrpc": "2.0", "id": 1, "result": 1},
+            {"jsonrpc": "2.0", "id": 2, "error": {"code": rpc.SERVER_BUSY, "message": "Server busy"}}
+        ])
+        self.assertTrue(self.transport.reading)
+
+    def test_shed(self):
+        rpc.pool.overload = "shed"
+        rpc.pool.capacity = 1
+        self.listener._dispatch(self.request(1))
+        with self.assertLogs(level="WARNING"):
+            self.listener._dispatch(self.request(2))
+        rpc.pool.run()
+        self.assertEqual([response["id"] for response in self.responses], [1])
+
+    def test_wait(self):
+        rpc.pool.capacity = 1
+        self.listener._dispatch(self.request(1))
+        self.listener._dispatch(self.request(2))
+        self.assertFalse(self.transport.reading)
+
+        rpc.pool.capacity = 1
+        self.loop.later.pop(0)()
+        rpc.pool.run()
+        self.assertEqual(sorted(response["id"] for response in self.responses), [1, 2])
+        self.assertTrue(self.transport.reading)
+
+
+if __name__ == "__main__":
+    unittest.main()